@@ -15,15 +15,65 @@
 import json
 import logging
 import os
+import signal
+import socket
 import sys
-from bottle import Bottle, request, static_file
+import time
+from bottle import Bottle, abort, request, response, static_file
 from rocket import Rocket
-from threading import Thread
+from SocketServer import ThreadingMixIn
+from threading import BoundedSemaphore, Thread
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
 from utils.efetch_helper import EfetchHelper
+from utils.evidence_preloader import EvidencePreloader
+
+
+def _exit_on_signal(signal_number, frame):
+    """Raises SystemExit so a terminated server process shuts down like an interrupted one"""
+    sys.exit(0)
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """A WSGI server that handles each request in a thread, used by worker processes on the shared socket"""
+    daemon_threads = True
+    # Requests handled at the same time, a full worker stops accepting connections so other workers accept them
+    max_threads = 32
+
+    def __init__(self, *args, **kwargs):
+        WSGIServer.__init__(self, *args, **kwargs)
+        self._threads = BoundedSemaphore(self.max_threads)
+
+    def process_request(self, request, client_address):
+        self._threads.acquire()
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self._threads.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self._threads.release()
+
+
+class _WorkerRequestHandler(WSGIRequestHandler):
+    """Logs requests with logging instead of writing them to stderr"""
+
+    def log_message(self, format, *args):
+        logging.debug(u'%s - %s', self.client_address[0], format % args)
 
 
 class Efetch(object):
-    def __init__(self, address, port, elastic_url, debug, cache_dir, max_file_size, plugins_file):
+    # Seconds between checks of the worker processes
+    _supervise_interval = 1
+    _listen_backlog = 128
+
+    def __init__(self, address, port, elastic_url, debug, cache_dir, max_file_size, plugins_file,
+                 max_cache_size=0, max_open_handles=256, magic_pool_size=4, index_evidence=False,
+                 thumbnail_processes=2, preload_paths=None, hash_processes=2, known_good=None, known_bad=None,
+                 allowed_origins=None, workers=1):
         """Initializes Efetch variables and utils.
 
         Args:
@@ -32,12 +82,28 @@ class Efetch(object):
             debug: The boolean that enables debug logging
             cache_dir: The directory to cache temporary files
             max_file_size: The max file size in Megabytes to cache
+            max_cache_size: The max size in Megabytes of the cache directory, 0 for no limit
+            max_open_handles: The max number of open dfvfs file entries and file objects
+            magic_pool_size: The max number of libmagic handles used to detect mimetypes concurrently
+            index_evidence: The boolean that enables the background file system metadata index
+            thumbnail_processes: The number of worker processes that create thumbnails
+            preload_paths: The list of evidence paths to open in the background once the server starts
+            hash_processes: The number of worker processes that hash files for bulk hashing jobs
+            known_good: The list of paths to known good hash lists, i.e. the NSRL
+            known_bad: The list of paths to known bad hash lists
+            allowed_origins: The list of origins allowed to request evidence items from another site, '*' for any
+            workers: The number of server processes, more than 1 pre-forks worker processes that share the cache
         """
         self._address = address
         self._port = port
+        self._workers = max(1, workers)
         self._helper = None
+        self._preloader = None
         self._app = Bottle()
         self._debug = debug
+        self._max_thumbnail_batch = 500
+        self._max_evidence_batch = 1000
+        self._allowed_origins = allowed_origins or []
         self._curr_directory = os.path.dirname(os.path.realpath(__file__))
         output_dir = cache_dir
 
@@ -58,26 +124,149 @@ class Efetch(object):
                 logging.error(u'Could not find nor create output directory ' + output_dir)
                 sys.exit(2)
 
+        if max_cache_size and max_cache_size < max_file_size:
+            logging.warn(u'Max cache size is smaller than the max file size, large files will not stay cached')
+
         if not os.path.isfile(plugins_file):
             logging.warn(u'Plugin config file "' + plugins_file + u'" is empty')
 
-        self._helper = EfetchHelper(self._curr_directory, output_dir,
-                                    max_file_size * 1000000, plugins_file, elastic_url)
+        self._helper_args = (self._curr_directory, output_dir,
+                             max_file_size * 1000000, plugins_file, elastic_url,
+                             max_cache_size * 1000000, max_open_handles, magic_pool_size, index_evidence,
+                             thumbnail_processes, hash_processes, known_good, known_bad)
+        self._preload_paths = preload_paths
+        # Worker processes create their own helper after they are forked, threads and databases are not forked
+        if self._workers == 1:
+            self._create_helper()
 
         self._route()
 
     def start(self):
         """Starts the Bottle server."""
+        if self._workers > 1:
+            self._start_workers()
+            return
+
         rocket = Rocket((self._address, self._port), 'wsgi', {'wsgi_app': self._app})
         server_thread = Thread(target=rocket.start, name='_rocket')
         server_thread.start()
+        self._start_background_work()
 
         try:
             while server_thread.is_alive():
                 server_thread.join(5)
         except (KeyboardInterrupt, SystemExit):
-            self._helper.poll.stop = True
             rocket.stop()
+            self._close()
+
+    def _create_helper(self):
+        """Creates the helper and evidence preloader of this process"""
+        self._helper = EfetchHelper(*self._helper_args)
+        self._preloader = EvidencePreloader(self._helper, self._preload_paths)
+
+    def _start_background_work(self):
+        """Starts preloading evidence and resumes the hashing jobs that were not complete"""
+        self._preloader.start()
+        self._helper.hash_jobs.resume()
+        self._helper.block_hashes.resume()
+
+    def _close(self):
+        """Stops the background threads and closes the cache and databases of this process"""
+        self._helper.poll.stop = True
+        self._preloader.stop = True
+        self._helper.pathspec_helper.cache_manager.close()
+        self._helper.pathspec_helper.metadata_store.close()
+        self._helper.pathspec_helper.thumbnail_service.close()
+        self._helper.hash_jobs.close()
+        self._helper.block_hashes.close()
+        self._helper.known_hashes.close()
+        if self._helper.pathspec_helper.evidence_index:
+            self._helper.pathspec_helper.evidence_index.close()
+
+    def _start_workers(self):
+        """Binds the server socket and forks the worker processes that accept requests on it, then restarts any
+        worker that exits until the server is interrupted or terminated"""
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind((self._address, self._port))
+        listen_socket.listen(self._listen_backlog)
+        # Every worker waits for connections, the workers that lose the race to accept one go back to waiting
+        listen_socket.setblocking(0)
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        logging.info(u'Serving on %s:%d with %d worker processes', self._address, self._port, self._workers)
+
+        # Process ID to worker number
+        workers = {}
+        try:
+            while True:
+                for number in set(range(self._workers)) - set(workers.values()):
+                    workers[self._fork_worker(listen_socket, number)] = number
+                time.sleep(self._supervise_interval)
+                for pid in workers.keys():
+                    exited_pid, status = os.waitpid(pid, os.WNOHANG)
+                    if exited_pid:
+                        # Negative for the signal that killed the worker
+                        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                        logging.warn(u'Worker %d (process %d) exited with code %d, restarting it',
+                                     workers.pop(pid), pid, code)
+        except (KeyboardInterrupt, SystemExit):
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
+            for pid in workers:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            listen_socket.close()
+
+    def _fork_worker(self, listen_socket, number):
+        """Forks a worker process, returns its process ID in the parent and never returns in the worker"""
+        pid = os.fork()
+        if pid:
+            logging.info(u'Started worker %d (process %d)', number, pid)
+            return pid
+
+        exit_code = 0
+        try:
+            self._run_worker(listen_socket, number)
+        except Exception:
+            logging.exception(u'Worker %d failed', number)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _run_worker(self, listen_socket, number):
+        """Serves requests on the shared socket until the worker is interrupted or terminated
+
+        Only the first worker preloads evidence and resumes hashing jobs, so they are not run once per worker.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._create_helper()
+        server = _ThreadingWSGIServer((self._address, self._port), _WorkerRequestHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = listen_socket
+        server.server_name = socket.getfqdn(self._address)
+        server.server_port = self._port
+        server.setup_environ()
+        server.set_app(self._app)
+        server_thread = Thread(target=server.serve_forever, name='_wsgi_server')
+        server_thread.daemon = True
+        server_thread.start()
+        if number == 0:
+            self._start_background_work()
+
+        try:
+            while server_thread.is_alive():
+                server_thread.join(5)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        # The parent also interrupts the workers when it is interrupted, the worker finishes closing first
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server.shutdown()
+        self._close()
 
     def _route(self):
         """Applies the routes to Efetch methods."""
@@ -85,6 +274,11 @@ class Efetch(object):
         self._app.route('/favicon.ico', method='GET', callback=self._get_favicon)
         self._app.route('/resources/<resource_path:path>',
                         method='GET', callback=self._get_resource)
+        self._app.route('/status', method='GET', callback=self._status)
+        self._app.route('/thumbnails', method='GET', callback=self._thumbnails)
+        self._app.route('/thumbnails', method='POST', callback=self._thumbnails)
+        self._app.route('/evidence', method='GET', callback=self._evidence)
+        self._app.route('/evidence', method='POST', callback=self._evidence)
         self._app.route('/plugins', method='GET', callback=self._list_plugins)
         self._app.route('/plugins/', method='GET', callback=self._list_plugins)
         self._app.route('/plugins/<plugin_name>', method='GET', callback=self._plugins)
@@ -110,6 +304,66 @@ class Efetch(object):
         """Returns the home page for Efetch."""
         return self._get_resource(u'index.html')
 
+    def _status(self):
+        """Returns a json object of the handle and cache statistics."""
+        statistics = self._helper.pathspec_helper.get_statistics()
+        statistics['hash_jobs'] = self._helper.hash_jobs.get_statistics()
+        statistics['known_hashes'] = self._helper.known_hashes.get_statistics()
+        statistics['process'] = {'pid': os.getpid(), 'workers': self._workers}
+        return json.dumps(statistics)
+
+    def _evidence(self):
+        """Returns a json object of the evidence items of a list of pathspecs, in the same order."""
+        try:
+            encoded_pathspecs = json.loads(self._helper.get_request_value(request, 'pathspecs', '[]'))
+        except ValueError:
+            abort(400, 'Pathspecs must be a JSON list')
+        if not isinstance(encoded_pathspecs, list) or len(encoded_pathspecs) > self._max_evidence_batch:
+            abort(400, 'Pathspecs must be a JSON list of at most ' + str(self._max_evidence_batch) + ' items')
+
+        index = self._helper.get_request_value(request, 'index', '*')
+        fast = self._helper.get_request_value(request, 'fast', 'False').lower() == 'true'
+
+        # Allows the Kibana plugin to request evidence items from its configured origin
+        origin = request.get_header('Origin')
+        if origin and (origin in self._allowed_origins or '*' in self._allowed_origins):
+            response.set_header('Access-Control-Allow-Origin', origin)
+        response.set_header('Vary', 'Origin')
+        return json.dumps({'items': self._helper.pathspec_helper.get_evidence_items(encoded_pathspecs, index,
+                                                                                   fast=fast)})
+
+    def _thumbnails(self):
+        """Returns a json object of the thumbnails of a list of pathspecs or of one page of a directory."""
+        index = self._helper.get_request_value(request, 'index', '*')
+        encoded_pathspecs = self._helper.get_request_value(request, 'pathspecs', '')
+        cursor = None
+
+        if encoded_pathspecs:
+            try:
+                encoded_pathspecs = json.loads(encoded_pathspecs)
+            except ValueError:
+                abort(400, 'Pathspecs must be a JSON list')
+            if not isinstance(encoded_pathspecs, list) or len(encoded_pathspecs) > self._max_thumbnail_batch:
+                abort(400, 'Pathspecs must be a JSON list of at most ' + str(self._max_thumbnail_batch) + ' items')
+
+            evidence_items = [evidence_item for evidence_item in
+                              self._helper.pathspec_helper.get_evidence_items(encoded_pathspecs, index, fast=True)
+                              if 'error' not in evidence_item]
+        else:
+            encoded_pathspec = self._helper.get_request_value(request, 'pathspec', '')
+            try:
+                cursor = int(self._helper.get_request_value(request, 'cursor', 0))
+                page_size = min(int(self._helper.get_request_value(request, 'page_size', 100)),
+                                self._max_thumbnail_batch)
+            except ValueError:
+                abort(400, 'Cursor and page size must be integers')
+            evidence_items, cursor = self._helper.pathspec_helper.list_directory_page(
+                encoded_pathspec, cursor, page_size, index=index, analyze=False)
+
+        return json.dumps({'thumbnails': self._helper.get_thumbnails(evidence_items),
+                           'retry': 1,
+                           'cursor': cursor})
+
     def _list_plugins(self):
         """Returns a json object of all the plugins."""
         return json.dumps(self._helper.plugin_manager.get_all_plugins())
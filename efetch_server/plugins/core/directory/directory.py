@@ -7,8 +7,54 @@ from jinja2 import Template
 import json
 import logging
 import os
+from urllib import urlencode
 
 class Directory(IPlugin):
+    # Templates
+    _row_template = Template("""
+            <tr class="{% if lazy %}lazy{% endif %}{% if known %} known-{{ known }}{% endif %}"{% if lazy %} data-pathspec="{{ pathspec|e }}"{% endif %}>
+                <!-- {{ file_name }} -->
+                <td style="padding-left: 24px;"><a class="row-link" href="/plugins/{{ plugin }}?{{ url_query }}" {{ target }}>
+                    <img class="row-icon" src="{{ icon }}"{% if thumbnail %} data-thumbnail="{{ pathspec|e }}"{% endif %} style="width:32px;height:32px;"
+                    alt="{{ order }} {{ file_name }}"></a></td>
+                <td><a class="row-link" href="/plugins/{{ plugin }}?{{ url_query }}" {{ target }}>{{file_name}}</a>{% if known == 'bad' %}
+                    <i class="fa fa-exclamation-triangle" title="Known bad"></i>{% endif %}</td>
+                <td>{{ mtime_no_nano }}</td>
+                <td>{{ atime_no_nano }}</td>
+                <td>{{ ctime_no_nano }}</td>
+                <td>{{ crtime_no_nano }}</td>
+                <td>{{ size }}</td>
+                <td>
+                    {{ analyze }}
+                    {{ preview }}
+                    {{ download }}
+                </td>
+            </tr>
+        """)
+    _analyze_template = Template("""
+                    <a href="/plugins/analyze?{{ url_query }}" target="_top" style="padding-right:10px">
+                        <span class="fa-stack fa-md">
+                            <i class="fa fa-square fa-stack-2x"></i>
+                            <i class="fa fa-info-circle fa-stack-1x fa-inverse"></i>
+                        </span>
+                    </a>""")
+    _download_template = Template("""
+                    <a href="/plugins/download?{{ url_query }}">
+                        <span class="fa-stack fa-md">
+                            <i class="fa fa-square fa-stack-2x"></i>
+                            <i class="fa fa-download fa-stack-1x fa-inverse"></i>
+                        </span>
+                    </a>""")
+    _preview_template = Template("""
+                    <a href="/plugins/preview?{{ url_query }}&redirect=True" target="_blank" style="padding-right:10px">
+                        <span class="fa-stack fa-md">
+                            <i class="fa fa-square fa-stack-2x"></i>
+                            <i class="fa fa-eye fa-stack-1x fa-inverse"></i>
+                        </span>
+                    </a>""")
+    # Number of directory entries rendered with the page, the rest are loaded a page at a time
+    _page_size = 1000
+    _max_page_size = 10000
 
     def __init__(self):
         self.display_name = 'Navigate'
@@ -40,6 +86,140 @@ class Directory(IPlugin):
         """Returns the mimetype of this plugins get command"""
         return "text/plain"
 
+    def get_formats(self, evidence, helper, request):
+        """Detects the formats and mimetypes of one page of the directory, returning the icon and mimetype of each
+        file, and the plugin of expandable files"""
+        formats = {}
+
+        cursor, page_size = self._get_page_range(helper, request)
+        items, _ = helper.pathspec_helper.list_directory_page(evidence['pathspec'], cursor, page_size,
+                                                              index=helper.get_request_value(request, 'index', '*'))
+        for item in items:
+            if item.get('meta_type') not in ['File', 'Device']:
+                continue
+            icon = helper.get_icon(item)
+            formats[item['pathspec']] = {'icon': icon,
+                                         'thumbnail': icon.startswith('/plugins/thumbnail'),
+                                         'mimetype': item['mimetype']}
+            if helper.is_expandable_evidence(item):
+                formats[item['pathspec']]['plugin'] = self._evidence_plugin
+                formats[item['pathspec']]['url_query'] = item['url_query']
+                for key in ['volume_type', 'storage_type', 'compression_type', 'archive_type']:
+                    if key in item:
+                        formats[item['pathspec']][key] = item[key]
+
+        return formats
+
+    def get_page(self, evidence, helper, request):
+        """Returns one page of the directory listing as JSON, with the rendered table rows of the page
+
+        The cursor of the next page is None once the listing is complete. Entries are listed without format
+        detection unless analyze=True is requested.
+        """
+        cursor, page_size = self._get_page_range(helper, request)
+        recursive = helper.get_request_value(request, 'recursive', 'False').lower() == 'true'
+        analyze = helper.get_request_value(request, 'analyze', 'False').lower() == 'true'
+
+        items, next_cursor = helper.pathspec_helper.list_directory_page(
+            evidence['pathspec'], cursor, page_size, recursive,
+            helper.get_request_value(request, 'index', '*'), analyze)
+        dir_table, file_table = self._render_rows([dict(item) for item in items], evidence, helper,
+                                                  hide_known=self._hide_known(helper, request))
+
+        return {'items': items,
+                'rows': dir_table + file_table,
+                'cursor': next_cursor}
+
+    def _render_rows(self, items, evidence, helper, force_expand=False, hide_known=False):
+        """Returns the rendered directory rows and file rows of the listed items, without known good files if
+        hide_known is True"""
+        dir_table = []
+        file_table = []
+
+        # Flags the files in known hash lists
+        helper.set_known(items)
+
+        # Gets the List of sub items to display
+        for item in items:
+            if hide_known and item.get('known') == 'good':
+                continue
+
+            # Compressed files do not have file_names, and get the parent name minus the last extension
+            if 'compression_type' in evidence:
+                if 'file_name' not in item or not item['file_name']:
+                    item['file_name'] = os.path.splitext(evidence['file_name'])[0]
+            # If the file does not have a file name set it to '-' for the link
+            if 'file_name' not in item or not item['file_name']:
+                item['file_name'] = '-'
+
+            # Remove nanoseconds for readability, values will be available on the overview page
+            for time in ['mtime', 'atime', 'ctime', 'crtime']:
+                if time in item:
+                    item[time + '_no_nano'] = item[time].split('.')[0].replace('T', ' ')
+
+            # Make human readable size
+            if 'size' in item:
+                item['size'] = Directory.human_readable_size(int(item['size']))
+
+            # Get the icon here to limit the number of calls
+            if not force_expand:
+                item['icon'] = helper.get_icon(item)
+            else:
+                item['icon'] = '/resources/icons/_evidence.png'
+
+            # Thumbnails are loaded by the page in batches
+            item['thumbnail'] = item['icon'].startswith('/plugins/thumbnail')
+            if item['thumbnail']:
+                item['icon'] = '/resources/icons/_page.png'
+
+            # Render analyze link
+            item['analyze'] = self._analyze_template.render(item)
+
+            # Files without detected formats are updated by the page once get_formats returns
+            item['lazy'] = item.get('analyzed', True) is False
+
+            # Known good files stay hidden in the directories navigated to
+            if hide_known and (item['meta_type'] == 'Directory' or helper.is_expandable_evidence(item) or
+                               force_expand):
+                item['url_query'] += '&known=hide'
+
+            # Expandable evidence
+            if helper.is_expandable_evidence(item) or force_expand:
+                item['order'] = 3
+                item['plugin'] = self._evidence_plugin
+                item['download'] = self._download_template.render(item)
+                item['preview'] = self._preview_template.render(item)
+                file_table.append(self._row_template.render(item))
+            # Directories
+            elif item['meta_type'] == 'Directory':
+                item['order'] = 2
+                item['plugin'] = self._dir_plugin
+                dir_table.append(self._row_template.render(item))
+            # Files/Other
+            else:
+                item['order'] = 3
+                item['target'] = 'target="_top"'
+                item['plugin'] = self._file_plugin
+                item['download'] = self._download_template.render(item)
+                item['preview'] = self._preview_template.render(item)
+                file_table.append(self._row_template.render(item))
+
+        return dir_table, file_table
+
+    def _get_page_range(self, helper, request):
+        """Returns the cursor and page size of the request, the first page if they are not valid"""
+        try:
+            return (max(0, int(helper.get_request_value(request, 'cursor', 0))),
+                    min(max(1, int(helper.get_request_value(request, 'page_size', self._page_size))),
+                        self._max_page_size))
+        except ValueError:
+            return 0, self._page_size
+
+    @staticmethod
+    def _hide_known(helper, request):
+        """Returns True if known good files should be hidden, known=hide"""
+        return helper.get_request_value(request, 'known', '') == 'hide'
+
     @staticmethod
     def human_readable_size(num, suffix='B'):
         for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
@@ -50,50 +230,16 @@ class Directory(IPlugin):
 
     def get(self, evidence, helper, path_on_disk, request):
         """Returns the result of this plugin to be displayed in a browser"""
-        dir_table = []
-        file_table = []
+        method = helper.get_request_value(request, 'method', '')
+        if method == 'formats':
+            return self.get_formats(evidence, helper, request)
+        elif method == 'list':
+            return self.get_page(evidence, helper, request)
 
-        # Templates
-        row_template = Template("""
-            <tr>
-                <!-- {{ file_name }} -->
-                <td style="padding-left: 24px;"><a href="/plugins/{{ plugin }}?{{ url_query }}" {{ target }}>
-                    <img src="{{ icon }}" style="width:32px;height:32px;"
-                    alt="{{ order }} {{ file_name }}"></a></td>
-                <td><a href="/plugins/{{ plugin }}?{{ url_query }}" {{ target }}>{{file_name}}</a></td>
-                <td>{{ mtime_no_nano }}</td>
-                <td>{{ atime_no_nano }}</td>
-                <td>{{ ctime_no_nano }}</td>
-                <td>{{ crtime_no_nano }}</td>
-                <td>{{ size }}</td>
-                <td>
-                    {{ analyze }}
-                    {{ preview }}
-                    {{ download }}
-                </td>
-            </tr>
-        """)
-        analyze_template = Template("""
-                    <a href="/plugins/analyze?{{ url_query }}" target="_top" style="padding-right:10px">
-                        <span class="fa-stack fa-md">
-                            <i class="fa fa-square fa-stack-2x"></i>
-                            <i class="fa fa-info-circle fa-stack-1x fa-inverse"></i>
-                        </span>
-                    </a>""")
-        download_template = Template("""
-                    <a href="/plugins/download?{{ url_query }}">
-                        <span class="fa-stack fa-md">
-                            <i class="fa fa-square fa-stack-2x"></i>
-                            <i class="fa fa-download fa-stack-1x fa-inverse"></i>
-                        </span>
-                    </a>""")
-        preview_template = Template("""
-                    <a href="/plugins/preview?{{ url_query }}&redirect=True" target="_blank" style="padding-right:10px">
-                        <span class="fa-stack fa-md">
-                            <i class="fa fa-square fa-stack-2x"></i>
-                            <i class="fa fa-eye fa-stack-1x fa-inverse"></i>
-                        </span>
-                    </a>""")
+        # The directory listed without format detection, the page requests the formats after loading
+        lazy_pathspec = None
+        # The cursor of the next page of the listing, None if the listing is complete
+        next_cursor = None
 
         # ORDER:
         #   1 - Up
@@ -125,6 +271,7 @@ class Directory(IPlugin):
         # Evidence
         elif helper.is_expandable_evidence(evidence):
             items = helper.pathspec_helper.list_base_pathspecs(evidence)
+            helper.pathspec_helper.index_base_pathspecs(items)
 
             # If moving up and only one item is there, go up (Prevents loop from next option)
             if len(items) == 1 and helper.get_request_value(request, 'up', False):
@@ -139,7 +286,9 @@ class Directory(IPlugin):
                 return self.get(evidence, helper, path_on_disk, request)
             # If only one item (volume/partition/etc) go ahead and expand it
             elif len(items) == 1:
-                items = helper.pathspec_helper.list_directory(items[0]['pathspec'])
+                lazy_pathspec = items[0]['pathspec']
+                items, next_cursor = helper.pathspec_helper.list_directory_page(lazy_pathspec, 0, self._page_size,
+                                                                                analyze=False)
             else:
                 force_expand = True
 
@@ -151,56 +300,12 @@ class Directory(IPlugin):
             while initial_pathspec and not getattr(helper.pathspec_helper._decode_pathspec(initial_pathspec), 'location', False):
                 initial_pathspec = helper.pathspec_helper.get_encoded_parent_base_pathspec_manually(initial_pathspec)
 
-            items = helper.pathspec_helper.list_directory(initial_pathspec)
+            lazy_pathspec = initial_pathspec
+            items, next_cursor = helper.pathspec_helper.list_directory_page(lazy_pathspec, 0, self._page_size,
+                                                                            analyze=False)
 
-        # Gets the List of sub items to display
-        for item in items:
-            # Compressed files do not have file_names, and get the parent name minus the last extension
-            if 'compression_type' in evidence:
-                if 'file_name' not in item or not item['file_name']:
-                    item['file_name'] = os.path.splitext(evidence['file_name'])[0]
-            # If the file does not have a file name set it to '-' for the link
-            if 'file_name' not in item or not item['file_name']:
-                item['file_name'] = '-'
-
-            # Remove nanoseconds for readability, values will be available on the overview page
-            for time in ['mtime', 'atime', 'ctime', 'crtime']:
-                if time in item:
-                    item[time + '_no_nano'] = item[time].split('.')[0].replace('T', ' ')
-
-            # Make human readable size
-            if 'size' in item:
-                item['size'] = Directory.human_readable_size(int(item['size']))
-
-            # Get the icon here to limit the number of calls
-            if not force_expand:
-                item['icon'] = helper.get_icon(item)
-            else:
-                item['icon'] = '/resources/icons/_evidence.png'
-
-            # Render analyze link
-            item['analyze'] = analyze_template.render(item)
-
-            # Expandable evidence
-            if helper.is_expandable_evidence(item) or force_expand:
-                item['order'] = 3
-                item['plugin'] = self._evidence_plugin
-                item['download'] = download_template.render(item)
-                item['preview'] = preview_template.render(item)
-                file_table.append(row_template.render(item))
-            # Directories
-            elif item['meta_type'] == 'Directory':
-                item['order'] = 2
-                item['plugin'] = self._dir_plugin
-                dir_table.append(row_template.render(item))
-            # Files/Other
-            else:
-                item['order'] = 3
-                item['target'] = 'target="_top"'
-                item['plugin'] = self._file_plugin
-                item['download'] = download_template.render(item)
-                item['preview'] = preview_template.render(item)
-                file_table.append(row_template.render(item))
+        dir_table, file_table = self._render_rows(items, evidence, helper, force_expand,
+                                                  self._hide_known(helper, request))
 
         # Presorts the tables
         dir_table.sort()
@@ -222,7 +327,69 @@ class Directory(IPlugin):
             parent_item['order'] = 1
             parent_item['plugin'] = self._dir_plugin
             parent_item['url_query'] = parent_item['url_query'] + '&up=True'
-            dir_table.insert(0, row_template.render(parent_item))
+            if self._hide_known(helper, request):
+                parent_item['url_query'] += '&known=hide'
+            dir_table.insert(0, self._row_template.render(parent_item))
+
+        formats_script = ''
+        if lazy_pathspec:
+            list_query = urlencode({'pathspec': lazy_pathspec,
+                                    'index': helper.get_request_value(request, 'index', '*'),
+                                    'method': 'list',
+                                    'page_size': self._page_size,
+                                    'known': helper.get_request_value(request, 'known', '')})
+            formats_query = urlencode({'pathspec': lazy_pathspec,
+                                       'index': helper.get_request_value(request, 'index', '*'),
+                                       'method': 'formats',
+                                       'page_size': self._page_size})
+            formats_script = '''
+                        <script type="text/javascript">
+                            function loadPage(cursor) {
+                                if (cursor === null) {
+                                    return;
+                                }
+                                $.getJSON('/plugins/directory?''' + list_query + '''&cursor=' + cursor, function(page) {
+                                    var rows = $($.parseHTML(page.rows.join(''))).filter('tr');
+                                    directoryTable.rows.add(rows).draw(false);
+                                    efetchThumbnails.load(rows.find('img[data-thumbnail]'));
+                                    if (rows.filter('.lazy').length) {
+                                        loadFormats(cursor);
+                                    }
+                                    loadPage(page.cursor);
+                                });
+                            }
+                            function loadFormats(cursor) {
+                                $.getJSON('/plugins/directory?''' + formats_query + '''&cursor=' + cursor, function(formats) {
+                                    var thumbnails = [];
+                                    $('tr.lazy').each(function() {
+                                        var pathspec = $(this).attr('data-pathspec');
+                                        var item = formats[pathspec];
+                                        if (item) {
+                                            $(this).removeClass('lazy');
+                                            if (item.plugin) {
+                                                $(this).find('a.row-link')
+                                                    .attr('href', '/plugins/' + item.plugin + '?' + item.url_query)
+                                                    .removeAttr('target');
+                                            }
+                                            // Thumbnails are loaded in batches like the rows listed as images
+                                            var icon = $(this).find('img.row-icon');
+                                            if (item.thumbnail) {
+                                                thumbnails.push(icon.attr('data-thumbnail', pathspec)[0]);
+                                            } else {
+                                                icon.attr('src', item.icon);
+                                            }
+                                        }
+                                    });
+                                    efetchThumbnails.load(thumbnails);
+                                });
+                            }
+                            $(document).ready(function() {
+                                if ($('tr.lazy').length) {
+                                    loadFormats(0);
+                                }
+                                loadPage(''' + json.dumps(next_cursor) + ''');
+                            } );
+                        </script>'''
 
         return '''
                 <!DOCTYPE html>
@@ -271,8 +438,9 @@ class Directory(IPlugin):
                                     return -1;
                                 };
                             };
+                            var directoryTable;
                             $(document).ready(function() {
-                                    $('#t01').DataTable({
+                                    directoryTable = $('#t01').DataTable({
                                             "paging": false,
                                             "info": false,
                                             "orderClasses": false,
@@ -285,6 +453,12 @@ class Directory(IPlugin):
                                     );
                             } );
                         </script>
+                        <script type="text/javascript" src="/resources/thumbnails.js"></script>
+                        <script type="text/javascript">
+                            $(document).ready(function() {
+                                efetchThumbnails.load($('img[data-thumbnail]'));
+                            } );
+                        </script>''' + formats_script + '''
                 <style>
                     table.dataTable thead th {
                         position: relative;
@@ -329,6 +503,12 @@ class Directory(IPlugin):
                     table#t01 tr:nth-child(odd) {
                        background-color:#eee;
                     }
+                    table#t01 tr.known-good {
+                        color: #999;
+                    }
+                    table#t01 tr.known-bad {
+                        background-color: #f2dede;
+                    }
                     table#t01 th {
                         background-color: #444;
                         color: white;
@@ -14,6 +14,7 @@ class Thumbnail(IPlugin):
         self.cache = False
         self.fast = True
         self.action = True
+        self._retry_after = 1
         IPlugin.__init__(self)
 
     def activate(self):
@@ -36,4 +37,12 @@ class Thumbnail(IPlugin):
         """Returns either an icon or thumbnail of the provided file"""
         # If it is folder just return the folder icon
         directory, file_name = os.path.split(helper.get_icon(evidence, False))
-        return(static_file(file_name, directory, mimetype='image/png'))
\ No newline at end of file
+        response = static_file(file_name, directory, mimetype='image/png')
+
+        # The thumbnail is still being created, the placeholder tells the client when to ask again
+        if helper.pathspec_helper.thumbnail_service.is_pending(evidence):
+            response.status = 202
+            response.set_header('Retry-After', str(self._retry_after))
+            response.set_header('Cache-Control', 'no-store')
+
+        return response
\ No newline at end of file
@@ -21,6 +21,15 @@ class SimpleRequest(object):
 
 def _action_process(items, helper, request, action_id, plugin, index, check, _actions, action_lock):
     """Runs the specified plugin on the provided event items aka events[hits][hits]"""
+    # Gets the evidence items of the whole queue at once, in the order of the events with pathspecs
+    pathspecs = [item['_source']['pathspec'] for item in items if 'pathspec' in item['_source']]
+    fast = hasattr(plugin, 'fast') and plugin.fast
+    try:
+        evidence_items = iter(helper.pathspec_helper.get_evidence_items(pathspecs, index, plugin.cache, fast))
+    except Exception:
+        logging.warn(u'Failed to get the evidence items of the queue, getting them one at a time')
+        evidence_items = _iter_evidence_items(pathspecs, helper, index, plugin.cache, fast)
+
     for item in items:
         try:
             source = item['_source']
@@ -29,9 +38,9 @@ def _action_process(items, helper, request, action_id, plugin, index, check, _ac
                     _actions[action_id]['fail'] += 1
                     _actions[action_id]['errors'] += source['pathspec'] + '\nNot found in Elasticsearch'
             else:
-                efetch_dictionary = helper.pathspec_helper.\
-                    get_evidence_item(source['pathspec'], index, plugin.cache,
-                                                            hasattr(plugin, 'fast') and plugin.fast)
+                efetch_dictionary = next(evidence_items)
+                if 'error' in efetch_dictionary:
+                    raise RuntimeError(efetch_dictionary['error'])
                 efetch_dictionary['_id'] = item['_id']
                 efetch_dictionary['doc_type'] = item['_type']
                 if not check or plugin.check(efetch_dictionary, efetch_dictionary['file_cache_path']):
@@ -52,6 +61,15 @@ def _action_process(items, helper, request, action_id, plugin, index, check, _ac
                     _actions[action_id]['status'] = 'done'
 
 
+def _iter_evidence_items(pathspecs, helper, index, cache, fast):
+    """Yields the evidence item of each pathspec, or a dictionary with its error if it fails"""
+    for pathspec in pathspecs:
+        try:
+            yield helper.pathspec_helper.get_evidence_item(pathspec, index, cache, fast)
+        except Exception as e:
+            yield {'pathspec': pathspec, 'error': unicode(e) or e.__class__.__name__}
+
+
 class FaActionAjax(IPlugin):
 
     def __init__(self):
@@ -43,6 +43,9 @@ class FaAttach(IPlugin):
     # This list should be limited to files that have generic mimetypes but very common extensions
     supported_extensions = ['pst']
 
+    # Max bytes of strings attached, Elasticsearch rejects requests over 100MB by default and Base64 adds a third
+    max_strings_size = 64000000
+
     def __init__(self):
         self.display_name = 'Index'
         self.popularity = 0
@@ -85,7 +88,14 @@ class FaAttach(IPlugin):
                 '_content': base64.b64encode(helper.pathspec_helper.read_file(evidence['pathspec']))
             }
         else:
+            strings = []
+            size = 0
+            for value in helper.pathspec_helper.get_file_strings(evidence['pathspec']):
+                size += len(value) + 1
+                if size > FaAttach.max_strings_size:
+                    break
+                strings.append(value)
             return {
                 '_indexed_chars': -1,
-                '_content': base64.b64encode("\n".join(helper.pathspec_helper.get_file_strings(evidence['pathspec'])))
+                '_content': base64.b64encode("\n".join(strings))
             }
\ No newline at end of file
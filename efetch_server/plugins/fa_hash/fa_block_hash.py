@@ -0,0 +1,156 @@
+"""
+Hashes a file one block at a time and compares the blocks of two files
+"""
+
+from yapsy.IPlugin import IPlugin
+import json
+from bottle import abort
+from urllib import urlencode
+
+
+class FaBlockHash(IPlugin):
+    _block_sizes = [4096, 65536, 1048576, 16777216]
+    _blocks_page_size = 1000
+
+    def __init__(self):
+        self.display_name = 'Block Hasher'
+        self.popularity = 0
+        self.cache = False
+        self.fast = True
+        self.action = False
+        self.icon = 'fa-th'
+        IPlugin.__init__(self)
+
+    def activate(self):
+        IPlugin.activate(self)
+        return
+
+    def deactivate(self):
+        IPlugin.deactivate(self)
+        return
+
+    def check(self, evidence, path_on_disk):
+        """Checks if the file is compatible with this plugin"""
+        return evidence['meta_type'] == 'File'
+
+    def mimetype(self, mimetype):
+        """Returns the mimetype of this plugins get command"""
+        return "text/plain"
+
+    def get(self, evidence, helper, path_on_disk, request):
+        """Returns the result of this plugin to be displayed in a browser
+
+        method=start starts or resumes hashing, method=stop stops it, method=status returns the progress and whole
+        file digest, method=blocks returns one page of block digests, and method=compare returns the byte ranges that
+        differ from the file of the other pathspec request value. Each takes the block_size and type request values.
+        """
+        method = helper.get_request_value(request, 'method', '')
+        block_size = helper.get_request_value(request, 'block_size', 1048576)
+        hash_type = helper.get_request_value(request, 'type', 'md5').lower()
+        block_hashes = helper.block_hashes
+
+        try:
+            if method == 'start':
+                return block_hashes.start(evidence['pathspec'], block_size, hash_type)
+            elif method == 'stop':
+                block_hashes.stop(evidence['pathspec'], block_size, hash_type)
+                return block_hashes.get_status(evidence['pathspec'], block_size, hash_type) or {}
+            elif method == 'status':
+                return block_hashes.get_status(evidence['pathspec'], block_size, hash_type) or {}
+            elif method == 'blocks':
+                cursor = max(0, int(helper.get_request_value(request, 'cursor', 0)))
+                blocks = block_hashes.get_blocks(evidence['pathspec'], block_size, hash_type, cursor,
+                                                 self._blocks_page_size)
+                return {'blocks': [{'block': block, 'digest': digest} for block, digest in blocks],
+                        'cursor': blocks[-1][0] + 1 if len(blocks) == self._blocks_page_size else None}
+            elif method == 'compare':
+                other_pathspec = helper.get_request_value(request, 'other', '')
+                if not other_pathspec:
+                    abort(400, 'Compare requires the other pathspec')
+                other_status = block_hashes.get_status(other_pathspec, block_size, hash_type)
+                ranges = block_hashes.compare(evidence['pathspec'], other_pathspec, block_size, hash_type)
+                return {'complete': bool(other_status and other_status['complete']),
+                        'ranges': [{'offset': offset, 'length': length} for offset, length in ranges]}
+        except ValueError, error:
+            abort(400, str(error))
+
+        query = urlencode({'pathspec': evidence['pathspec'],
+                           'index': helper.get_request_value(request, 'index', '*')})
+
+        return '''
+                <!DOCTYPE html>
+                <html>
+                <head>
+                        <script src="/resources/jquery-1.11.3.min.js"></script>
+                        <style>
+                            body { font-family: sans-serif; font-size: 13px; }
+                            #status, #ranges { font-family: monospace; white-space: pre-wrap; }
+                        </style>
+                        <script type="text/javascript">
+                            var blockSizes = ''' + json.dumps(self._block_sizes) + ''';
+                            function options() {
+                                return '&block_size=' + $('#block_size').val() + '&type=' + $('#type').val();
+                            }
+                            function loadStatus() {
+                                $.getJSON('/plugins/fa_block_hash?''' + query + '''&method=status' + options(),
+                                    function(status) {
+                                        if (!status.blocks && status.blocks !== 0) {
+                                            $('#status').text('Not hashed');
+                                            return;
+                                        }
+                                        $('#status').text((status.complete ? 'Complete' :
+                                            (status.running ? 'Running' : 'Stopped')) + ', ' + status.blocks +
+                                            ' blocks, ' + status.mb_per_second.toFixed(1) + ' MB/s' +
+                                            (status.digest ? '\\n' + status.hash_type + ': ' + status.digest : ''));
+                                        if (status.running) {
+                                            setTimeout(loadStatus, 2000);
+                                        }
+                                    });
+                            }
+                            $(document).ready(function() {
+                                $.each(blockSizes, function(index, blockSize) {
+                                    $('#block_size').append($('<option>').val(blockSize)
+                                        .text(blockSize / 1024 + ' KB').prop('selected', blockSize == 1048576));
+                                });
+                                $('#block_size, #type').change(loadStatus);
+                                $('#start').click(function() {
+                                    $.getJSON('/plugins/fa_block_hash?''' + query + '''&method=start' + options(),
+                                        loadStatus);
+                                });
+                                $('#stop').click(function() {
+                                    $.getJSON('/plugins/fa_block_hash?''' + query + '''&method=stop' + options(),
+                                        loadStatus);
+                                });
+                                $('#compare').submit(function(event) {
+                                    event.preventDefault();
+                                    $.getJSON('/plugins/fa_block_hash?''' + query + '''&method=compare' + options() +
+                                        '&other=' + encodeURIComponent($('#other').val()), function(data) {
+                                            var lines = $.map(data.ranges, function(range) {
+                                                return '0x' + range.offset.toString(16) + ' - 0x' +
+                                                    (range.offset + range.length).toString(16);
+                                            });
+                                            $('#ranges').text((data.complete ? '' : 'The other file is not ' +
+                                                'completely hashed with these options\\n') +
+                                                (lines.length ? lines.join('\\n') : 'No differences'));
+                                        });
+                                });
+                                loadStatus();
+                            });
+                        </script>
+                </head>
+                <body>
+                    <div>
+                        <select id="block_size"></select>
+                        <select id="type"><option>md5</option><option>sha1</option><option>sha256</option></select>
+                        <button id="start">Hash blocks</button>
+                        <button id="stop">Stop</button>
+                    </div>
+                    <p id="status"></p>
+                    <form id="compare">
+                        <input type="text" id="other" placeholder="Pathspec of the file to compare" size="80">
+                        <button type="submit">Compare</button>
+                    </form>
+                    <p id="ranges"></p>
+                </body>
+                </html>
+                '''
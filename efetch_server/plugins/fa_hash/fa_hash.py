@@ -3,18 +3,19 @@ Get the hash of a file
 """
 
 from yapsy.IPlugin import IPlugin
-import hashlib
 import datetime
 import logging
-import os
 from bottle import abort
 
 
 class FaHash(IPlugin):
+    # Supported hash types, in display order
+    _hash_types = ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
+
     def __init__(self):
         self.display_name = 'File Hasher'
         self.popularity = 0
-        self.cache = True
+        self.cache = False
         self.fast = False
         self.action = True
         IPlugin.__init__(self)
@@ -29,18 +30,18 @@ class FaHash(IPlugin):
 
     def check(self, evidence, path_on_disk):
         """Checks if the file is compatible with this plugin"""
-        return path_on_disk and os.path.isfile(path_on_disk) and evidence['meta_type'] == 'File'
+        return evidence['meta_type'] == 'File'
 
     def mimetype(self, mimetype):
         """Returns the mimetype of this plugins get command"""
         return "text/plain"
 
     def get(self, evidence, helper, path_on_disk, request):
-        """Returns the result of this plugin to be displayed in a browser"""
-        block_size = 65536
-        hashers = {'md5': hashlib.md5(), 'sha1': hashlib.sha1(), 'sha224': hashlib.sha224(), 'sha256': hashlib.sha256(),
-                   'sha384': hashlib.sha384(), 'sha512': hashlib.sha512()}
+        """Returns the result of this plugin to be displayed in a browser
 
+        The type request value is a comma separated list of hash types or 'all', every missing digest is computed
+        in one pass over the file and stored with a single Elasticsearch update.
+        """
         index = helper.get_request_value(request, 'index', False)
         if not index:
             logging.warn('Hash plugin requires an index, but none found')
@@ -62,31 +63,38 @@ class FaHash(IPlugin):
         else:
             doc_type = evidence['doc_type']
 
-        try:
-            hash_type = request.query['type']
-            if hash_type not in hashers.keys():
-                hash_type = 'md5'
-        except:
-            hash_type = 'md5'
-        hasher = hashers[hash_type]
+        requested_types = helper.get_request_value(request, 'type', 'md5').lower()
+        if requested_types == 'all':
+            hash_types = list(self._hash_types)
+        else:
+            hash_types = [hash_type for hash_type in self._hash_types if hash_type in requested_types.split(',')]
+        if not hash_types:
+            hash_types = ['md5']
+
+        results = {}
+        missing_types = []
+        for hash_type in hash_types:
+            if hash_type + '_digest' in evidence:
+                results[hash_type] = evidence[hash_type + '_digest']
+            else:
+                missing_types.append(hash_type)
 
-        if hash_type + '_digest' not in evidence:
+        if missing_types:
             try:
-                with open(path_on_disk, 'rb') as fh:
-                    data = fh.read(block_size)
-                    while data:
-                        hasher.update(data)
-                        data = fh.read(block_size)
-                    fh.close()
-                    hash_time = datetime.datetime.now()
-                    hash_result = hasher.hexdigest()
-                    update = {hash_type + '_time': hash_time, hash_type + "_digest": hash_result}
-                    helper.db_util.update(id_value, index, update, doc_type=doc_type)
+                digests = helper.pathspec_helper.hash_file(evidence['pathspec'], missing_types)
+                hash_time = datetime.datetime.now()
+                update = {}
+                for hash_type, digest in digests.iteritems():
+                    update[hash_type + '_time'] = hash_time
+                    update[hash_type + '_digest'] = digest
+                helper.db_util.update(id_value, index, update, doc_type=doc_type)
+                results.update(digests)
             except:
                 logging.warn('Failed to hash file')
                 return '<xmp style="white-space: pre-wrap;">Error</xmp>'
-        else:
-            hash_result = evidence[hash_type + '_digest']
-
-        return '<xmp style="white-space: pre-wrap;">' + hash_type + ': ' + hash_result + '</xmp>'
 
+        lines = [hash_type + ': ' + results[hash_type] for hash_type in hash_types]
+        known = helper.known_hashes.lookup(results)
+        if known:
+            lines.append('known: ' + known)
+        return '<xmp style="white-space: pre-wrap;">' + '\n'.join(lines) + '</xmp>'
@@ -0,0 +1,154 @@
+"""
+Hashes every file in an evidence item or directory with a bulk hashing job
+"""
+
+from yapsy.IPlugin import IPlugin
+import json
+from urllib import urlencode
+
+
+class FaHashJob(IPlugin):
+    # Supported hash types, in display order
+    _hash_types = ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
+    _results_page_size = 1000
+
+    def __init__(self):
+        self.display_name = 'Bulk Hasher'
+        self.popularity = 0
+        self.cache = False
+        self.fast = True
+        self.action = False
+        self.icon = 'fa-hashtag'
+        IPlugin.__init__(self)
+
+    def activate(self):
+        IPlugin.activate(self)
+        return
+
+    def deactivate(self):
+        IPlugin.deactivate(self)
+        return
+
+    def check(self, evidence, path_on_disk):
+        """Checks if the file is compatible with this plugin"""
+        return evidence['meta_type'] == 'Directory' or 'volume_type' in evidence or 'storage_type' in evidence or \
+            evidence.get('type_indicator') in ['TSK_PARTITION', 'VSHADOW']
+
+    def mimetype(self, mimetype):
+        """Returns the mimetype of this plugins get command"""
+        return "text/plain"
+
+    def get(self, evidence, helper, path_on_disk, request):
+        """Returns the result of this plugin to be displayed in a browser
+
+        method=start starts or resumes the job of the evidence, method=stop stops it, method=status returns the
+        progress of the jobs of the evidence, and method=results returns one page of the hashed files of a job.
+        """
+        method = helper.get_request_value(request, 'method', '')
+        if method == 'start':
+            requested_types = helper.get_request_value(request, 'type', 'md5,sha256').lower().split(',')
+            hash_types = [hash_type for hash_type in self._hash_types if hash_type in requested_types]
+            if helper.is_expandable_evidence(evidence):
+                roots = [item['pathspec'] for item in helper.pathspec_helper.list_base_pathspecs(evidence)]
+            else:
+                roots = [evidence['pathspec']]
+            job_id = helper.hash_jobs.start_job(evidence['pathspec'], roots, hash_types,
+                                                helper.get_request_value(request, 'output_index', None))
+            return helper.hash_jobs.get_status(job_id)
+        elif method == 'stop':
+            helper.hash_jobs.stop_job(self._get_job_id(helper, request))
+            return helper.hash_jobs.get_status(self._get_job_id(helper, request))
+        elif method == 'status':
+            return {'jobs': helper.hash_jobs.get_jobs(evidence['pathspec'])}
+        elif method == 'results':
+            try:
+                cursor = max(0, int(helper.get_request_value(request, 'cursor', 0)))
+            except ValueError:
+                cursor = 0
+            results = helper.hash_jobs.get_results(self._get_job_id(helper, request), cursor,
+                                                   self._results_page_size)
+            return {'results': results,
+                    'cursor': cursor + len(results) if len(results) == self._results_page_size else None}
+
+        query = urlencode({'pathspec': evidence['pathspec'],
+                           'index': helper.get_request_value(request, 'index', '*')})
+
+        return '''
+                <!DOCTYPE html>
+                <html>
+                <head>
+                        <script src="/resources/jquery-1.11.3.min.js"></script>
+                        <style>
+                            body { font-family: sans-serif; font-size: 13px; }
+                            table { border-collapse: collapse; }
+                            td, th { padding: 2px 8px; text-align: left; border-bottom: 1px solid #ddd; }
+                        </style>
+                        <script type="text/javascript">
+                            var hashTypes = ''' + json.dumps(self._hash_types) + ''';
+                            function showJobs(data) {
+                                var rows = $.map(data.jobs, function(job) {
+                                    var state = job.complete ? 'Complete' : (job.running ? 'Running' : 'Stopped');
+                                    return $('<tr>').append(
+                                        $('<td>').text(job.id),
+                                        $('<td>').text(job.hash_types.join(', ')),
+                                        $('<td>').text(state),
+                                        $('<td>').text(job.files + (job.errors ? ' (' + job.errors + ' errors)' : '')),
+                                        $('<td>').text((job.bytes / 1000000).toFixed(1) + ' MB'),
+                                        $('<td>').text(job.files_per_second.toFixed(1)),
+                                        $('<td>').text(job.mb_per_second.toFixed(1)),
+                                        $('<td>').append(job.complete ? '' : $('<button>').text(job.running ? 'Stop' : 'Resume')
+                                            .click(function() {
+                                                if (job.running) {
+                                                    $.getJSON('/plugins/fa_hash_job?''' + query + '''&method=stop&job=' + job.id);
+                                                } else {
+                                                    start(job.hash_types);
+                                                }
+                                            }))
+                                    );
+                                });
+                                $('#jobs tbody').empty().append(rows);
+                            }
+                            function loadJobs() {
+                                $.getJSON('/plugins/fa_hash_job?''' + query + '''&method=status', function(data) {
+                                    showJobs(data);
+                                    setTimeout(loadJobs, 2000);
+                                });
+                            }
+                            function start(types) {
+                                $.getJSON('/plugins/fa_hash_job?''' + query + '''&method=start&type=' + types.join(','));
+                            }
+                            $(document).ready(function() {
+                                $.each(hashTypes, function(index, hashType) {
+                                    $('#types').append($('<label>').append(
+                                        $('<input type="checkbox">').val(hashType)
+                                            .prop('checked', hashType == 'md5' || hashType == 'sha256'),
+                                        hashType + ' '));
+                                });
+                                $('#start').click(function() {
+                                    start($('#types input:checked').map(function() {
+                                        return $(this).val();
+                                    }).get());
+                                });
+                                loadJobs();
+                            });
+                        </script>
+                </head>
+                <body>
+                    <div><span id="types"></span><button id="start">Hash all files</button></div>
+                    <table id="jobs">
+                        <thead>
+                            <tr><th>Job</th><th>Hashes</th><th>State</th><th>Files</th><th>Read</th>
+                                <th>Files/s</th><th>MB/s</th><th></th></tr>
+                        </thead>
+                        <tbody></tbody>
+                    </table>
+                </body>
+                </html>
+                '''
+
+    def _get_job_id(self, helper, request):
+        """Returns the job request value as an integer, or None"""
+        try:
+            return int(helper.get_request_value(request, 'job', ''))
+        except ValueError:
+            return None
@@ -1,15 +1,32 @@
 """
-Returns a static HTML page with the hexdump output, similar to Hexdump -C
+Returns an HTML page with the hexdump output, similar to Hexdump -C, one window of the file at a time
 """
 
+import json
+from urllib import urlencode
 from yapsy.IPlugin import IPlugin
 
 
 class FaHexdump(IPlugin):
+    # Bytes per row
+    _row_length = 16
+    # Default and max number of bytes per page
+    _page_size = 65536
+    _max_page_size = 1048576
+    # Hex text of every byte value, followed by its separator
+    _hex_table = ['%02x ' % x for x in range(256)]
+    # Translation table replacing non printable characters with '.'
+    _printable_table = ''.join([chr(x) if 32 <= x < 127 else '.' for x in range(256)])
+
+    @staticmethod
+    def _script_json(value):
+        """Returns the value as JSON that is safe inside a script tag, the dump contains text from the evidence"""
+        return json.dumps(value).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
     def __init__(self):
         self.display_name = 'Hex View'
         self.popularity = 3
-        self.cache = True
+        self.cache = False
         self.fast = False
         self.action = False
         self.icon = 'fa-file-code-o'
@@ -31,19 +48,128 @@ class FaHexdump(IPlugin):
         """Returns the mimetype of this plugins get command"""
         return "text/plain"
 
+    def get_page(self, evidence, helper, request):
+        """Returns the hexdump of one window of the file as JSON, with the offsets of the previous and next windows
+
+        The window is read directly through the pathspec, the file does not need to be cached. The offset is
+        aligned down to the row length and the next offset is None at the end of the file.
+        """
+        try:
+            offset = max(0, int(helper.get_request_value(request, 'offset', 0)))
+            length = min(max(self._row_length, int(helper.get_request_value(request, 'length', self._page_size))),
+                         self._max_page_size)
+        except ValueError:
+            offset = 0
+            length = self._page_size
+        offset -= offset % self._row_length
+
+        size = int(evidence.get('size', 0) or 0)
+        if size and offset >= size:
+            offset = max(0, size - 1)
+            offset -= offset % self._row_length
+
+        data = helper.pathspec_helper.read_file(evidence['pathspec'], size=length, seek=offset) if length else ''
+        if size:
+            next_offset = offset + length if offset + length < size else None
+        else:
+            next_offset = offset + length if len(data) == length else None
+
+        return {'offset': offset,
+                'length': len(data),
+                'size': size,
+                'previous': max(0, offset - length) if offset else None,
+                'next': next_offset,
+                'dump': self.hex_dump(data, offset)}
+
     def get(self, evidence, helper, path_on_disk, request):
         """Returns the result of this plugin to be displayed in a browser"""
-        input_file = open(path_on_disk, 'rb')
-        return "<xmp>" + self.hex_dump(input_file.read()) + "</xmp>"
+        method = helper.get_request_value(request, 'method', '')
+        if method == 'page':
+            return self.get_page(evidence, helper, request)
+
+        page = self.get_page(evidence, helper, request)
+        page_query = urlencode({'pathspec': evidence['pathspec'],
+                                'index': helper.get_request_value(request, 'index', '*'),
+                                'method': 'page',
+                                'length': self._page_size})
+
+        return '''
+                <!DOCTYPE html>
+                <html>
+                <head>
+                        <script src="/resources/jquery-1.11.3.min.js"></script>
+                        <style>
+                            body { margin: 0; }
+                            #controls { padding: 4px; font-family: monospace; border-bottom: 1px solid #ccc; }
+                            #hexdump { margin: 4px; }
+                        </style>
+                        <script type="text/javascript">
+                            var page = ''' + self._script_json(page) + ''';
+                            function showPage(data) {
+                                page = data;
+                                $('#hexdump').text(page.dump);
+                                $('#position').text('0x' + page.offset.toString(16) + ' - 0x' +
+                                    (page.offset + page.length).toString(16) +
+                                    (page.size ? ' of 0x' + page.size.toString(16) : ''));
+                                $('#previous').prop('disabled', page.previous === null);
+                                $('#next').prop('disabled', page.next === null);
+                            }
+                            function loadPage(offset) {
+                                $.getJSON('/plugins/fa_hexdump?''' + page_query + '''&offset=' + offset, showPage);
+                            }
+                            $(document).ready(function() {
+                                showPage(page);
+                                $('#controls').submit(function(event) {
+                                    event.preventDefault();
+                                    var value = $.trim($('#offset').val());
+                                    // Offsets are hex, with or without the 0x prefix
+                                    var offset = parseInt(value.replace(/^0x/i, ''), 16);
+                                    if (!isNaN(offset)) {
+                                        loadPage(offset);
+                                    }
+                                });
+                                $('#previous').click(function() {
+                                    loadPage(page.previous);
+                                });
+                                $('#next').click(function() {
+                                    loadPage(page.next);
+                                });
+                            });
+                        </script>
+                </head>
+                <body>
+                    <form id="controls">
+                        <button type="button" id="previous">Previous</button>
+                        <button type="button" id="next">Next</button>
+                        <input type="text" id="offset" placeholder="Offset (hex)" size="16">
+                        <button type="submit" id="jump">Jump</button>
+                        <span id="position"></span>
+                    </form>
+                    <pre id="hexdump"></pre>
+                </body>
+                </html>
+                '''
+
+    def hex_dump(self, src, offset=0, sep='.'):
+        """Returns the hexdump of the data, with row offsets starting at the given offset
+
+        The whole window is converted with one table lookup pass for the hex text and one translate call for the
+        printable text, each row is then a pair of slices.
+        """
+        length = self._row_length
+        hex_width = length * 3
+        half = hex_width / 2
+        hex_text = ''.join(map(self._hex_table.__getitem__, bytearray(src)))
+        printable_table = self._printable_table
+        if sep != '.':
+            printable_table = ''.join([chr(x) if 32 <= x < 127 else sep for x in range(256)])
+        printable = src.translate(printable_table)
 
-    def hex_dump(self, src, length=16, sep='.'):
-        FILTER = ''.join([(len(repr(chr(x))) == 3) and chr(x) or sep for x in range(256)])
         lines = []
-        for c in xrange(0, len(src), length):
-            chars = src[c:c + length]
-            hex = ' '.join(["%02x" % ord(x) for x in chars])
-            if len(hex) > 24:
-                hex = "%s %s" % (hex[:24], hex[24:])
-            printable = ''.join(["%s" % ((ord(x) <= 127 and FILTER[ord(x)]) or sep) for x in chars])
-            lines.append("%08x:  %-*s  |%s|\n" % (c, length * 3, hex, printable))
+        for row, start in enumerate(xrange(0, len(src), length)):
+            row_hex = hex_text[row * hex_width:(row + 1) * hex_width]
+            if len(row_hex) > half:
+                row_hex = row_hex[:half] + ' ' + row_hex[half:]
+            lines.append("%08x:  %-*s |%s|\n" % (offset + start, hex_width + 1, row_hex,
+                                                 printable[start:start + length]))
         return ''.join(lines)
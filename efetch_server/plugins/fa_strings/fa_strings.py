@@ -2,6 +2,7 @@
 A simple plugin that takes a file and returns the Strings in it
 """
 
+from urllib import urlencode
 from yapsy.IPlugin import IPlugin
 
 
@@ -13,6 +14,7 @@ class FaStrings(IPlugin):
         self.fast = False
         self.action = False
         self.icon = 'fa-file-text-o'
+        self._page_size = 10000
         IPlugin.__init__(self)
 
     def activate(self):
@@ -32,6 +34,22 @@ class FaStrings(IPlugin):
         return "text/plain"
 
     def get(self, evidence, helper, path_on_disk, request):
-        """Returns the result of this plugin to be displayed in a browser"""
-        return '<xmp style="white-space: pre-wrap;">' + \
-               "\n".join(helper.pathspec_helper.get_file_strings(evidence['pathspec'])) + '</xmp>'
\ No newline at end of file
+        """Returns one page of the strings in the file, starting at the offset request value"""
+        try:
+            offset = max(0, int(helper.get_request_value(request, 'offset', 0)))
+        except ValueError:
+            offset = 0
+
+        lines = []
+        next_offset = None
+        for string_offset, value in helper.pathspec_helper.iter_file_strings(evidence['pathspec'], offset=offset):
+            if len(lines) == self._page_size:
+                next_offset = string_offset
+                break
+            lines.append('%10x  %s' % (string_offset, value))
+
+        html = '<xmp style="white-space: pre-wrap;">' + '\n'.join(lines) + '</xmp>'
+        if next_offset is not None:
+            html += '<a href="/plugins/fa_strings?' + evidence['url_query'] + '&' + \
+                    urlencode({'offset': next_offset}) + '">Next ' + str(self._page_size) + ' strings</a>'
+        return html
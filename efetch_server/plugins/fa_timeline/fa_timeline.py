@@ -105,6 +105,8 @@ class FaTimeline(IPlugin):
             event_dict = {}
             event_dict['total'] = events['hits']['total']
             rows = []
+            # Flags the events of files in known hash lists
+            helper.set_known([item['_source'] for item in events['hits']['hits']])
             for item in events['hits']['hits']:
                 event_row = {}
                 source = item['_source']
@@ -130,6 +132,7 @@ class FaTimeline(IPlugin):
                     else:
                         event_row[key] = ''
                 event_row['index'] = index
+                event_row['known'] = source.get('known')
                 rows.append(event_row)
             event_dict['rows'] = rows
             return event_dict
@@ -0,0 +1,52 @@
+/*
+ * Loads the thumbnails of img elements with a data-thumbnail pathspec using the batch thumbnail endpoint,
+ * one request per batch of images instead of one request per image. Pending thumbnails are requested again
+ * after the retry time returned by the server.
+ */
+var efetchThumbnails = {
+    batchSize: 100,
+    maxAttempts: 5,
+
+    load: function(images, attempt) {
+        attempt = attempt || 0;
+        var byPathspec = {};
+        var pathspecs = [];
+        $(images).each(function() {
+            var pathspec = $(this).attr('data-thumbnail');
+            if (pathspec) {
+                if (!(pathspec in byPathspec)) {
+                    byPathspec[pathspec] = [];
+                    pathspecs.push(pathspec);
+                }
+                byPathspec[pathspec].push(this);
+            }
+        });
+
+        for (var start = 0; start < pathspecs.length; start += efetchThumbnails.batchSize) {
+            efetchThumbnails.loadBatch(pathspecs.slice(start, start + efetchThumbnails.batchSize), byPathspec,
+                attempt);
+        }
+    },
+
+    loadBatch: function(pathspecs, byPathspec, attempt) {
+        $.post('/thumbnails', {pathspecs: JSON.stringify(pathspecs)}, function(data) {
+            var pending = [];
+            $.each(data.thumbnails, function(pathspec, thumbnail) {
+                $.each(byPathspec[pathspec] || [], function(index, image) {
+                    $(image).attr('src', thumbnail.src);
+                    if (thumbnail.pending) {
+                        pending.push(image);
+                    } else {
+                        $(image).removeAttr('data-thumbnail');
+                    }
+                });
+            });
+
+            if (pending.length && attempt < efetchThumbnails.maxAttempts) {
+                setTimeout(function() {
+                    efetchThumbnails.load(pending, attempt + 1);
+                }, 1000 * data.retry * Math.pow(2, attempt));
+            }
+        }, 'json');
+    }
+};
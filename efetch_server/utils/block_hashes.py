@@ -0,0 +1,311 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from efetch_server.utils.file_lock import FileLock
+
+
+class BlockHashes(object):
+    """This class hashes files one fixed size block at a time straight from the evidence, storing the digest of each
+    block and of the whole file in a SQLite database in the cache directory, so large files can be compared block by
+    block without caching them and interrupted hashing resumes at the last stored block"""
+    _database_file_name = u'block_hashes.sqlite'
+    _hash_types = ['md5', 'sha1', 'sha256']
+    _min_block_size = 4096
+    _max_block_size = 67108864
+    # Bytes read from the evidence at a time, a multiple of the block size
+    _read_size = 1048576
+    # Number of block digests stored per transaction
+    _batch_size = 256
+    # Seconds to wait for the lock of a file, it is only held briefly by status checks of other processes
+    _file_lock_timeout = 1
+
+    def __init__(self, cache_directory, pathspec_helper):
+        """Opens or creates the block hash database
+
+        Args:
+            cache_directory: The directory containing the database
+            pathspec_helper: The PathspecHelper used to read the files
+        """
+        self.database_path = os.path.join(cache_directory, self._database_file_name)
+        self.cache_directory = cache_directory
+        self._pathspec_helper = pathspec_helper
+        self._lock = threading.Lock()
+        # (pathspec hash, block size, hash type) to the stop flag of the hashing running in this process
+        self._running = {}
+
+        self._connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        self._connection.execute(u'PRAGMA synchronous = OFF')
+        self._connection.execute(u'PRAGMA journal_mode = WAL')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS files '
+                                 u'(hash TEXT, block_size INTEGER, hash_type TEXT, pathspec TEXT, size INTEGER, '
+                                 u'blocks INTEGER, digest TEXT, complete INTEGER, elapsed REAL, '
+                                 u'PRIMARY KEY (hash, block_size, hash_type))')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS blocks '
+                                 u'(hash TEXT, block_size INTEGER, hash_type TEXT, block INTEGER, digest TEXT, '
+                                 u'PRIMARY KEY (hash, block_size, hash_type, block))')
+        self._connection.commit()
+
+    def start(self, encoded_pathspec, block_size=1048576, hash_type='md5'):
+        """Starts or resumes hashing the blocks of the file in a background thread, returns its status
+
+        Args:
+            encoded_pathspec: The pathspec of the file
+            block_size: The size of each block in bytes, a power of 2 between 4KB and 64MB
+            hash_type: The hashlib algorithm name, md5, sha1, or sha256
+        """
+        block_size, hash_type = self._validate(block_size, hash_type)
+        key = (self._pathspec_helper.get_pathspec_key(encoded_pathspec).hash, block_size, hash_type)
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT complete FROM files WHERE hash = ? AND block_size = ? AND hash_type = ?', key).fetchone()
+            if row and row[0]:
+                return self.get_status(encoded_pathspec, block_size, hash_type, False)
+            if not row:
+                self._connection.execute(u'INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, NULL, 0, NULL, 0, 0)',
+                                         key + (encoded_pathspec,))
+                self._connection.commit()
+            if key in self._running:
+                return self.get_status(encoded_pathspec, block_size, hash_type, False)
+
+        # The file lock is held while the blocks are hashed, so a file is never hashed twice at the same time
+        file_lock = self._get_file_lock(key)
+        if not file_lock.acquire(timeout=self._file_lock_timeout):
+            logging.info(u'Blocks of %s are being hashed by another process', encoded_pathspec)
+            return self.get_status(encoded_pathspec, block_size, hash_type, False)
+        stop_path = self._get_stop_path(key)
+        if os.path.isfile(stop_path):
+            os.remove(stop_path)
+
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT complete FROM files WHERE hash = ? AND block_size = ? AND hash_type = ?', key).fetchone()
+            if row and row[0]:
+                file_lock.release()
+            else:
+                self._running[key] = {'stop': False, 'lock': file_lock, 'stop_path': stop_path}
+                thread = threading.Thread(target=self._run, args=(encoded_pathspec, key, self._running[key]),
+                                          name='_block_hash')
+                thread.daemon = True
+                thread.start()
+        return self.get_status(encoded_pathspec, block_size, hash_type, False)
+
+    def stop(self, encoded_pathspec, block_size=1048576, hash_type='md5'):
+        """Stops hashing the blocks of the file, it resumes at the last stored block when started again
+
+        Hashing run by another server process sharing the cache directory is asked to stop with a stop file.
+        """
+        block_size, hash_type = self._validate(block_size, hash_type)
+        key = (self._pathspec_helper.get_pathspec_key(encoded_pathspec).hash, block_size, hash_type)
+        with self._lock:
+            if key in self._running:
+                self._running[key]['stop'] = True
+                return
+        if self._get_file_lock(key).is_locked():
+            open(self._get_stop_path(key), 'w').close()
+
+    def resume(self):
+        """Resumes the files that were not completely hashed when the server stopped"""
+        with self._lock:
+            rows = self._connection.execute(
+                u'SELECT pathspec, block_size, hash_type FROM files WHERE NOT complete').fetchall()
+        for encoded_pathspec, block_size, hash_type in rows:
+            logging.info(u'Resuming block hashing of ' + encoded_pathspec)
+            self.start(encoded_pathspec, block_size, hash_type)
+
+    def get_status(self, encoded_pathspec, block_size=1048576, hash_type='md5', validate=True):
+        """Returns a dictionary with the progress and whole file digest of the file, or None if it was not started"""
+        if validate:
+            block_size, hash_type = self._validate(block_size, hash_type)
+        key = (self._pathspec_helper.get_pathspec_key(encoded_pathspec).hash, block_size, hash_type)
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT size, blocks, digest, complete, elapsed FROM files '
+                u'WHERE hash = ? AND block_size = ? AND hash_type = ?', key).fetchone()
+            running = key in self._running or self._get_file_lock(key).is_locked()
+        if not row:
+            return None
+
+        size, blocks, digest, complete, elapsed = row
+        hashed = min(size, blocks * block_size) if size is not None else blocks * block_size
+        return {'pathspec': encoded_pathspec,
+                'block_size': block_size,
+                'hash_type': hash_type,
+                'size': size,
+                'blocks': blocks,
+                'digest': digest,
+                'complete': bool(complete),
+                'running': running,
+                'mb_per_second': hashed / 1000000.0 / elapsed if elapsed else 0.0}
+
+    def get_blocks(self, encoded_pathspec, block_size=1048576, hash_type='md5', cursor=0, count=1000):
+        """Returns one page of the block digests of the file as (block, digest) tuples
+
+        Args:
+            encoded_pathspec: The pathspec of the file
+            block_size: The size of each block in bytes
+            hash_type: The hashlib algorithm name
+            cursor: The first block to return
+            count: The max number of blocks to return
+        """
+        block_size, hash_type = self._validate(block_size, hash_type)
+        key = (self._pathspec_helper.get_pathspec_key(encoded_pathspec).hash, block_size, hash_type)
+        with self._lock:
+            return self._connection.execute(
+                u'SELECT block, digest FROM blocks WHERE hash = ? AND block_size = ? AND hash_type = ? '
+                u'AND block >= ? ORDER BY block LIMIT ?', key + (cursor, count)).fetchall()
+
+    def compare(self, encoded_pathspec, other_pathspec, block_size=1048576, hash_type='md5'):
+        """Returns the byte ranges that differ between two files as a list of (offset, length) tuples
+
+        Blocks stored for only one of the files are different, i.e. past the end of the shorter file, so both files
+        should be completely hashed first. Consecutive different blocks are merged into one range.
+        """
+        block_size, hash_type = self._validate(block_size, hash_type)
+        key = (self._pathspec_helper.get_pathspec_key(encoded_pathspec).hash, block_size, hash_type)
+        other_key = (self._pathspec_helper.get_pathspec_key(other_pathspec).hash, block_size, hash_type)
+        with self._lock:
+            blocks = self._connection.execute(
+                u'SELECT first.block FROM blocks AS first '
+                u'LEFT JOIN blocks AS second ON second.hash = ? AND second.block_size = first.block_size AND '
+                u'second.hash_type = first.hash_type AND second.block = first.block '
+                u'WHERE first.hash = ? AND first.block_size = ? AND first.hash_type = ? AND '
+                u'(second.digest IS NULL OR second.digest != first.digest) '
+                u'UNION SELECT second.block FROM blocks AS second '
+                u'LEFT JOIN blocks AS first ON first.hash = ? AND first.block_size = second.block_size AND '
+                u'first.hash_type = second.hash_type AND first.block = second.block '
+                u'WHERE second.hash = ? AND second.block_size = ? AND second.hash_type = ? AND first.digest IS NULL '
+                u'ORDER BY 1',
+                (other_key[0],) + key + (key[0],) + other_key).fetchall()
+            # The size of the longer hashed file, its last block is usually shorter than the block size
+            size = self._connection.execute(
+                u'SELECT MAX(size) FROM files WHERE hash IN (?, ?) AND block_size = ? AND hash_type = ?',
+                (key[0], other_key[0], block_size, hash_type)).fetchone()[0]
+
+        ranges = []
+        for (block,) in blocks:
+            offset = block * block_size
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + block_size)
+            else:
+                ranges.append((offset, block_size))
+        if ranges and size is not None and ranges[-1][0] < size:
+            ranges[-1] = (ranges[-1][0], min(ranges[-1][1], size - ranges[-1][0]))
+        return ranges
+
+    def close(self):
+        """Stops hashing and closes the database"""
+        with self._lock:
+            for state in self._running.values():
+                state['stop'] = True
+            self._connection.close()
+
+    def _validate(self, block_size, hash_type):
+        """Returns the block size and hash type, raises ValueError if either is not supported"""
+        block_size = int(block_size)
+        if block_size < self._min_block_size or block_size > self._max_block_size or block_size & (block_size - 1):
+            raise ValueError(u'Block size must be a power of 2 between %d and %d' %
+                             (self._min_block_size, self._max_block_size))
+        if hash_type not in self._hash_types:
+            raise ValueError(u'Hash type must be one of ' + u', '.join(self._hash_types))
+        return block_size, hash_type
+
+    def _run(self, encoded_pathspec, key, state):
+        """Hashes the blocks after the last stored block, then stores the whole file digest
+
+        The whole file digest cannot be saved part way, so a resumed file reads the blocks that are already stored
+        again for the whole file digest, without hashing them as blocks.
+        """
+        block_size, hash_type = key[1], key[2]
+        try:
+            with self._lock:
+                start_block, elapsed = self._connection.execute(
+                    u'SELECT blocks, elapsed FROM files WHERE hash = ? AND block_size = ? AND hash_type = ?',
+                    key).fetchone()
+            start = time.time()
+            file_hasher = hashlib.new(hash_type)
+            resume_offset = start_block * block_size
+            read_size = max(block_size, self._read_size)
+
+            block = 0
+            size = 0
+            batch = []
+            # The bytes read past the last whole block, reads may be short so blocks span reads
+            partial = ''
+            for data in self._pathspec_helper.iter_file_chunks(encoded_pathspec, read_size):
+                if state['stop'] or os.path.isfile(state['stop_path']):
+                    state['stop'] = True
+                    break
+                file_hasher.update(data)
+                size += len(data)
+                if partial:
+                    data = partial + data
+                end = len(data) - len(data) % block_size
+                for data_offset in xrange(0, end, block_size):
+                    if block >= start_block:
+                        batch.append(key + (block, hashlib.new(hash_type, data[data_offset:data_offset + block_size])
+                                            .hexdigest()))
+                    block += 1
+                partial = data[end:]
+                if len(batch) >= self._batch_size:
+                    self._store_blocks(key, batch, block, start)
+                    start = time.time()
+                    batch = []
+
+            if partial and not state['stop']:
+                if block >= start_block:
+                    batch.append(key + (block, hashlib.new(hash_type, partial).hexdigest()))
+                block += 1
+            self._store_blocks(key, batch, max(block, start_block), start)
+            if not state['stop']:
+                with self._lock:
+                    self._connection.execute(
+                        u'UPDATE files SET size = ?, blocks = ?, digest = ?, complete = 1 '
+                        u'WHERE hash = ? AND block_size = ? AND hash_type = ?',
+                        (size, block, file_hasher.hexdigest()) + key)
+                    self._connection.commit()
+                if resume_offset:
+                    logging.info(u'Resumed block hashing at block %d of %d', start_block, block)
+        except Exception:
+            logging.exception(u'Failed to hash blocks of ' + encoded_pathspec)
+        finally:
+            with self._lock:
+                if self._running.get(key) is state:
+                    del self._running[key]
+            if os.path.isfile(state['stop_path']):
+                os.remove(state['stop_path'])
+            state['lock'].release()
+
+    def _get_file_lock(self, key):
+        """Returns the FileLock held by the process hashing the blocks of the file"""
+        return FileLock.for_cache(self.cache_directory, u'block_hash_%s_%d_%s' % key, temporary=True)
+
+    def _get_stop_path(self, key):
+        """Returns the path of the file that asks the process hashing the blocks of the file to stop"""
+        return os.path.join(self.cache_directory, FileLock.cache_subdirectory, u'block_hash_%s_%d_%s.stop' % key)
+
+    def _store_blocks(self, key, batch, blocks, start):
+        """Stores the block digests and the number of stored blocks of the file"""
+        with self._lock:
+            self._connection.executemany(u'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)', batch)
+            self._connection.execute(
+                u'UPDATE files SET blocks = ?, elapsed = elapsed + ? WHERE hash = ? AND block_size = ? AND '
+                u'hash_type = ?', (blocks, time.time() - start) + key)
+            self._connection.commit()
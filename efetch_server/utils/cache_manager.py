@@ -0,0 +1,294 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from efetch_server.utils.file_lock import FileLock
+
+
+class CacheManager(object):
+    """This class tracks the files in the cache directory and evicts the least recently used files
+
+    The index is a SQLite database in the cache directory, so every server process sharing the cache directory
+    counts the same files against the max cache size. Each change is a write transaction, which also serializes the
+    eviction of the processes.
+    """
+    _database_file_name = u'cache_index.sqlite'
+    # The index of older versions, its last access times are imported once
+    _index_file_name = u'cache_index.json'
+    _cache_subdirectories = [u'files', u'thumbnails']
+    _partial_extension = u'.part'
+    # Cross process locks of cached files, each path hashes to one of a fixed number of lock files
+    _lock_count = 4096
+    # Cache entries are sharded by the first two byte pairs of their hash, i.e. files/ab/cd/abcd.../
+    _shard_depth = 2
+    _hash_pattern = re.compile(r'^[0-9a-f]{40}$')
+    # Number of least recently used entries read at a time while evicting
+    _eviction_batch_size = 100
+    # Seconds to wait for another process to finish writing the index
+    _busy_timeout = 30
+
+    def __init__(self, cache_directory, max_cache_size=0):
+        """Opens or creates the index and reconciles it with the files in the cache directory
+
+        Args:
+            cache_directory: The directory containing the cached files and thumbnails
+            max_cache_size: The max size in bytes of the cache, 0 for no limit
+        """
+        if not cache_directory.endswith(os.path.sep):
+            cache_directory += os.path.sep
+        self.cache_directory = cache_directory
+        self.max_cache_size = max_cache_size
+        self.database_path = os.path.join(cache_directory, self._database_file_name)
+        self._index_path = os.path.join(cache_directory, self._index_file_name)
+        self._lock = threading.RLock()
+        # Evictions by this process
+        self.evictions = 0
+
+        # Transactions are started explicitly so each one takes the write lock before reading
+        self._connection = sqlite3.connect(self.database_path, timeout=self._busy_timeout, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute(u'PRAGMA synchronous = OFF')
+        self._connection.execute(u'PRAGMA journal_mode = WAL')
+        with self._write():
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS entries '
+                                     u'(path TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+            self._connection.execute(u'CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+            # The total size is kept by triggers so it does not need to be summed for every change
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, size INTEGER)')
+            self._connection.execute(u'INSERT OR IGNORE INTO totals VALUES (0, 0)')
+            self._connection.execute(u'CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+                                     u'UPDATE totals SET size = size + new.size WHERE id = 0; END')
+            self._connection.execute(u'CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+                                     u'UPDATE totals SET size = size - old.size WHERE id = 0; END')
+            self._connection.execute(u'CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries '
+                                     u'BEGIN UPDATE totals SET size = size - old.size + new.size WHERE id = 0; END')
+
+        self.rebuild()
+
+    def rebuild(self):
+        """Reconciles the index with the cache directory tree, adding the files that are not in the index and removing
+        the entries of files that no longer exist, the last access times of indexed files are kept"""
+        with self._lock:
+            saved_index = dict([(row[0], [row[1], row[2]]) for row in
+                                self._connection.execute(u'SELECT path, size, last_access FROM entries')])
+        if not saved_index:
+            saved_index = self._load_index()
+        self._migrate_flat_layout(saved_index)
+        entries = {}
+
+        for subdirectory in self._cache_subdirectories:
+            for root, _, file_names in os.walk(os.path.join(self.cache_directory, subdirectory)):
+                for file_name in file_names:
+                    path = os.path.join(root, file_name)
+                    # Partial copies are left behind when the server stops mid-cache
+                    if file_name.endswith(self._partial_extension):
+                        # Unless another worker process is still writing it
+                        lock = self.get_lock(path[:-len(self._partial_extension)])
+                        if lock.acquire(False):
+                            try:
+                                self._remove_file(path)
+                            finally:
+                                lock.release()
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    relative_path = os.path.relpath(path, self.cache_directory)
+                    entries[relative_path] = [stat.st_size, saved_index.get(relative_path, [0, stat.st_mtime])[1]]
+
+        with self._lock:
+            with self._write():
+                indexed = set([row[0] for row in self._connection.execute(u'SELECT path FROM entries')])
+                # Other processes may have cached or evicted files during the walk, their changes are committed
+                # because this transaction holds the write lock, so the files are checked again
+                for relative_path in indexed.difference(entries):
+                    if not os.path.isfile(os.path.join(self.cache_directory, relative_path)):
+                        self._connection.execute(u'DELETE FROM entries WHERE path = ?', (relative_path,))
+                for relative_path in set(entries).difference(indexed):
+                    if os.path.isfile(os.path.join(self.cache_directory, relative_path)):
+                        self._connection.execute(u'INSERT INTO entries VALUES (?, ?, ?)',
+                                                 [relative_path] + entries[relative_path])
+                self._evict()
+            statistics = self.get_statistics()
+        logging.info(u'Cache index contains %d files using %d bytes', statistics['files'], statistics['size'])
+
+        if os.path.isfile(self._index_path):
+            self._remove_file(self._index_path, False)
+
+    def get_directory(self, subdirectory, key):
+        """Returns the sharded directory in the subdirectory for the hex key, i.e. files/ab/cd/abcd.../"""
+        shards = [key[index * 2:index * 2 + 2] for index in range(self._shard_depth)]
+        return os.path.join(self.cache_directory, subdirectory, *(shards + [key])) + os.path.sep
+
+    def get_lock(self, path):
+        """Returns a FileLock held while the cached file at the path is created, shared by all worker processes"""
+        relative_path = os.path.relpath(path, self.cache_directory)
+        if isinstance(relative_path, unicode):
+            relative_path = relative_path.encode('utf-8')
+        stripe = int(hashlib.sha1(relative_path).hexdigest()[:8], 16) % self._lock_count
+        return FileLock.for_cache(self.cache_directory, u'%03x' % stripe)
+
+    def touch(self, path):
+        """Marks the cached file at the path as most recently used, adding it to the index if it is new"""
+        relative_path = os.path.relpath(path, self.cache_directory)
+        try:
+            with self._lock:
+                with self._write():
+                    if not self._connection.execute(u'UPDATE entries SET last_access = ? WHERE path = ?',
+                                                    (time.time(), relative_path)).rowcount:
+                        try:
+                            size = os.path.getsize(path)
+                        except OSError:
+                            return
+                        self._connection.execute(u'INSERT INTO entries VALUES (?, ?, ?)',
+                                                 (relative_path, size, time.time()))
+                    self._evict(relative_path)
+        except sqlite3.Error:
+            logging.warn(u'Failed to update the cache index for ' + relative_path)
+
+    def remove(self, path):
+        """Removes the cached file at the path from the index and the disk"""
+        relative_path = os.path.relpath(path, self.cache_directory)
+        try:
+            with self._lock:
+                with self._write():
+                    self._connection.execute(u'DELETE FROM entries WHERE path = ?', (relative_path,))
+                    self._remove_file(path)
+        except sqlite3.Error:
+            logging.warn(u'Failed to update the cache index for ' + relative_path)
+
+    def get_statistics(self):
+        """Returns a dictionary describing the current state of the cache, the evictions are of this process"""
+        with self._lock:
+            files = self._connection.execute(u'SELECT COUNT(*) FROM entries').fetchone()[0]
+            return {'files': files,
+                    'size': self._get_size(),
+                    'max_size': self.max_cache_size,
+                    'evictions': self.evictions}
+
+    def close(self):
+        """Closes the index, every change is already written"""
+        with self._lock:
+            self._connection.close()
+
+    @contextlib.contextmanager
+    def _write(self):
+        """Runs the block in a write transaction, committed if the block succeeds, the lock must be held"""
+        self._connection.execute(u'BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            self._connection.execute(u'ROLLBACK')
+            raise
+        self._connection.execute(u'COMMIT')
+
+    def _get_size(self):
+        """Returns the total size of the indexed files"""
+        return self._connection.execute(u'SELECT size FROM totals WHERE id = 0').fetchone()[0]
+
+    def _load_index(self):
+        """Returns the index saved by older versions or an empty index if it is missing or corrupt"""
+        if not os.path.isfile(self._index_path):
+            return {}
+        try:
+            with open(self._index_path, 'r') as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            logging.warn(u'Cache index is corrupt, rebuilding from the cache directory')
+            return {}
+
+    def _migrate_flat_layout(self, saved_index):
+        """Moves entries from the old unsharded layout, i.e. files/abcd.../, into the sharded layout"""
+        migrated = 0
+        for subdirectory in self._cache_subdirectories:
+            subdirectory_path = os.path.join(self.cache_directory, subdirectory)
+            if not os.path.isdir(subdirectory_path):
+                continue
+
+            for key in os.listdir(subdirectory_path):
+                old_directory = os.path.join(subdirectory_path, key)
+                if not self._hash_pattern.match(key) or not os.path.isdir(old_directory):
+                    continue
+
+                new_directory = self.get_directory(subdirectory, key)
+                try:
+                    if os.path.isdir(new_directory):
+                        shutil.rmtree(old_directory)
+                    else:
+                        shard_directory = os.path.dirname(os.path.dirname(new_directory))
+                        if not os.path.isdir(shard_directory):
+                            os.makedirs(shard_directory)
+                        os.rename(old_directory, new_directory)
+                except OSError:
+                    logging.warn(u'Failed to migrate cache directory ' + old_directory)
+                    continue
+                migrated += 1
+
+                # Keeps the last access times of the moved files
+                old_prefix = os.path.join(subdirectory, key) + os.path.sep
+                new_prefix = os.path.relpath(new_directory, self.cache_directory) + os.path.sep
+                for relative_path in saved_index.keys():
+                    if relative_path.startswith(old_prefix):
+                        saved_index[new_prefix + relative_path[len(old_prefix):]] = saved_index.pop(relative_path)
+
+        if migrated:
+            logging.info(u'Migrated %d cache directories to the sharded cache layout', migrated)
+
+    def _evict(self, keep=None):
+        """Removes the least recently used files until the cache is within its max size, the file is removed before
+        the transaction commits so another process cannot cache it again in between, the lock must be held"""
+        if not self.max_cache_size:
+            return
+
+        size = self._get_size()
+        while size > self.max_cache_size:
+            # Never evicts the file that was just used
+            rows = self._connection.execute(u'SELECT path, size FROM entries WHERE path != ? '
+                                            u'ORDER BY last_access LIMIT ?',
+                                            (keep or u'', self._eviction_batch_size)).fetchall()
+            if not rows:
+                break
+            for relative_path, entry_size in rows:
+                if size <= self.max_cache_size:
+                    break
+                self._connection.execute(u'DELETE FROM entries WHERE path = ?', (relative_path,))
+                size -= entry_size
+                self.evictions += 1
+                logging.debug(u'Evicting ' + relative_path + u' from the cache')
+                self._remove_file(os.path.join(self.cache_directory, relative_path))
+
+    def _remove_file(self, path, remove_directory=True):
+        """Deletes the file and its entry directory if it is now empty, shard directories are kept"""
+        try:
+            os.remove(path)
+        except OSError:
+            return
+
+        if not remove_directory:
+            return
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
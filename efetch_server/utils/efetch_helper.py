@@ -13,9 +13,13 @@
 # limitations under the License.
 
 
+import base64
 import logging
 import os
+from block_hashes import BlockHashes
 from db_util import DBUtil
+from hash_jobs import HashJobs
+from known_hashes import KnownHashes
 from pathspec_helper import PathspecHelper
 from plugin_manager import EfetchPluginManager
 from poll import Poll
@@ -25,7 +29,9 @@ class EfetchHelper(object):
     """This class provides helper methods to be used in Efetch and its plugins"""
 
 
-    def __init__(self, curr_directory, output_directory, max_file_size, plugins_file, es_url):
+    def __init__(self, curr_directory, output_directory, max_file_size, plugins_file, es_url, max_cache_size=0,
+                 max_open_handles=256, magic_pool_size=4, index_evidence=False, thumbnail_processes=2,
+                 hash_processes=2, known_good=None, known_bad=None):
         """Initializes the Efetch Helper"""
         # Setup directory references
         self.curr_dir = curr_directory
@@ -36,7 +42,8 @@ class EfetchHelper(object):
         if not os.path.isdir(self.icon_dir):
             logging.error(u'Could not find icon directory ' + self.icon_dir)
 
-        self.pathspec_helper = PathspecHelper(output_directory, max_file_size)
+        self.pathspec_helper = PathspecHelper(output_directory, max_file_size, max_cache_size, max_open_handles,
+                                              magic_pool_size, index_evidence, thumbnail_processes)
 
         # Create plugin manager and begin polling for changes to plugins
         self.plugin_manager = EfetchPluginManager(plugins_file, self.curr_dir)
@@ -52,6 +59,17 @@ class EfetchHelper(object):
         else:
             self.db_util = DBUtil(es_url)
 
+        # Known good and known bad hash lists, loaded in the background
+        self.known_hashes = KnownHashes(output_directory, known_good, known_bad)
+        self.known_hashes.start()
+
+        # Bulk hashing jobs, the worker processes are started with the first job
+        self.hash_jobs = HashJobs(output_directory, self.pathspec_helper, self.db_util, hash_processes,
+                                  self.known_hashes)
+
+        # Block level hashing of large files
+        self.block_hashes = BlockHashes(output_directory, self.pathspec_helper)
+
     def get_request_value(self, request, variable_name, default=None):
         """Gets the value of a variable in either a GET or POST request"""
         if variable_name in request.query:
@@ -120,6 +138,25 @@ class EfetchHelper(object):
         # Everything else is not expandable
         return False
 
+    def set_known(self, items):
+        """Sets 'known' of each file item to 'bad' or 'good' if one of its digests is in a known hash list
+
+        The digests are the md5_digest, sha1_digest, and sha256_digest values of the item, i.e. set by the hash
+        plugin, and the digests of the file in the results of bulk hashing jobs.
+        """
+        if not self.known_hashes.is_enabled():
+            return
+
+        files = [item for item in items if item.get('meta_type', 'File') == 'File' and 'pathspec' in item]
+        hashes = [self.pathspec_helper.get_pathspec_key(item['pathspec']).hash for item in files]
+        hashed = self.hash_jobs.get_digests(hashes)
+        for item, pathspec_hash in zip(files, hashes):
+            digests = dict(hashed.get(pathspec_hash, {}))
+            for hash_type in ['md5', 'sha1', 'sha256']:
+                if item.get(hash_type + '_digest'):
+                    digests[hash_type] = item[hash_type + '_digest']
+            item['known'] = self.known_hashes.lookup(digests) if digests else None
+
     def get_icon(self, evidence, resource=True):
         """Returns either an icon or thumbnail of the provided file"""
         if resource:
@@ -131,6 +168,7 @@ class EfetchHelper(object):
                 or 'archive_type' in evidence:
             if not evidence['mimetype_known']:
                 evidence['mimetype'] = self.pathspec_helper.get_mimetype(evidence['pathspec'])
+                evidence['mimetype_known'] = True
         if self.is_expandable_evidence(evidence):
             return curr_icon_dir + '_evidence.png'
 
@@ -148,10 +186,12 @@ class EfetchHelper(object):
         if evidence['mimetype'].startswith('image') and resource:
             return '/plugins/thumbnail?' + evidence['url_query']
         elif evidence['mimetype'].startswith('image'):
-            self.pathspec_helper.create_thumbnail(evidence)
+            thumbnail = self.pathspec_helper.create_thumbnail(evidence)
 
-            if os.path.isfile(evidence['thumbnail_cache_path']):
-                return evidence['thumbnail_cache_path']
+            if thumbnail:
+                return thumbnail
+            elif self.pathspec_helper.thumbnail_service.is_pending(evidence):
+                return curr_icon_dir + '_page.png'
             else:
                 return curr_icon_dir + '_missing.png'
 
@@ -163,6 +203,41 @@ class EfetchHelper(object):
             else:
                 return curr_icon_dir + evidence['extension'].lower() + '.png'
 
+    def get_thumbnails(self, evidence_items):
+        """Returns a dictionary of pathspec to the thumbnail or icon of each evidence item
+
+        Thumbnails are returned as data URIs and icons as resource URLs. Thumbnails that are still being created
+        are returned as a placeholder icon with 'pending' set to True.
+        """
+        thumbnails = {}
+
+        for evidence in evidence_items:
+            icon = self.get_icon(evidence)
+            pending = False
+
+            if icon.startswith('/plugins/thumbnail'):
+                thumbnail_path = self.pathspec_helper.create_thumbnail(evidence)
+                data = None
+                if thumbnail_path:
+                    try:
+                        with open(thumbnail_path, 'rb') as thumbnail_file:
+                            data = thumbnail_file.read()
+                    except (IOError, OSError):
+                        # The thumbnail was evicted from the cache since it was found
+                        logging.debug(u'Failed to read thumbnail ' + thumbnail_path)
+                if data:
+                    mimetype = 'image/jpeg' if data.startswith('\xff\xd8') else 'image/png'
+                    icon = 'data:' + mimetype + ';base64,' + base64.b64encode(data)
+                elif self.pathspec_helper.thumbnail_service.is_pending(evidence):
+                    icon = '/resources/icons/_page.png'
+                    pending = True
+                else:
+                    icon = '/resources/icons/_missing.png'
+
+            thumbnails[evidence['pathspec']] = {'src': icon, 'pending': pending}
+
+        return thumbnails
+
     def action_get(self, evidence, request, display_name, function, term, update_term = False):
         """Runs a function that takes an evidence item, updates the term in elastic, and returns the results"""
         index = self.get_request_value(request, 'index', False)
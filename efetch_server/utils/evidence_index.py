@@ -0,0 +1,248 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import Queue
+import sqlite3
+import threading
+import time
+from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
+from efetch_server.utils.file_lock import FileLock
+from efetch_server.utils.pathspec_key import PathspecKey
+
+
+class EvidenceIndex(threading.Thread):
+    """This thread walks the file systems of opened evidence once and stores the metadata of every entry in a SQLite
+    database in the cache directory, so directory listings and parent lookups do not need dfvfs"""
+    _database_file_name = u'evidence_index.sqlite'
+    # Entry metadata columns, in the order they are stored
+    _columns = ['path', 'file_name', 'inode', 'size', 'mode', 'uid', 'gid', 'mtime', 'atime', 'ctime', 'crtime',
+                'meta_type', 'legacy_type']
+    # Number of entries inserted per transaction
+    _batch_size = 1000
+
+    def __init__(self, cache_directory, stat_function, open_function, close_function):
+        """Opens or creates the index database and removes roots that were not completely indexed, unless another
+        server process sharing the cache directory is indexing them
+
+        Args:
+            cache_directory: The directory containing the database
+            stat_function: The function that takes a file entry and PathspecKey and returns the entry metadata
+            open_function: The function that takes an encoded pathspec and returns its open file entry
+            close_function: The function that takes an encoded pathspec and releases its file entry
+        """
+        super(EvidenceIndex, self).__init__()
+        self.daemon = True
+        self.database_path = os.path.join(cache_directory, self._database_file_name)
+        self.cache_directory = cache_directory
+        self.stop = False
+        self._stat_function = stat_function
+        self._open_function = open_function
+        self._close_function = close_function
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        # Root hashes that are queued or being indexed
+        self._pending = set()
+
+        self._connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        self._connection.execute(u'PRAGMA synchronous = OFF')
+        self._connection.execute(u'PRAGMA journal_mode = WAL')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS roots '
+                                 u'(hash TEXT PRIMARY KEY, pathspec TEXT, complete INTEGER, entries INTEGER, '
+                                 u'started REAL, completed REAL)')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS entries '
+                                 u'(hash TEXT PRIMARY KEY, root_hash TEXT, parent_hash TEXT, position INTEGER, '
+                                 u'pathspec TEXT, ' + u', '.join(self._columns) + u')')
+        self._connection.execute(u'CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent_hash, position)')
+        self._connection.commit()
+
+        for (root_hash,) in self._connection.execute(u'SELECT hash FROM roots WHERE NOT complete').fetchall():
+            root_lock = self._get_root_lock(root_hash)
+            if root_lock.acquire(False):
+                try:
+                    self._remove_root(root_hash)
+                finally:
+                    root_lock.release()
+
+    def queue(self, encoded_pathspec):
+        """Queues the file system root for indexing, unless it is already indexed or queued"""
+        root_hash = PathspecKey(encoded_pathspec).hash
+        with self._lock:
+            if root_hash in self._pending:
+                return
+            if self._connection.execute(u'SELECT 1 FROM roots WHERE hash = ?', (root_hash,)).fetchone():
+                return
+            self._pending.add(root_hash)
+        self._queue.put(encoded_pathspec)
+
+    def is_indexed(self, pathspec_hash):
+        """Returns True if the directory belongs to a completely indexed root"""
+        with self._lock:
+            if self._connection.execute(u'SELECT 1 FROM roots WHERE hash = ? AND complete',
+                                        (pathspec_hash,)).fetchone():
+                return True
+            return bool(self._connection.execute(
+                u'SELECT 1 FROM entries JOIN roots ON entries.root_hash = roots.hash '
+                u'WHERE entries.hash = ? AND roots.complete', (pathspec_hash,)).fetchone())
+
+    def get_children(self, pathspec_hash, cursor=0, count=-1):
+        """Returns the metadata dictionaries of the entries in the directory, in listing order
+
+        Args:
+            pathspec_hash: The hash of the directory pathspec
+            cursor: The number of entries to skip
+            count: The max number of entries to return, -1 for all entries
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                u'SELECT pathspec, ' + u', '.join(self._columns) + u' FROM entries WHERE parent_hash = ? '
+                u'ORDER BY position LIMIT ? OFFSET ?', (pathspec_hash, count, cursor)).fetchall()
+
+        children = []
+        for row in rows:
+            child = {'pathspec': row[0]}
+            for column, value in zip(self._columns, row[1:]):
+                if value is not None:
+                    child[column] = value
+            children.append(child)
+        return children
+
+    def get_parent_pathspec(self, pathspec_hash):
+        """Returns the encoded pathspec of the parent directory or None if the entry is not indexed"""
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT COALESCE(parents.pathspec, roots.pathspec) FROM entries '
+                u'LEFT JOIN entries AS parents ON entries.parent_hash = parents.hash '
+                u'LEFT JOIN roots ON entries.parent_hash = roots.hash '
+                u'WHERE entries.hash = ?', (pathspec_hash,)).fetchone()
+        return row[0] if row else None
+
+    def get_statistics(self):
+        """Returns a dictionary with the number of indexed roots, entries, and queued roots"""
+        with self._lock:
+            roots, entries = self._connection.execute(
+                u'SELECT COUNT(*), COALESCE(SUM(entries), 0) FROM roots WHERE complete').fetchone()
+            return {'roots': roots, 'entries': entries, 'pending': len(self._pending)}
+
+    def close(self):
+        """Stops indexing and closes the database"""
+        self.stop = True
+        self._queue.put(None)
+        if self.is_alive():
+            self.join(5)
+        with self._lock:
+            self._connection.close()
+
+    def run(self):
+        """Indexes queued roots until stopped"""
+        while not self.stop:
+            encoded_pathspec = self._queue.get()
+            if encoded_pathspec is None or self.stop:
+                break
+            root_hash = PathspecKey(encoded_pathspec).hash
+            # Each root is indexed by one server process at a time
+            root_lock = self._get_root_lock(root_hash)
+            if not root_lock.acquire(False):
+                logging.debug(u'Another process is indexing ' + encoded_pathspec)
+                with self._lock:
+                    self._pending.discard(root_hash)
+                continue
+            try:
+                with self._lock:
+                    row = self._connection.execute(u'SELECT complete FROM roots WHERE hash = ?',
+                                                   (root_hash,)).fetchone()
+                if not (row and row[0]):
+                    # Removes the entries of a process that stopped before it finished the root
+                    self._remove_root(root_hash)
+                    self._index_root(encoded_pathspec, root_hash)
+            except Exception:
+                logging.exception(u'Failed to index ' + encoded_pathspec)
+                self._remove_root(root_hash)
+            finally:
+                root_lock.release()
+                with self._lock:
+                    self._pending.discard(root_hash)
+
+    def _index_root(self, encoded_pathspec, root_hash):
+        """Walks the file system below the root depth first, storing the metadata of each entry"""
+        start = time.time()
+        with self._lock:
+            self._connection.execute(u'INSERT OR REPLACE INTO roots VALUES (?, ?, 0, 0, ?, NULL)',
+                                     (root_hash, encoded_pathspec, start))
+            self._connection.commit()
+
+        count = 0
+        batch = []
+        file_entry = self._open_function(encoded_pathspec)
+        try:
+            # Stack of (parent hash, sub file entry iterator, next position)
+            stack = [[root_hash, iter(file_entry.sub_file_entries), 0]]
+            while stack and not self.stop:
+                parent = stack[-1]
+                sub_file_entry = next(parent[1], None)
+                if sub_file_entry is None:
+                    stack.pop()
+                    continue
+
+                pathspec = sub_file_entry.path_spec
+                key = PathspecKey(JsonPathSpecSerializer.WriteSerialized(pathspec), pathspec)
+                metadata = self._stat_function(sub_file_entry, key)
+                location = getattr(pathspec, 'location', '') or ''
+                metadata['path'] = location
+                metadata['file_name'] = os.path.basename(location.rstrip('/\\'))
+                batch.append([key.hash, root_hash, parent[0], parent[2], key.encoded_pathspec] +
+                             [metadata.get(column) for column in self._columns])
+                parent[2] += 1
+                count += 1
+
+                if len(batch) >= self._batch_size:
+                    self._insert(batch)
+                    batch = []
+
+                if sub_file_entry.IsDirectory():
+                    stack.append([key.hash, iter(sub_file_entry.sub_file_entries), 0])
+        finally:
+            self._close_function(encoded_pathspec)
+
+        if self.stop:
+            return
+
+        self._insert(batch)
+        with self._lock:
+            self._connection.execute(u'UPDATE roots SET complete = 1, entries = ?, completed = ? WHERE hash = ?',
+                                     (count, time.time(), root_hash))
+            self._connection.commit()
+        logging.info(u'Indexed %d entries in %.1f seconds', count, time.time() - start)
+
+    def _get_root_lock(self, root_hash):
+        """Returns the FileLock held while the root is indexed"""
+        return FileLock.for_cache(self.cache_directory, u'index_' + root_hash, temporary=True)
+
+    def _insert(self, batch):
+        """Inserts a batch of entry rows"""
+        if not batch:
+            return
+        with self._lock:
+            self._connection.executemany(u'INSERT OR REPLACE INTO entries VALUES (' +
+                                         u', '.join([u'?'] * (len(self._columns) + 5)) + u')', batch)
+            self._connection.commit()
+
+    def _remove_root(self, root_hash):
+        """Removes a partially indexed root so it is indexed again the next time it is opened"""
+        with self._lock:
+            self._connection.execute(u'DELETE FROM entries WHERE root_hash = ?', (root_hash,))
+            self._connection.execute(u'DELETE FROM roots WHERE hash = ?', (root_hash,))
+            self._connection.commit()
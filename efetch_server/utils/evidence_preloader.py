@@ -0,0 +1,81 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import threading
+import time
+from dfvfs.lib import definitions as dfvfs_definitions
+from dfvfs.path import factory as path_spec_factory
+from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
+
+
+class EvidencePreloader(threading.Thread):
+    """This thread opens evidence files at startup, while the server is accepting requests, so the first request for
+    them does not pay for opening the image, scanning its volumes, and listing its file system roots"""
+    # Number of root entries listed per file system
+    _page_size = 1000
+
+    def __init__(self, efetch_helper, paths):
+        """Creates the preloader, preloading starts when the thread is started
+
+        Args:
+            efetch_helper: The Efetch Helper used to open, scan, and list the evidence
+            paths: The list of paths to evidence files or directories on the local file system
+        """
+        super(EvidencePreloader, self).__init__(name='_preloader')
+        self.daemon = True
+        self.stop = False
+        self._helper = efetch_helper
+        self._paths = list(paths or [])
+
+    def run(self):
+        """Preloads each evidence path in order"""
+        for path in self._paths:
+            if self.stop:
+                break
+            path = os.path.abspath(os.path.expanduser(path))
+            if not os.path.exists(path):
+                logging.warn(u'Cannot preload missing evidence ' + path)
+                continue
+            start = time.time()
+            try:
+                count = self._preload(path)
+            except Exception:
+                logging.exception(u'Failed to preload ' + path)
+                continue
+            logging.info(u'Preloaded %s with %d file systems in %.1f seconds', path, count, time.time() - start)
+
+    def _preload(self, path):
+        """Opens and scans the evidence and lists the root of each of its file systems, returns the number listed"""
+        pathspec_helper = self._helper.pathspec_helper
+        pathspec = path_spec_factory.Factory.NewPathSpec(dfvfs_definitions.TYPE_INDICATOR_OS, location=path)
+        evidence = pathspec_helper.get_evidence_item(JsonPathSpecSerializer.WriteSerialized(pathspec))
+
+        if self._helper.is_expandable_evidence(evidence):
+            base_pathspecs = [item['pathspec'] for item in pathspec_helper.list_base_pathspecs(evidence)]
+        elif evidence['meta_type'] == 'Directory':
+            base_pathspecs = [evidence['pathspec']]
+        else:
+            return 0
+
+        for base_pathspec in base_pathspecs:
+            if self.stop:
+                break
+            pathspec_helper.get_evidence_item(base_pathspec)
+            pathspec_helper.index_base_pathspecs([{'pathspec': base_pathspec}])
+            pathspec_helper.list_directory_page(base_pathspec, 0, self._page_size, analyze=False)
+
+        return len(base_pathspecs)
@@ -0,0 +1,144 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import fcntl
+import os
+import time
+
+
+# The files of the locks held by this process, a forked process shares them until it closes them
+_held_files = set()
+
+
+class FileLock(object):
+    """This class is an exclusive lock shared by every thread and process that opens the same lock file, it is held
+    with flock so it is released if the holding process dies. An instance is held by one thread at a time."""
+    # Directory of the lock files in the cache directory
+    cache_subdirectory = u'locks'
+    # Seconds between attempts to acquire the lock before a timeout
+    _retry_interval = 0.05
+
+    def __init__(self, path, temporary=False):
+        """Creates the lock, the lock file and its directory are created when it is first acquired
+
+        Args:
+            path: The path of the lock file
+            temporary: True to remove the lock file when the lock is released, for locks of jobs and files that are
+                rarely locked again, so the lock directory does not grow with every item ever locked
+        """
+        self.path = path
+        self.temporary = temporary
+        self._file = None
+
+    @staticmethod
+    def for_cache(cache_directory, name, temporary=False):
+        """Returns the lock with the name in the lock directory of the cache directory"""
+        return FileLock(os.path.join(cache_directory, FileLock.cache_subdirectory, name + u'.lock'), temporary)
+
+    @staticmethod
+    def close_inherited():
+        """Closes the files of the locks held when this process was forked, called first by forked worker processes
+
+        A forked process shares the flock of its parent until it closes the file, so a pool worker forked while a
+        lock was held would otherwise hold the lock until it exits.
+        """
+        for lock_file in list(_held_files):
+            lock_file.close()
+        _held_files.clear()
+
+    def acquire(self, blocking=True, timeout=None):
+        """Acquires the lock, returns False if another thread or process holds it and blocking is False or it is
+        still held after the timeout in seconds"""
+        lock_file = self._open()
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            try:
+                if blocking and deadline is None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                if blocking and deadline is None:
+                    lock_file.close()
+                    raise
+                if not blocking or time.time() >= deadline:
+                    lock_file.close()
+                    return False
+                time.sleep(self._retry_interval)
+                continue
+            if self._is_current(lock_file):
+                break
+            # The holder removed the lock file while this waited for it, the lock is now a new file
+            lock_file.close()
+            lock_file = self._open()
+        self._file = lock_file
+        _held_files.add(lock_file)
+        return True
+
+    def is_locked(self):
+        """Returns True if any thread or process holds the lock, including another instance in this process"""
+        try:
+            lock_file = open(self.path, 'r')
+        except IOError:
+            # The lock file is created when the lock is acquired, and temporary lock files are removed on release
+            return False
+        try:
+            # A shared lock does not block other checks, only the exclusive lock of a holder
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except IOError:
+            return True
+        finally:
+            lock_file.close()
+
+    def release(self):
+        """Releases the lock, removing the lock file first if the lock is temporary"""
+        lock_file = self._file
+        self._file = None
+        if lock_file:
+            if self.temporary:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            _held_files.discard(lock_file)
+            lock_file.close()
+
+    def _is_current(self, lock_file):
+        """Returns True if the open lock file is still the file at the path of the lock"""
+        try:
+            path_stat = os.stat(self.path)
+        except OSError:
+            return False
+        file_stat = os.fstat(lock_file.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+    def _open(self):
+        """Opens the lock file, creating it and its directory if they do not exist"""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process created the directory first
+                pass
+        return open(self.path, 'a')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
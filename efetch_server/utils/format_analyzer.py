@@ -0,0 +1,164 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import logging
+import pysigscan
+import threading
+from dfvfs.analyzer import specification
+from dfvfs.analyzer.analyzer import Analyzer
+from dfvfs.lib import definitions
+
+
+class FormatAnalyzer(object):
+    """This class detects the volume system, storage media image, compressed stream, and archive formats of a
+    file with a single signature scan, instead of the four separate scans done by the dfvfs Analyzer"""
+    # Evidence item key for each dfvfs format category
+    _category_keys = collections.OrderedDict([
+        (definitions.FORMAT_CATEGORY_VOLUME_SYSTEM, 'volume_type'),
+        (definitions.FORMAT_CATEGORY_STORAGE_MEDIA_IMAGE, 'storage_type'),
+        (definitions.FORMAT_CATEGORY_COMPRESSED_STREAM, 'compression_type'),
+        (definitions.FORMAT_CATEGORY_ARCHIVE, 'archive_type')])
+
+    _scanner_lock = threading.Lock()
+    _signature_scanner = None
+    _specification_store = None
+    # Type indicator to evidence item keys, and (analyzer helper, evidence item keys) for formats without signatures
+    _type_indicator_keys = {}
+    _remainder_list = []
+
+    def __init__(self, max_results=16384, metadata_store=None):
+        """Creates an analyzer that remembers the formats of the last max_results pathspecs
+
+        Args:
+            max_results: The max number of results kept in memory
+            metadata_store: The MetadataStore used to persist results, None to only keep them in memory
+        """
+        self._max_results = max_results
+        self._metadata_store = metadata_store
+        self._results_lock = threading.Lock()
+        self._results = collections.OrderedDict()
+
+    def get_cached_format_types(self, pathspec_hash):
+        """Returns the previously detected formats of the pathspec hash or None if it was not analyzed"""
+        with self._results_lock:
+            format_types = self._results.pop(pathspec_hash, None)
+            if format_types is not None:
+                self._results[pathspec_hash] = format_types
+                return format_types
+
+        if self._metadata_store:
+            format_types = self._metadata_store.get_format_types(pathspec_hash)
+            if format_types is not None:
+                self._remember(pathspec_hash, format_types)
+        return format_types
+
+    def set_cached_format_types(self, pathspec_hash, format_types):
+        """Remembers the detected formats of the pathspec hash"""
+        self._remember(pathspec_hash, format_types)
+        if self._metadata_store:
+            self._metadata_store.set_format_types(pathspec_hash, format_types)
+
+    def _remember(self, pathspec_hash, format_types):
+        """Adds the formats of the pathspec hash to the in memory results"""
+        with self._results_lock:
+            self._results[pathspec_hash] = format_types
+            while len(self._results) > self._max_results:
+                self._results.popitem(last=False)
+
+    def get_format_types(self, pathspec_hash, file_object):
+        """Returns a dictionary of evidence item keys, i.e. archive_type, to lists of type indicators
+
+        Args:
+            pathspec_hash: The hash of the pathspec used to cache the results
+            file_object: The open file object of the pathspec, the caller must serialize access to it
+        """
+        format_types = self.get_cached_format_types(pathspec_hash)
+        if format_types is not None:
+            return format_types
+
+        try:
+            format_types = self._scan(file_object)
+        except AttributeError:
+            # The dfvfs version does not have the Analyzer internals used to build the combined scanner
+            logging.debug('Combined signature scan unavailable, falling back to the dfvfs Analyzer')
+            format_types = None
+
+        if format_types is not None:
+            self.set_cached_format_types(pathspec_hash, format_types)
+        return format_types
+
+    @staticmethod
+    def get_format_types_from_analyzer(path_spec):
+        """Returns the formats of the path spec using the four separate dfvfs Analyzer scans"""
+        analyze = Analyzer()
+        format_types = {}
+        for key, type_indicators in [
+                ('volume_type', analyze.GetVolumeSystemTypeIndicators(path_spec)),
+                ('storage_type', analyze.GetStorageMediaImageTypeIndicators(path_spec)),
+                ('compression_type', analyze.GetCompressedStreamTypeIndicators(path_spec)),
+                ('archive_type', analyze.GetArchiveTypeIndicators(path_spec))]:
+            if type_indicators:
+                format_types[key] = type_indicators
+        return format_types
+
+    @classmethod
+    def _scan(cls, file_object):
+        """Scans the file object once for the signatures of every format category"""
+        signature_scanner = cls._get_signature_scanner()
+        format_types = {}
+
+        scan_state = pysigscan.scan_state()
+        signature_scanner.scan_file_object(scan_state, file_object)
+        for scan_result in iter(scan_state.scan_results):
+            format_specification = cls._specification_store.GetSpecificationBySignature(scan_result.identifier)
+            for key in cls._type_indicator_keys[format_specification.identifier]:
+                type_indicators = format_types.setdefault(key, [])
+                if format_specification.identifier not in type_indicators:
+                    type_indicators.append(format_specification.identifier)
+
+        for analyzer_helper, keys in cls._remainder_list:
+            type_indicator = analyzer_helper.AnalyzeFileObject(file_object)
+            if type_indicator is not None:
+                for key in keys:
+                    format_types.setdefault(key, []).append(type_indicator)
+
+        return format_types
+
+    @classmethod
+    def _get_signature_scanner(cls):
+        """Returns the signature scanner for all format categories, creating it on first use"""
+        with cls._scanner_lock:
+            if cls._signature_scanner:
+                return cls._signature_scanner
+
+            specification_store = specification.FormatSpecificationStore()
+            type_indicator_keys = {}
+            remainder_keys = collections.OrderedDict()
+
+            for category, key in cls._category_keys.iteritems():
+                category_store, category_remainder_list = Analyzer._GetSpecificationStore(category)
+                for format_specification in category_store.specifications:
+                    if format_specification.identifier not in type_indicator_keys:
+                        specification_store.AddSpecification(format_specification)
+                    type_indicator_keys.setdefault(format_specification.identifier, []).append(key)
+                for analyzer_helper in category_remainder_list:
+                    remainder_keys.setdefault(analyzer_helper, []).append(key)
+
+            cls._specification_store = specification_store
+            cls._type_indicator_keys = type_indicator_keys
+            cls._remainder_list = remainder_keys.items()
+            cls._signature_scanner = Analyzer._GetSignatureScanner(specification_store)
+            return cls._signature_scanner
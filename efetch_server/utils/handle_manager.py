@@ -0,0 +1,131 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import logging
+import threading
+import time
+
+
+class HandleManager(object):
+    """This class keeps a bounded number of reference counted open handles, closing the least recently used
+    idle handle when a new handle is needed"""
+
+    def __init__(self, open_function, close_function=None, max_count=256, wait_timeout=60, name='handle'):
+        """Creates an empty handle manager
+
+        Args:
+            open_function: The function that takes a key and returns a newly opened handle
+            close_function: The function that takes a handle and closes it, None if handles need no closing
+            max_count: The max number of open handles
+            wait_timeout: The max seconds to wait for a free handle before raising a RuntimeError
+            name: The name of the handle type used in log messages
+        """
+        self.max_count = max_count
+        self.wait_timeout = wait_timeout
+        self.name = name
+        self._open_function = open_function
+        self._close_function = close_function
+        self._condition = threading.Condition(threading.Lock())
+        # Key to handle, ordered from least to most recently used
+        self._handles = collections.OrderedDict()
+        self._counts = {}
+        # Keys currently being opened, they count towards max_count
+        self._opening = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, key):
+        """Returns the open handle for the key, opening it and waiting for a free slot if needed"""
+        deadline = time.time() + self.wait_timeout
+
+        with self._condition:
+            while True:
+                if key in self._handles:
+                    self.hits += 1
+                    self._counts[key] += 1
+                    self._handles[key] = self._handles.pop(key)
+                    return self._handles[key]
+
+                if key not in self._opening and \
+                        (len(self._handles) + len(self._opening) < self.max_count or self._evict_one()):
+                    self.misses += 1
+                    self._opening.add(key)
+                    break
+
+                # Either another thread is opening this key or every handle is in use
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.error('Timed out waiting for a free ' + self.name)
+                    raise RuntimeError('Timed out waiting for a free ' + self.name)
+                self._condition.wait(remaining)
+
+        # Opening can be slow so it is done without holding the lock
+        try:
+            handle = self._open_function(key)
+        except:
+            with self._condition:
+                self._opening.discard(key)
+                self._condition.notify_all()
+            raise
+
+        with self._condition:
+            self._opening.discard(key)
+            self._handles[key] = handle
+            self._counts[key] = 1
+            self._condition.notify_all()
+
+        return handle
+
+    def release(self, key):
+        """Releases one reference to the handle, the handle stays open until it is evicted"""
+        with self._condition:
+            if self._counts.get(key, 0) < 1:
+                raise KeyError(key)
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                self._condition.notify_all()
+
+    def evict_idle(self):
+        """Closes every handle that is not in use"""
+        with self._condition:
+            while self._evict_one():
+                pass
+
+    def get_statistics(self):
+        """Returns a dictionary with the handle counts, hits, misses, and evictions"""
+        with self._condition:
+            return {'open': len(self._handles),
+                    'in_use': len([count for count in self._counts.itervalues() if count]),
+                    'max_count': self.max_count,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _evict_one(self):
+        """Closes the least recently used idle handle, returns False if every handle is in use"""
+        for key in self._handles:
+            if not self._counts[key]:
+                handle = self._handles.pop(key)
+                del self._counts[key]
+                self.evictions += 1
+                if self._close_function:
+                    try:
+                        self._close_function(handle)
+                    except Exception:
+                        logging.warn('Failed to close evicted ' + self.name)
+                return True
+        return False
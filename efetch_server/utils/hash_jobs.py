@@ -0,0 +1,445 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from dfvfs.resolver import context
+from dfvfs.resolver import resolver
+from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
+from efetch_server.utils.file_lock import FileLock
+
+
+# The dfvfs resolver context of a worker process, so each worker opens and caches its own image handles
+_resolver_context = None
+
+
+def _init_worker():
+    """Creates the dfvfs resolver context of the worker process"""
+    global _resolver_context
+    FileLock.close_inherited()
+    _resolver_context = context.Context()
+
+
+def _hash_file(encoded_pathspec, hash_types, chunk_size):
+    """Hashes the file with every hash type in one pass, runs in a worker process
+
+    Args:
+        encoded_pathspec: The pathspec of the file, opened with the dfvfs resolver context of the worker
+        hash_types: The list of hashlib algorithm names
+        chunk_size: The number of bytes read at a time
+
+    Returns:
+        A tuple of the pathspec, the number of bytes read, the dictionary of hash type to hex digest or None, and
+        the error message or None
+    """
+    hashers = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types]
+    size = 0
+    file_object = None
+    try:
+        pathspec = JsonPathSpecSerializer.ReadSerialized(encoded_pathspec)
+        file_object = resolver.Resolver.OpenFileObject(pathspec, resolver_context=_resolver_context)
+        data = file_object.read(chunk_size)
+        while data:
+            size += len(data)
+            for hash_type, hasher in hashers:
+                hasher.update(data)
+            data = file_object.read(chunk_size)
+    except Exception, error:
+        return encoded_pathspec, size, None, str(error) or error.__class__.__name__
+    finally:
+        if file_object:
+            file_object.close()
+
+    return encoded_pathspec, size, dict([(hash_type, hasher.hexdigest()) for hash_type, hasher in hashers]), None
+
+
+class HashJobs(object):
+    """This class hashes every file below evidence pathspecs in a pool of worker processes, storing the digests in a
+    SQLite database in the cache directory so interrupted jobs resume without hashing finished files again"""
+    _database_file_name = u'hash_jobs.sqlite'
+    # Number of files checked against the finished files and written per transaction
+    _batch_size = 500
+    _hash_chunk_size = 1048576
+    _default_hash_types = ['md5', 'sha256']
+    # Seconds to wait for the lock of a job, it is only held briefly by status checks of other processes
+    _job_lock_timeout = 1
+    # Seconds before a file is recorded as an error when its worker died or hung, plus one second per
+    # _minimum_hash_rate bytes of the file
+    _file_timeout = 300
+    _minimum_hash_rate = 1048576
+
+    def __init__(self, cache_directory, pathspec_helper, db_util=None, processes=2, known_hashes=None):
+        """Opens or creates the results database, the worker processes are started with the first job
+
+        Args:
+            cache_directory: The directory containing the database
+            pathspec_helper: The PathspecHelper used to walk the evidence
+            db_util: The DBUtil used to write results to Elasticsearch
+            processes: The number of worker processes
+            known_hashes: The KnownHashes used to flag known good and known bad files in the results
+        """
+        self.database_path = os.path.join(cache_directory, self._database_file_name)
+        self.cache_directory = cache_directory
+        self.processes = max(1, processes)
+        self._pathspec_helper = pathspec_helper
+        self._db_util = db_util
+        self._known_hashes = known_hashes
+        self._lock = threading.Lock()
+        # Job ID to the state of its run in this process
+        self._running = {}
+        # The pool belongs to the process that started it
+        self._pid = None
+        self._pool = None
+
+        self._connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        self._connection.execute(u'PRAGMA synchronous = OFF')
+        self._connection.execute(u'PRAGMA journal_mode = WAL')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS jobs '
+                                 u'(id INTEGER PRIMARY KEY AUTOINCREMENT, pathspec TEXT, roots TEXT, hash_types TEXT, '
+                                 u'output_index TEXT, complete INTEGER, files INTEGER, bytes INTEGER, errors INTEGER, '
+                                 u'elapsed REAL, started REAL, completed REAL)')
+        self._connection.execute(u'CREATE TABLE IF NOT EXISTS results '
+                                 u'(job_id INTEGER, hash TEXT, pathspec TEXT, path TEXT, size INTEGER, digests TEXT, '
+                                 u'error TEXT, PRIMARY KEY (job_id, hash))')
+        self._connection.commit()
+
+    def start_job(self, encoded_pathspec, roots, hash_types=None, output_index=None):
+        """Starts hashing the files below the roots and returns the job ID
+
+        A job with the same pathspec and hash types is resumed instead of starting a new one, or returned if it is
+        complete.
+
+        Args:
+            encoded_pathspec: The pathspec of the evidence the job is for
+            roots: The list of encoded file system pathspecs to walk
+            hash_types: The list of hashlib algorithm names, md5 and sha256 if empty
+            output_index: The Elasticsearch index to also write the results to, None for only the local database
+        """
+        hash_types = sorted(hash_types or self._default_hash_types)
+        with self._lock:
+            row = self._connection.execute(u'SELECT id, complete FROM jobs WHERE pathspec = ? AND hash_types = ?',
+                                           (encoded_pathspec, u','.join(hash_types))).fetchone()
+            if row and row[1]:
+                return row[0]
+            elif row:
+                job_id = row[0]
+            else:
+                job_id = self._connection.execute(
+                    u'INSERT INTO jobs (pathspec, roots, hash_types, output_index, complete, files, bytes, errors, '
+                    u'elapsed, started) VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, ?)',
+                    (encoded_pathspec, json.dumps(roots), u','.join(hash_types), output_index, time.time())).lastrowid
+                self._connection.commit()
+        self._run_job(job_id)
+        return job_id
+
+    def resume(self):
+        """Resumes the jobs that were not complete when the server stopped"""
+        with self._lock:
+            job_ids = [row[0] for row in self._connection.execute(u'SELECT id FROM jobs WHERE NOT complete')]
+        for job_id in job_ids:
+            logging.info(u'Resuming hash job %d', job_id)
+            self._run_job(job_id)
+
+    def stop_job(self, job_id):
+        """Stops the job after the files being hashed are finished, it can be resumed by starting it again
+
+        A job run by another server process sharing the cache directory is asked to stop with a stop file.
+        """
+        with self._lock:
+            state = self._running.get(job_id)
+            if state:
+                state['stop'] = True
+                return
+        if job_id is not None and self._get_job_lock(job_id).is_locked():
+            open(self._get_stop_path(job_id), 'w').close()
+
+    def get_status(self, job_id):
+        """Returns a dictionary with the progress and throughput of the job, or None if there is no such job"""
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT id, pathspec, hash_types, output_index, complete, files, bytes, errors, elapsed, started, '
+                u'completed FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not row:
+                return None
+            status = dict(zip(['id', 'pathspec', 'hash_types', 'output_index', 'complete', 'files', 'bytes',
+                               'errors', 'elapsed', 'started', 'completed'], row))
+            state = self._running.get(job_id)
+            status['running'] = bool(state) or self._get_job_lock(job_id).is_locked()
+            if state:
+                status['elapsed'] += time.time() - state['started']
+
+        status['complete'] = bool(status['complete'])
+        status['hash_types'] = status['hash_types'].split(',')
+        elapsed = status['elapsed'] or 0.0
+        status['files_per_second'] = status['files'] / elapsed if elapsed else 0.0
+        status['mb_per_second'] = status['bytes'] / 1000000.0 / elapsed if elapsed else 0.0
+        return status
+
+    def get_jobs(self, encoded_pathspec=None):
+        """Returns the status of every job, or of the jobs of the pathspec"""
+        with self._lock:
+            if encoded_pathspec:
+                rows = self._connection.execute(u'SELECT id FROM jobs WHERE pathspec = ? ORDER BY id',
+                                                (encoded_pathspec,)).fetchall()
+            else:
+                rows = self._connection.execute(u'SELECT id FROM jobs ORDER BY id').fetchall()
+        return [self.get_status(row[0]) for row in rows]
+
+    def get_results(self, job_id, cursor=0, count=1000):
+        """Returns one page of the hashed files of the job
+
+        Args:
+            job_id: The ID of the job
+            cursor: The number of results to skip
+            count: The max number of results to return
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                u'SELECT pathspec, path, size, digests, error FROM results WHERE job_id = ? '
+                u'ORDER BY rowid LIMIT ? OFFSET ?', (job_id, count, cursor)).fetchall()
+        results = []
+        for pathspec, path, size, digests, error in rows:
+            result = {'pathspec': pathspec, 'path': path, 'size': size}
+            if digests:
+                digests = json.loads(digests)
+                result.update(digests)
+                if self._known_hashes:
+                    result['known'] = self._known_hashes.lookup(digests)
+            if error:
+                result['error'] = error
+            results.append(result)
+        return results
+
+    def get_digests(self, pathspec_hashes):
+        """Returns a dictionary of pathspec hash to the dictionary of hash type to hex digest of every hashed file
+        in the list, from the results of all jobs"""
+        digests = {}
+        pathspec_hashes = list(pathspec_hashes)
+        for start in xrange(0, len(pathspec_hashes), self._batch_size):
+            batch = pathspec_hashes[start:start + self._batch_size]
+            with self._lock:
+                rows = self._connection.execute(
+                    u'SELECT hash, digests FROM results WHERE digests IS NOT NULL AND hash IN (' +
+                    u', '.join([u'?'] * len(batch)) + u')', batch).fetchall()
+            for pathspec_hash, file_digests in rows:
+                digests.setdefault(pathspec_hash, {}).update(json.loads(file_digests))
+        return digests
+
+    def get_statistics(self):
+        """Returns a dictionary with the number of jobs running in this process and the number of processes"""
+        with self._lock:
+            return {'running': len(self._running), 'processes': self.processes}
+
+    def close(self):
+        """Stops the running jobs and the worker processes, and closes the database"""
+        with self._lock:
+            for state in self._running.values():
+                state['stop'] = True
+            if self._pool and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._connection.close()
+
+    def _run_job(self, job_id):
+        """Starts the thread of the job unless it is already running in this or another server process"""
+        with self._lock:
+            self._start()
+            if job_id in self._running:
+                return
+
+        # The job lock is held while the job runs, so a job is never run twice at the same time
+        job_lock = self._get_job_lock(job_id)
+        if not job_lock.acquire(timeout=self._job_lock_timeout):
+            logging.info(u'Hash job %d is running in another process', job_id)
+            return
+        stop_path = self._get_stop_path(job_id)
+        if os.path.isfile(stop_path):
+            os.remove(stop_path)
+
+        with self._lock:
+            row = self._connection.execute(u'SELECT complete FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not row or row[0]:
+                job_lock.release()
+                return
+            state = {'stop': False,
+                     'started': time.time(),
+                     'tasks': [],
+                     'results': [],
+                     'lock': job_lock,
+                     'stop_path': stop_path}
+            self._running[job_id] = state
+        thread = threading.Thread(target=self._run, args=(job_id, state), name='_hash_job_%d' % job_id)
+        thread.daemon = True
+        thread.start()
+
+    def _start(self):
+        """Starts the worker pool in this process, the lock must be held"""
+        if self._pid == os.getpid():
+            return
+        # Jobs run by a parent process are run again when resumed or started
+        self._pid = os.getpid()
+        self._running = {}
+        self._pool = multiprocessing.Pool(self.processes, _init_worker)
+
+    def _run(self, job_id, state):
+        """Walks the roots of the job, hashing the files that are not hashed yet, and records the results"""
+        try:
+            with self._lock:
+                roots, hash_types, output_index = self._connection.execute(
+                    u'SELECT roots, hash_types, output_index FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                pool = self._pool
+            hash_types = hash_types.split(',')
+
+            for root in json.loads(roots):
+                files = (item for item in self._pathspec_helper.iter_directory(root, recursive=True, analyze=False)
+                         if item.get('meta_type') == 'File')
+                while not self._is_stopped(state):
+                    batch = list(itertools.islice(files, self._batch_size))
+                    if not batch:
+                        break
+                    for item in self._get_unhashed(job_id, batch):
+                        self._submit(pool, state, item, hash_types)
+                        if self._is_stopped(state):
+                            break
+                    self._write_results(job_id, state, output_index)
+                if state['stop']:
+                    break
+
+            # Waits for the last files of the job
+            while state['tasks'] and not self._is_stopped(state):
+                self._collect(state, 1)
+            self._write_results(job_id, state, output_index, not state['stop'])
+        except Exception:
+            logging.exception(u'Hash job %d failed', job_id)
+            self._write_results(job_id, state, None)
+        finally:
+            with self._lock:
+                if self._running.get(job_id) is state:
+                    del self._running[job_id]
+            if os.path.isfile(state['stop_path']):
+                os.remove(state['stop_path'])
+            state['lock'].release()
+
+    def _get_job_lock(self, job_id):
+        """Returns the FileLock held by the process running the job"""
+        return FileLock.for_cache(self.cache_directory, u'hash_job_%d' % job_id, temporary=True)
+
+    def _get_stop_path(self, job_id):
+        """Returns the path of the file that asks the process running the job to stop it"""
+        return os.path.join(self.cache_directory, FileLock.cache_subdirectory, u'hash_job_%d.stop' % job_id)
+
+    @staticmethod
+    def _is_stopped(state):
+        """Returns True if the job was stopped by this process or by another process with its stop file"""
+        if not state['stop'] and os.path.isfile(state['stop_path']):
+            state['stop'] = True
+        return state['stop']
+
+    def _get_unhashed(self, job_id, items):
+        """Returns the items that do not have a result in the job yet"""
+        for item in items:
+            item['hash'] = self._pathspec_helper.get_pathspec_key(item['pathspec']).hash
+        with self._lock:
+            hashed = set([row[0] for row in self._connection.execute(
+                u'SELECT hash FROM results WHERE job_id = ? AND hash IN (' + u', '.join([u'?'] * len(items)) + u')',
+                [job_id] + [item['hash'] for item in items])])
+        return [item for item in items if item['hash'] not in hashed]
+
+    def _submit(self, pool, state, item, hash_types):
+        """Submits the file to the worker pool, waiting while every worker has files queued"""
+        while len(state['tasks']) >= self.processes * 4 and not self._is_stopped(state):
+            self._collect(state, 1)
+        deadline = time.time() + self._file_timeout + (item.get('size') or 0) / self._minimum_hash_rate
+        state['tasks'].append((item, pool.apply_async(_hash_file, (item['pathspec'], hash_types,
+                                                                   self._hash_chunk_size)), deadline))
+
+    @staticmethod
+    def _collect(state, timeout=0):
+        """Moves the results of finished files to the results of the job, waiting up to the timeout in seconds for
+        the oldest file. Files past their deadline are recorded as errors, a pool replaces a worker that dies but
+        never finishes its file, so it would otherwise hold up the job forever."""
+        if timeout and state['tasks']:
+            state['tasks'][0][1].wait(timeout)
+        now = time.time()
+        tasks = []
+        for item, async_result, deadline in state['tasks']:
+            if async_result.ready():
+                try:
+                    result = async_result.get()
+                except Exception, error:
+                    result = (item['pathspec'], 0, None, str(error) or error.__class__.__name__)
+                state['results'].append((item, result))
+            elif now >= deadline:
+                logging.warn(u'Hashing timed out for %s', item['pathspec'])
+                state['results'].append((item, (item['pathspec'], 0, None, u'Hashing timed out')))
+            else:
+                tasks.append((item, async_result, deadline))
+        state['tasks'] = tasks
+
+    def _write_results(self, job_id, state, output_index, complete=False):
+        """Writes the finished results of the job to the database and Elasticsearch and updates its progress"""
+        self._collect(state)
+        finished = state['results']
+        state['results'] = []
+
+        now = time.time()
+        rows = []
+        documents = []
+        size = 0
+        errors = 0
+        for item, (pathspec, file_size, digests, error) in finished:
+            size += file_size
+            if error:
+                errors += 1
+            rows.append((job_id, item['hash'], pathspec, item.get('path', ''), file_size,
+                         json.dumps(digests) if digests else None, error))
+            if output_index and digests:
+                source = {'pathspec': pathspec, 'path': item.get('path', ''), 'size': file_size,
+                          'hash_time': datetime.datetime.now()}
+                for hash_type, digest in digests.iteritems():
+                    source[hash_type + '_digest'] = digest
+                if self._known_hashes:
+                    source['known'] = self._known_hashes.lookup(digests)
+                documents.append({'_index': output_index, '_type': 'efetch_hash', '_id': item['hash'],
+                                  '_source': source})
+
+        with self._lock:
+            self._connection.executemany(u'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._connection.execute(
+                u'UPDATE jobs SET files = files + ?, bytes = bytes + ?, errors = errors + ?, elapsed = elapsed + ? '
+                u'WHERE id = ?', (len(rows), size, errors, now - state['started'], job_id))
+            if complete:
+                self._connection.execute(u'UPDATE jobs SET complete = 1, completed = ? WHERE id = ?', (now, job_id))
+            self._connection.commit()
+        state['started'] = now
+
+        if documents and self._db_util:
+            try:
+                self._db_util.bulk(documents)
+            except Exception:
+                logging.exception(u'Failed to write hash results of job %d to Elasticsearch', job_id)
+
+        if complete:
+            status = self.get_status(job_id)
+            logging.info(u'Hash job %d hashed %d files at %.1f files/s and %.1f MB/s', job_id, status['files'],
+                         status['files_per_second'], status['mb_per_second'])
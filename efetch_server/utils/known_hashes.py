@@ -0,0 +1,281 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import array
+import binascii
+import hashlib
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from efetch_server.utils.file_lock import FileLock
+
+
+class HashSet(object):
+    """This class looks up digests in a file of sorted fixed size binary digests, the file is memory mapped and
+    searched in place, using a table of the first index of each 2 byte prefix to narrow the search"""
+    _fanout_size = 65537
+
+    def __init__(self, path, digest_size):
+        """Maps the hash set file built by HashSet.build
+
+        Args:
+            path: The path of the sorted digest file, the prefix table is in the same path with .fanout appended
+            digest_size: The size in bytes of each digest
+        """
+        self.path = path
+        self.digest_size = digest_size
+        self._file = open(path, 'rb')
+        self._count = os.path.getsize(path) / digest_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._count else ''
+        self._fanout = array.array('I')
+        with open(path + '.fanout', 'rb') as fanout_file:
+            self._fanout.fromfile(fanout_file, self._fanout_size)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, hex_digest):
+        """Returns True if the hex digest is in the set"""
+        try:
+            digest = binascii.unhexlify(hex_digest)
+        except (TypeError, binascii.Error):
+            return False
+        if len(digest) != self.digest_size:
+            return False
+
+        prefix = (ord(digest[0]) << 8) | ord(digest[1])
+        low = self._fanout[prefix]
+        high = self._fanout[prefix + 1]
+        size = self.digest_size
+        while low < high:
+            middle = (low + high) // 2
+            value = self._map[middle * size:(middle + 1) * size]
+            if value < digest:
+                low = middle + 1
+            elif value > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self):
+        """Unmaps the hash set file"""
+        if self._count:
+            self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def build(digests, path, digest_size, run_size=1000000):
+        """Writes the unique binary digests sorted to the path, sorting runs of digests in memory and merging them
+
+        Args:
+            digests: An iterable of binary digests of the digest size
+            path: The path of the hash set file
+            digest_size: The size in bytes of each digest
+            run_size: The max number of digests sorted in memory at a time
+        """
+        run_directory = tempfile.mkdtemp(dir=os.path.dirname(path))
+        try:
+            runs = []
+            run = []
+            for digest in digests:
+                run.append(digest)
+                if len(run) >= run_size:
+                    runs.append(HashSet._write_run(run, run_directory, len(runs)))
+                    run = []
+            if run or not runs:
+                runs.append(HashSet._write_run(run, run_directory, len(runs)))
+            run = None
+
+            run_files = [open(run_path, 'rb') for run_path in runs]
+            fanout = array.array('I', [0] * HashSet._fanout_size)
+            count = 0
+            previous = None
+            try:
+                with open(path + '.part', 'wb') as output:
+                    readers = [iter(lambda run_file=run_file: run_file.read(digest_size), '') for run_file in run_files]
+                    for digest in heapq.merge(*readers):
+                        if digest == previous:
+                            continue
+                        previous = digest
+                        output.write(digest)
+                        fanout[((ord(digest[0]) << 8) | ord(digest[1])) + 1] += 1
+                        count += 1
+            finally:
+                for run_file in run_files:
+                    run_file.close()
+
+            # Converts the counts of each prefix to the index of the first digest with the prefix
+            for prefix in xrange(1, HashSet._fanout_size):
+                fanout[prefix] += fanout[prefix - 1]
+
+            os.rename(path + '.part', path)
+            with open(path + '.fanout.part', 'wb') as fanout_file:
+                fanout.tofile(fanout_file)
+            os.rename(path + '.fanout.part', path + '.fanout')
+            return count
+        finally:
+            shutil.rmtree(run_directory, ignore_errors=True)
+
+    @staticmethod
+    def _write_run(run, run_directory, number):
+        """Writes the sorted run to a file in the run directory and returns its path"""
+        run.sort()
+        run_path = os.path.join(run_directory, str(number))
+        with open(run_path, 'wb') as run_file:
+            run_file.write(''.join(run))
+        return run_path
+
+
+class KnownHashes(threading.Thread):
+    """This thread loads known good and known bad hash lists, such as the NSRL, building the hash set files of a list
+    in the cache directory the first time the list is loaded"""
+    _directory_name = u'hash_sets'
+    # Digest types by the number of hex characters
+    _digest_types = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+    # Number of lines read to detect the digest types of a list
+    _sample_lines = 1000
+    _hex_pattern = re.compile(r'(?<![0-9A-Fa-f])(?:[0-9A-Fa-f]{64}|[0-9A-Fa-f]{40}|[0-9A-Fa-f]{32})(?![0-9A-Fa-f])')
+
+    def __init__(self, cache_directory, known_good=None, known_bad=None):
+        """Creates the loader, the lists are loaded when the thread is started
+
+        Args:
+            cache_directory: The directory containing the hash set files
+            known_good: The list of paths to known good hash lists
+            known_bad: The list of paths to known bad hash lists
+        """
+        super(KnownHashes, self).__init__(name='_known_hashes')
+        self.daemon = True
+        self.directory = os.path.join(cache_directory, self._directory_name)
+        self.cache_directory = cache_directory
+        self._lists = [('bad', path) for path in known_bad or []] + [('good', path) for path in known_good or []]
+        self._lock = threading.Lock()
+        # Tuples of known category, digest type, and HashSet, known bad sets are checked first
+        self._sets = []
+
+    def lookup(self, digests):
+        """Returns 'bad' or 'good' if one of the digests is in a loaded known bad or known good list, or None
+
+        Args:
+            digests: A dictionary of digest type, i.e. md5, to hex digest
+        """
+        with self._lock:
+            sets = self._sets
+        for known, digest_type, hash_set in sets:
+            digest = digests.get(digest_type)
+            if digest and digest in hash_set:
+                return known
+        return None
+
+    def is_enabled(self):
+        """Returns True if any hash lists were configured"""
+        return bool(self._lists)
+
+    def get_statistics(self):
+        """Returns a dictionary with the number of loaded known good and known bad digests"""
+        statistics = {'good': 0, 'bad': 0, 'lists': len(self._lists)}
+        with self._lock:
+            for known, digest_type, hash_set in self._sets:
+                statistics[known] += len(hash_set)
+        return statistics
+
+    def close(self):
+        """Unmaps the hash sets"""
+        with self._lock:
+            sets = self._sets
+            self._sets = []
+        for known, digest_type, hash_set in sets:
+            hash_set.close()
+
+    def run(self):
+        """Loads each list, building its hash sets first if they do not exist or the list changed"""
+        if self._lists and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for known, path in self._lists:
+            try:
+                self._load(known, os.path.abspath(os.path.expanduser(path)))
+            except Exception:
+                logging.exception(u'Failed to load hash list ' + path)
+
+    def _load(self, known, path):
+        """Loads the hash sets of the list"""
+        stat = os.stat(path)
+        name = hashlib.sha1(u'%s:%d:%d' % (path, stat.st_size, stat.st_mtime)).hexdigest()
+        set_paths = dict([(digest_type, os.path.join(self.directory, name + u'.' + digest_type))
+                          for digest_type in self._digest_types.values()])
+        # The list is built once its marker file exists, even if it does not contain every digest type
+        marker_path = os.path.join(self.directory, name + u'.built')
+
+        if not os.path.isfile(marker_path):
+            # Server processes sharing the cache directory wait for the one building the list
+            with FileLock.for_cache(self.cache_directory, u'hash_set_' + name, temporary=True):
+                if not os.path.isfile(marker_path):
+                    start = time.time()
+                    logging.info(u'Building hash sets of ' + path)
+                    for digest_type, count in self._build(path, set_paths).iteritems():
+                        logging.info(u'Built %d %s digests of %s in %.1f seconds', count, digest_type, path,
+                                     time.time() - start)
+                    open(marker_path, 'w').close()
+
+        sets = []
+        for hex_size, digest_type in sorted(self._digest_types.items()):
+            if os.path.isfile(set_paths[digest_type] + '.fanout'):
+                hash_set = HashSet(set_paths[digest_type], hex_size / 2)
+                if len(hash_set):
+                    sets.append((known, digest_type, hash_set))
+                else:
+                    hash_set.close()
+
+        with self._lock:
+            # Copies the list so lookups iterate over a list that is not changed
+            self._sets = sorted(self._sets + sets, key=lambda hash_set: hash_set[0] != 'bad')
+        logging.info(u'Loaded known %s hash list %s', known, path)
+
+    def _build(self, path, set_paths):
+        """Builds the hash set of each digest type found in the list, returns the digest counts by type
+
+        Each line of the list may contain any number of hex digests, such as the SHA-1 and MD5 columns of NSRL
+        files or one digest per line. The digest types are detected from the first lines, then the list is read once
+        for each digest type it contains.
+        """
+        digest_types = set()
+        with open(path, 'rb') as list_file:
+            for line in itertools.islice(list_file, self._sample_lines):
+                for digest in self._hex_pattern.findall(line):
+                    digest_types.add(self._digest_types[len(digest)])
+
+        counts = {}
+        for hex_size, digest_type in self._digest_types.iteritems():
+            if digest_type in digest_types:
+                counts[digest_type] = HashSet.build(self._read_digests(path, hex_size), set_paths[digest_type],
+                                                    hex_size / 2)
+        return counts
+
+    def _read_digests(self, path, hex_size):
+        """Yields the binary digests of the hex size in the list"""
+        with open(path, 'rb') as list_file:
+            for line in list_file:
+                for digest in self._hex_pattern.findall(line):
+                    if len(digest) == hex_size:
+                        yield binascii.unhexlify(digest)
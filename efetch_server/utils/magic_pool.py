@@ -0,0 +1,89 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import magic
+import Queue
+import threading
+
+
+class MagicPool(object):
+    """This class keeps a pool of independent libmagic handles so mimetypes can be detected by several threads at
+    once, a libmagic handle is never used by two threads at the same time"""
+
+    def __init__(self, size=4):
+        """Creates an empty pool, handles are opened on first use
+
+        Args:
+            size: The max number of libmagic handles, which is the max number of concurrent mimetype detections
+        """
+        self.size = max(1, size)
+        self._lock = threading.Lock()
+        self._idle = Queue.LifoQueue()
+        self._count = 0
+        self._pymagic = None
+
+    def from_buffer(self, data):
+        """Returns the mimetype of the data"""
+        handle = self._acquire()
+        try:
+            if self._pymagic:
+                return handle.from_buffer(data)
+            else:
+                return handle.id_buffer(data)
+        finally:
+            self._idle.put(handle)
+
+    def from_file(self, path):
+        """Returns the mimetype of the file at the path"""
+        handle = self._acquire()
+        try:
+            if self._pymagic:
+                return handle.from_file(path)
+            else:
+                return handle.id_filename(path)
+        finally:
+            self._idle.put(handle)
+
+    def _acquire(self):
+        """Returns an idle libmagic handle, opening a new one if the pool is not full"""
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self._lock:
+            if self._count < self.size:
+                handle = self._open()
+                self._count += 1
+                return handle
+
+        return self._idle.get()
+
+    def _open(self):
+        """Opens a libmagic handle using python-magic, or filemagic which shares the magic module name"""
+        if self._pymagic is not False:
+            try:
+                handle = magic.Magic(mime=True)
+                self._pymagic = True
+                return handle
+            except Exception:
+                if self._pymagic:
+                    raise
+        handle = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
+        if self._pymagic is None:
+            logging.debug(u'Using filemagic for mimetype detection')
+        self._pymagic = False
+        return handle
@@ -0,0 +1,120 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class MetadataStore(object):
+    """This class persists the sniffed mimetypes, detected formats, and scanned base pathspecs of pathspecs in a SQLite
+    database in the cache directory, keyed by the pathspec hash, so they survive restarts and do not require the
+    cached file"""
+    _database_file_name = u'metadata.sqlite'
+
+    def __init__(self, cache_directory):
+        """Opens or creates the metadata database
+
+        Args:
+            cache_directory: The directory containing the database
+        """
+        self.database_path = os.path.join(cache_directory, self._database_file_name)
+        self._lock = threading.Lock()
+        self._connection = None
+
+        try:
+            self._connection = sqlite3.connect(self.database_path, check_same_thread=False)
+            # The store is a cache, losing the last writes on a crash is cheaper than syncing every write
+            self._connection.execute(u'PRAGMA synchronous = OFF')
+            self._connection.execute(u'PRAGMA journal_mode = WAL')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS mimetypes '
+                                     u'(hash TEXT PRIMARY KEY, mimetype TEXT)')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS format_types '
+                                     u'(hash TEXT PRIMARY KEY, format_types TEXT)')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS base_pathspecs '
+                                     u'(hash TEXT PRIMARY KEY, base_pathspecs TEXT)')
+            self._connection.commit()
+        except sqlite3.Error:
+            logging.warn(u'Failed to open metadata store ' + self.database_path + u', metadata will not persist')
+            self._connection = None
+
+    def get_mimetype(self, pathspec_hash):
+        """Returns the stored mimetype of the pathspec hash or None if it is unknown"""
+        row = self._select(u'SELECT mimetype FROM mimetypes WHERE hash = ?', pathspec_hash)
+        return row[0] if row else None
+
+    def set_mimetype(self, pathspec_hash, mimetype):
+        """Stores the mimetype of the pathspec hash"""
+        self._replace(u'INSERT OR REPLACE INTO mimetypes VALUES (?, ?)', pathspec_hash, mimetype)
+
+    def get_format_types(self, pathspec_hash):
+        """Returns the stored format types of the pathspec hash or None if it was not analyzed"""
+        row = self._select(u'SELECT format_types FROM format_types WHERE hash = ?', pathspec_hash)
+        if not row:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def set_format_types(self, pathspec_hash, format_types):
+        """Stores the format types of the pathspec hash"""
+        self._replace(u'INSERT OR REPLACE INTO format_types VALUES (?, ?)', pathspec_hash, json.dumps(format_types))
+
+    def get_base_pathspecs(self, pathspec_hash):
+        """Returns the stored base pathspec items of the pathspec hash or None if it was not scanned"""
+        row = self._select(u'SELECT base_pathspecs FROM base_pathspecs WHERE hash = ?', pathspec_hash)
+        if not row:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def set_base_pathspecs(self, pathspec_hash, base_pathspecs):
+        """Stores the base pathspec items of the pathspec hash"""
+        self._replace(u'INSERT OR REPLACE INTO base_pathspecs VALUES (?, ?)', pathspec_hash,
+                      json.dumps(base_pathspecs))
+
+    def close(self):
+        """Closes the database"""
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+    def _select(self, query, pathspec_hash):
+        """Returns the first row of the query or None"""
+        if not self._connection:
+            return None
+        with self._lock:
+            try:
+                return self._connection.execute(query, (pathspec_hash,)).fetchone()
+            except sqlite3.Error:
+                logging.warn(u'Failed to read from metadata store')
+                return None
+
+    def _replace(self, query, pathspec_hash, value):
+        """Runs the insert or replace query and commits it"""
+        if not self._connection:
+            return
+        with self._lock:
+            try:
+                self._connection.execute(query, (pathspec_hash, value))
+                self._connection.commit()
+            except sqlite3.Error:
+                logging.warn(u'Failed to write to metadata store')
@@ -13,16 +13,17 @@
 # limitations under the License.
 
 
+import collections
 import datetime
 import hashlib
+import itertools
 import logging
-import magic
 import os
 import json
 import re
+import string
 import threading
 import traceback
-import time
 from bottle import abort
 from dfvfs.lib import definitions
 from dfvfs.lib.errors import AccessError, CacheFullError
@@ -31,66 +32,113 @@ from dfvfs.resolver import resolver
 from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
 from dfvfs.lib import definitions as dfvfs_definitions
 from dfvfs.path import factory as path_spec_factory
-from dfvfs.analyzer.analyzer import Analyzer
-from PIL import Image
 from urllib import urlencode
+from efetch_server.utils.cache_manager import CacheManager
 from efetch_server.utils.dfvfs_util import DfvfsUtil
+from efetch_server.utils.evidence_index import EvidenceIndex
+from efetch_server.utils.format_analyzer import FormatAnalyzer
+from efetch_server.utils.handle_manager import HandleManager
+from efetch_server.utils.magic_pool import MagicPool
+from efetch_server.utils.metadata_store import MetadataStore
+from efetch_server.utils.pathspec_key import PathspecKey
+from efetch_server.utils.thumbnail_service import ThumbnailService
 
 class PathspecHelper(object):
     """This singleton class provides helper methods that generally all take a pathspec"""
-    # Objects for controlling caching (Only 1 file caches at a time)
+    # Objects for controlling caching (Only 1 copy per pathspec at a time, maps pathspec to a done Event)
     _cache_lock = threading.Lock()
-    _caching = []
-    # Objects for controlling evidence file reads (Only 1 file read at a time)
-    _file_read_lock = threading.Lock()
-    # Objects for controlling running magic on a file (Only 1 file at a time)
-    _magic = threading.Lock()
-    # Objects for controlling file entry objects
-    _open_file_entries_lock = threading.Lock()
-    _open_file_entries_locks = {}
-    _open_file_entries_count = {}
-    _open_file_entries = {}
-    # Objects for controlling opening and closing of file objects
-    _open_file_object_lock = threading.Lock()
-    _open_file_objects_count = {}
-    _open_file_objects = {}
+    _caching = {}
+    # Objects for controlling evidence file reads (Only 1 read per underlying image at a time)
+    _file_read_locks_lock = threading.Lock()
+    _file_read_locks = {}
+    # Objects for controlling file entry and file objects, idle handles are closed least recently used first
+    _open_file_entries = HandleManager(lambda encoded_pathspec: PathspecHelper._resolve_file_entry(encoded_pathspec),
+                                       name='file entry')
+    _open_file_objects = HandleManager(lambda encoded_pathspec: PathspecHelper._resolve_file_object(encoded_pathspec),
+                                       lambda file_object: file_object.close(), name='file object')
+    # Objects for memoizing decoded pathspecs, the least recently used keys are dropped first
+    _pathspec_keys_lock = threading.Lock()
+    _pathspec_keys = collections.OrderedDict()
+    _max_pathspec_keys = 16384
+    # Objects for resuming directory listings, maps a page of a listing to the suspended walk that yields that page
+    _suspended_listings_lock = threading.Lock()
+    _suspended_listings = collections.OrderedDict()
+    _max_suspended_listings = 32
+    # Objects for memoizing source scanner results, maps the pathspec hash to its list of base pathspec items
+    _base_pathspecs_lock = threading.Lock()
+    _base_pathspecs = {}
     # Misc
-    _max_file_count = 256
     _cache_chunk_size = 32768
     _thumbnail_size = 64
     _mimetype_chunk_size = 32768
+    _index_page_size = 1000
+    _strings_chunk_size = 1048576
+    _hash_chunk_size = 1048576
+    # Characters of a string, a string longer than the max carry over may be split at a chunk boundary
+    _strings_characters = r"A-Za-z0-9/\-:.,_$%'()[\]<> "
+    _strings_character_set = string.ascii_letters + string.digits + "/-:.,_$%'()[]<> "
+    _strings_max_carry_over = 1048576
 
     _automatically_traverse = ['VSHADOW', 'TSK_PARTITION', 'EWF']
 
     instance = None
 
     class __PathspecHelper(object):
-        def __init__(self, output_directory, max_file_size):
+        def __init__(self, output_directory, max_file_size, max_cache_size, magic_pool_size):
             self.output_directory = output_directory
             self.max_file_size = max_file_size
-            
-            # Determine which magic lib to use
-            try:
-                self._my_magic = magic.Magic(mime=True)
-                self._pymagic = True
-            except:
-                self._my_magic = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
-                self._pymagic = False
-        
-    def __init__(self, output_directory, max_file_size):
+            self.cache_manager = CacheManager(output_directory, max_cache_size)
+            self.metadata_store = MetadataStore(output_directory)
+            self.format_analyzer = FormatAnalyzer(metadata_store=self.metadata_store)
+            self.magic_pool = MagicPool(magic_pool_size)
+            self.evidence_index = None
+            self.thumbnail_service = None
+
+    def __init__(self, output_directory, max_file_size, max_cache_size=0, max_open_handles=256, magic_pool_size=4,
+                 index_evidence=False, thumbnail_processes=2):
         """Initializes the Efetch Helper"""
         if not PathspecHelper.instance:
-            PathspecHelper.instance = PathspecHelper.__PathspecHelper(output_directory, max_file_size)
+            PathspecHelper.instance = PathspecHelper.__PathspecHelper(output_directory, max_file_size,
+                                                                      max_cache_size, magic_pool_size)
+            PathspecHelper._open_file_entries.max_count = max_open_handles
+            PathspecHelper._open_file_objects.max_count = max_open_handles
+            self.instance.thumbnail_service = ThumbnailService(self, self.cache_manager, thumbnail_processes,
+                                                               PathspecHelper._thumbnail_size)
+            if index_evidence:
+                self.instance.evidence_index = EvidenceIndex(
+                    output_directory,
+                    lambda file_entry, key: self._get_stat_information_from_file_entry(file_entry, key, False),
+                    PathspecHelper._open_file_entry, PathspecHelper._close_file_entry)
+                self.instance.evidence_index.start()
         else:
             logging.warn('Cannot reinitialize Pathspec Helper')
 
     def __getattr__(self, name):
         return getattr(self.instance, name)
 
+    def get_statistics(self):
+        """Returns the hit, miss, and eviction counters of the handle managers and the file cache"""
+        statistics = {'file_entries': PathspecHelper._open_file_entries.get_statistics(),
+                      'file_objects': PathspecHelper._open_file_objects.get_statistics(),
+                      'cache': self.cache_manager.get_statistics(),
+                      'thumbnails': self.thumbnail_service.get_statistics()}
+        if self.evidence_index:
+            statistics['index'] = self.evidence_index.get_statistics()
+        return statistics
+
+    def index_base_pathspecs(self, base_pathspecs):
+        """Queues the file systems of the base pathspecs for background indexing, if indexing is enabled"""
+        if self.evidence_index:
+            for base_pathspec in base_pathspecs:
+                self.evidence_index.queue(base_pathspec['pathspec'])
+
     def get_cache_path(self, encoded_pathspec, parent_directory='files'):
         """Returns the full path to the cached evidence file"""
-        return self.get_cache_directory(encoded_pathspec, parent_directory) + \
-               unicode(PathspecHelper.get_file_name(encoded_pathspec))
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        if parent_directory not in key.cache_paths:
+            key.cache_paths[parent_directory] = self.get_cache_directory(key, parent_directory) + \
+                                                unicode(key.file_name)
+        return key.cache_paths[parent_directory]
 
     def is_file_cached(self, encoded_pathspec, parent_directory='files'):
         """Returns True if the evidence file is cached and false if it is not cached"""
@@ -98,8 +146,10 @@ class PathspecHelper(object):
 
     def get_cache_directory(self, encoded_pathspec, parent_directory='files'):
         """Returns the full path of the directory that should contain the cached evidence file"""
-        return self.output_directory + parent_directory + os.path.sep + \
-               PathspecHelper._get_pathspec_hash(encoded_pathspec) + os.path.sep
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        if parent_directory not in key.cache_directories:
+            key.cache_directories[parent_directory] = self.cache_manager.get_directory(parent_directory, key.hash)
+        return key.cache_directories[parent_directory]
 
     def cache_file(self, encoded_pathspec, file_entry=False):
         """Caches the file object associated with the specified pathspec"""
@@ -109,15 +159,21 @@ class PathspecHelper(object):
         """Creates a dictionary of information about the pathspec"""
         file_entry = PathspecHelper._open_file_entry(encoded_pathspec)
 
-        evidence_item = self._get_stat_information_from_file_entry(file_entry)
+        evidence_item = self._get_stat_information_from_file_entry(file_entry, encoded_pathspec)
 
         del file_entry
         PathspecHelper._close_file_entry(encoded_pathspec)
 
         return  evidence_item
 
-    def _get_stat_information_from_file_entry(self, file_entry):
-        """Creates a dictionary of information about the file_entry"""
+    def _get_stat_information_from_file_entry(self, file_entry, encoded_pathspec=None, analyze=True):
+        """Creates a dictionary of information about the file_entry
+
+        Args:
+            file_entry: The dfvfs file entry
+            encoded_pathspec: The encoded pathspec or PathspecKey of the file entry, if already known
+            analyze: False to only use previously detected formats, sets 'analyzed' to False if none are known
+        """
         evidence_item = {}
         stat_object = file_entry.GetStat()
 
@@ -145,20 +201,8 @@ class PathspecHelper(object):
                 # TODO CHANGE
                 evidence_item['meta_type'] = 'Device'
                 evidence_item['legacy_type'] = 'b/b'
-                analyze = Analyzer()
                 try:
-                    volume_type = analyze.GetVolumeSystemTypeIndicators(file_entry.path_spec)
-                    if volume_type:
-                        evidence_item['volume_type'] = volume_type
-                    storage_type = analyze.GetStorageMediaImageTypeIndicators(file_entry.path_spec)
-                    if storage_type:
-                        evidence_item['storage_type'] = storage_type
-                    compression_type = analyze.GetCompressedStreamTypeIndicators(file_entry.path_spec)
-                    if compression_type:
-                        evidence_item['compression_type'] = compression_type
-                    archive_type = analyze.GetArchiveTypeIndicators(file_entry.path_spec)
-                    if archive_type:
-                        evidence_item['archive_type'] = archive_type
+                    self._append_format_types(evidence_item, file_entry, encoded_pathspec, analyze)
                 except AccessError:
                     logging.debug('Failed to determine volume or storage type of because access was denied')
                 except IOError:
@@ -170,20 +214,8 @@ class PathspecHelper(object):
             elif type == definitions.FILE_ENTRY_TYPE_FILE:
                 evidence_item['meta_type'] = 'File'
                 evidence_item['legacy_type'] = 'r/r'
-                analyze = Analyzer()
                 try:
-                    volume_type = analyze.GetVolumeSystemTypeIndicators(file_entry.path_spec)
-                    if volume_type:
-                        evidence_item['volume_type'] = volume_type
-                    storage_type = analyze.GetStorageMediaImageTypeIndicators(file_entry.path_spec)
-                    if storage_type:
-                        evidence_item['storage_type'] = storage_type
-                    compression_type = analyze.GetCompressedStreamTypeIndicators(file_entry.path_spec)
-                    if compression_type:
-                        evidence_item['compression_type'] = compression_type
-                    archive_type = analyze.GetArchiveTypeIndicators(file_entry.path_spec)
-                    if archive_type:
-                        evidence_item['archive_type'] = archive_type
+                    self._append_format_types(evidence_item, file_entry, encoded_pathspec, analyze)
                 except AccessError:
                     logging.warn('Failed to determine volume or storage type of because access was denied')
             elif type == definitions.FILE_ENTRY_TYPE_LINK:
@@ -202,14 +234,148 @@ class PathspecHelper(object):
 
         return  evidence_item
 
+    def _append_format_types(self, evidence_item, file_entry, encoded_pathspec=None, analyze=True):
+        """Adds the format types of the file entry to the evidence item, or marks it as not analyzed"""
+        format_types = self._get_format_types(file_entry, encoded_pathspec, analyze)
+        if format_types is None:
+            evidence_item['analyzed'] = False
+        else:
+            evidence_item.update(format_types)
+
+    def _get_format_types(self, file_entry, encoded_pathspec=None, analyze=True):
+        """Returns the volume, storage, compression, and archive types of the file entry, cached per pathspec
+
+        Returns None if analyze is False and the formats of the file entry have not been detected yet.
+        """
+        if not encoded_pathspec:
+            encoded_pathspec = JsonPathSpecSerializer.WriteSerialized(file_entry.path_spec)
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec, getattr(file_entry, 'path_spec', None))
+
+        format_types = self.format_analyzer.get_cached_format_types(key.hash)
+        if format_types is not None or not analyze:
+            return format_types
+
+        # The header is read once and checked against every format family
+        file_object = file_entry.GetFileObject()
+        if file_object:
+            try:
+                with PathspecHelper._get_read_lock(key):
+                    format_types = self.format_analyzer.get_format_types(key.hash, file_object)
+                    file_object.seek(0)
+            finally:
+                file_object.close()
+
+        if format_types is None:
+            format_types = FormatAnalyzer.get_format_types_from_analyzer(file_entry.path_spec)
+            self.format_analyzer.set_cached_format_types(key.hash, format_types)
+
+        return format_types
+
     def get_evidence_item(self, encoded_pathspec, index='*', cache=False, fast=False):
         """Creates and returns an Efetch object from an encoded path spec"""
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        evidence_item = self._get_evidence_item_paths(key, index)
+
+        if not fast:
+            evidence_item.update(self._get_stat_information(key))
+        else:
+            try:
+                file_entry = PathspecHelper._open_file_entry(key)
+                evidence_item['meta_type'] = PathspecHelper._get_meta_type(file_entry)
+                del file_entry
+
+                PathspecHelper._close_file_entry(key)
+            except RuntimeError:
+                logging.warn('Failed to open file_entry for evidence')
+                evidence_item['meta_type'] = 'Unknown'
+
+        return self._append_mimetype(evidence_item, cache)
+
+    def get_evidence_items(self, encoded_pathspecs, index='*', cache=False, fast=False):
+        """Returns the Efetch objects of a list of encoded pathspecs, in the same order
+
+        The pathspecs are grouped by their parent file system, which is opened once per group and used to open the
+        file entry of each pathspec in the group. A pathspec that fails is returned as a dictionary with its pathspec
+        and the error.
+        """
+        keys = [None] * len(encoded_pathspecs)
+        evidence_items = [None] * len(encoded_pathspecs)
+
+        groups = collections.OrderedDict()
+        for position, encoded_pathspec in enumerate(encoded_pathspecs):
+            # A pathspec that cannot be decoded only fails its own item
+            try:
+                key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+                parent = getattr(key.pathspec, 'parent', None)
+                group = (key.pathspec.type_indicator,
+                         JsonPathSpecSerializer.WriteSerialized(parent) if parent else None)
+            except Exception as error:
+                logging.warn(u'Failed to decode pathspec %r', encoded_pathspec)
+                evidence_items[position] = {'pathspec': encoded_pathspec,
+                                            'error': unicode(error) or error.__class__.__name__}
+                continue
+            keys[position] = key
+            groups.setdefault(group, []).append(position)
+
+        for positions in groups.itervalues():
+            file_system = None
+            try:
+                file_system = resolver.Resolver.OpenFileSystem(keys[positions[0]].pathspec)
+            except Exception:
+                logging.debug(u'Failed to open file system, opening file entries one at a time')
+
+            try:
+                # Entries of the same directory are opened together
+                for position in sorted(positions, key=lambda position: keys[position].file_path):
+                    key = keys[position]
+                    try:
+                        if file_system:
+                            evidence_item = self._get_evidence_item_from_file_system(file_system, key, index, fast)
+                            evidence_items[position] = self._append_mimetype(evidence_item, cache)
+                        else:
+                            evidence_items[position] = self.get_evidence_item(key, index, cache, fast)
+                    except Exception as error:
+                        logging.warn(u'Failed to get evidence item ' + key.encoded_pathspec)
+                        evidence_items[position] = {'pathspec': key.encoded_pathspec,
+                                                    'error': unicode(error) or error.__class__.__name__}
+            finally:
+                if file_system:
+                    file_system.Close()
+
+        return evidence_items
+
+    def _get_evidence_item_from_file_system(self, file_system, key, index='*', fast=False):
+        """Returns the Efetch object of the pathspec key, opening its file entry from the open file system"""
+        evidence_item = self._get_evidence_item_paths(key, index)
+        file_entry = file_system.GetFileEntryByPathSpec(key.pathspec)
+        if not file_entry:
+            raise RuntimeError('File entry not found')
+        if fast:
+            evidence_item['meta_type'] = PathspecHelper._get_meta_type(file_entry)
+        else:
+            evidence_item.update(self._get_stat_information_from_file_entry(file_entry, key))
+        return evidence_item
+
+    @staticmethod
+    def _get_meta_type(file_entry):
+        """Returns the meta type of the file entry without getting its stat information"""
+        if not file_entry:
+            return 'None'
+        elif file_entry.IsDirectory():
+            return 'Directory'
+        elif file_entry.IsFile():
+            return 'File'
+        return 'Unknown'
+
+    def _get_evidence_item_paths(self, key, index='*'):
+        """Returns the part of the Efetch object that only depends on the pathspec, not on the file entry"""
+        encoded_pathspec = key.encoded_pathspec
         evidence_item = {}
         evidence_item['pathspec'] = encoded_pathspec
         evidence_item['url_query'] = urlencode({'pathspec': encoded_pathspec,
                                                 'index': index})
 
-        pathspec = PathspecHelper._decode_pathspec(encoded_pathspec)
+        pathspec = key.pathspec
 
         evidence_item['path'] = getattr(pathspec, 'location', '')
         if evidence_item['path'].endswith('/') or evidence_item['path'].endswith('\\'):
@@ -221,56 +387,40 @@ class PathspecHelper(object):
         evidence_item['file_name'] = os.path.basename(evidence_item['path'])
         evidence_item['directory'] = os.path.dirname(evidence_item['path'])
         evidence_item['extension'] = os.path.splitext(evidence_item['file_name'])[1][1:].lower() or ""
-        evidence_item['file_cache_path'] = self.get_cache_path(encoded_pathspec)
-        evidence_item['file_cache_dir'] = self.get_cache_directory(encoded_pathspec)
-        evidence_item['thumbnail_cache_path'] = self.get_cache_path(encoded_pathspec, 'thumbnails')
-        evidence_item['thumbnail_cache_dir'] = self.get_cache_directory(encoded_pathspec, 'thumbnails')
+        evidence_item['file_cache_path'] = self.get_cache_path(key)
+        evidence_item['file_cache_dir'] = self.get_cache_directory(key)
+        evidence_item['thumbnail_cache_path'] = self.get_cache_path(key, 'thumbnails')
+        evidence_item['thumbnail_cache_dir'] = self.get_cache_directory(key, 'thumbnails')
 
-        if not fast:
-            evidence_item.update(self._get_stat_information(encoded_pathspec))
-        else:
-            try:
-                file_entry = PathspecHelper._open_file_entry(encoded_pathspec)
-
-                if not file_entry:
-                    evidence_item['meta_type'] = 'None'
-                elif file_entry.IsDirectory():
-                    evidence_item['meta_type'] = 'Directory'
-                elif file_entry.IsFile():
-                    evidence_item['meta_type'] = 'File'
-                else:
-                    evidence_item['meta_type'] = 'Unknown'
-
-                del file_entry
-
-                PathspecHelper._close_file_entry(encoded_pathspec)
-            except RuntimeError:
-                logging.warn('Failed to open file_entry for evidence')
-                evidence_item['meta_type'] = 'Unknown'
+        return evidence_item
 
-        return self._append_mimetype(evidence_item, cache)
+    def _append_mimetype(self, evidence, cache=False, sniff=True):
+        """Adds the mimetype to the evidence, sniff=False guesses it from the extension even if the file is cached
 
-    def _append_mimetype(self, evidence, cache=False):
-        evidence['mimetype'] = ''
+        Previously sniffed mimetypes are read from the metadata store and are always known.
+        """
+        key = PathspecHelper.get_pathspec_key(evidence['pathspec'])
+        evidence['mimetype'] = self.metadata_store.get_mimetype(key.hash) or ''
 
         if cache:
             evidence['cached'] = self.cache_evidence_item(evidence)
-            if evidence['cached']:
+            if evidence['cached'] and not evidence['mimetype']:
                 evidence['mimetype'] = self.get_mimetype_from_path(evidence['file_cache_path'])
-                evidence['mimetype_known'] = True
-            else:
-                evidence['mimetype'] = PathspecHelper.guess_mimetype(evidence['extension'])
-                evidence['mimetype_known'] = False
-        elif os.path.isfile(evidence['file_cache_path']) and \
-                not evidence['pathspec'] in PathspecHelper._caching:
-            evidence['mimetype'] = self.get_mimetype_from_path(evidence['file_cache_path'])
-            evidence['mimetype_known'] = True
+                self.metadata_store.set_mimetype(key.hash, evidence['mimetype'])
+        elif os.path.isfile(evidence['file_cache_path']) and not evidence['pathspec'] in PathspecHelper._caching:
+            self.cache_manager.touch(evidence['file_cache_path'])
             evidence['cached'] = True
+            if not evidence['mimetype'] and sniff:
+                evidence['mimetype'] = self.get_mimetype_from_path(evidence['file_cache_path'])
+                self.metadata_store.set_mimetype(key.hash, evidence['mimetype'])
         else:
-            evidence['mimetype'] = PathspecHelper.guess_mimetype(evidence['extension'])
-            evidence['mimetype_known'] = False
             evidence['cached'] = False
 
+        evidence['mimetype_known'] = bool(evidence['mimetype'])
+        if not evidence['mimetype']:
+            evidence['mimetype'] = PathspecHelper.guess_mimetype(evidence['extension'])
+        evidence.setdefault('cached', False)
+
         return evidence
 
     def cache_evidence_item(self, evidence_item, file_entry=False, repeat=4):
@@ -281,122 +431,253 @@ class PathspecHelper(object):
             return False
 
         if not os.path.isdir(evidence_item['file_cache_dir']):
-            os.makedirs(evidence_item['file_cache_dir'])
+            try:
+                os.makedirs(evidence_item['file_cache_dir'])
+            except OSError:
+                # Another thread created the directory first
+                pass
 
         while not os.path.isfile(evidence_item['file_cache_path']) and repeat > 0:
+            repeat = repeat - 1
+
+            # Single-flight, only the first request copies the file and the rest wait for that copy
             with PathspecHelper._cache_lock:
-                repeat = repeat - 1
-                #try:
-                PathspecHelper._caching.append(evidence_item['pathspec'])
-                in_file = PathspecHelper._open_file_object(evidence_item['pathspec'])
-                out_file = open(evidence_item['file_cache_path'], "wb")
-                with PathspecHelper._file_read_lock:
-                    data = in_file.read(PathspecHelper._cache_chunk_size)
-                    while data:
-                        out_file.write(data)
-                        data = in_file.read(PathspecHelper._cache_chunk_size)
-                    in_file.seek(0)
-                PathspecHelper._close_file_object(evidence_item['pathspec'])
-                out_file.close()
-                PathspecHelper._caching.remove(evidence_item['pathspec'])
-                #except:
-                #    logging.warn('File failed to cache, attempting ' + str(repeat) + ' more times')
+                caching_event = PathspecHelper._caching.get(evidence_item['pathspec'])
+                is_caching_thread = caching_event is None
+                if is_caching_thread:
+                    caching_event = threading.Event()
+                    PathspecHelper._caching[evidence_item['pathspec']] = caching_event
+
+            if not is_caching_thread:
+                caching_event.wait()
+                continue
+
+            try:
+                # Another worker process may be copying the same file, it is only copied if still missing
+                with self.cache_manager.get_lock(evidence_item['file_cache_path']):
+                    if not os.path.isfile(evidence_item['file_cache_path']):
+                        self._copy_to_cache(evidence_item)
+            finally:
+                with PathspecHelper._cache_lock:
+                    del PathspecHelper._caching[evidence_item['pathspec']]
+                caching_event.set()
 
         self.create_thumbnail(evidence_item, file_entry)
 
-        return True
+        if not os.path.isfile(evidence_item['file_cache_path']):
+            return False
+        self.cache_manager.touch(evidence_item['file_cache_path'])
 
-    def create_thumbnail(self, evidence_item, file_entry=False):
-        """Creates a thumbnail for the evidence item"""
-        # If the file is an image create a thumbnail
-        if evidence_item['mimetype'].startswith('image') \
-                and not os.path.isfile(evidence_item['thumbnail_cache_path']):
-            if not os.path.isdir(evidence_item['thumbnail_cache_dir']):
-                os.makedirs(evidence_item['thumbnail_cache_dir'])
-            try:
-                cached = os.path.isfile(evidence_item['file_cache_path'])
-                if cached:
-                    image = Image.open(evidence_item['file_cache_path'])
-                else:
-                    image = Image.open(self._open_file_object(evidence_item['pathspec']))
+        return True
 
-                image.thumbnail((PathspecHelper._thumbnail_size, PathspecHelper._thumbnail_size), Image.ANTIALIAS)
+    def _copy_to_cache(self, evidence_item):
+        """Copies the evidence file into the cache, the file only appears at its cache path once complete"""
+        partial_path = evidence_item['file_cache_path'] + '.part'
+        read_lock = PathspecHelper._get_read_lock(evidence_item['pathspec'])
+        in_file = PathspecHelper._open_file_object(evidence_item['pathspec'])
+        try:
+            with open(partial_path, 'wb') as out_file:
+                # Only holds the image lock per chunk so other reads on the same image can interleave
+                offset = 0
+                while True:
+                    with read_lock:
+                        in_file.seek(offset)
+                        data = in_file.read(PathspecHelper._cache_chunk_size)
+                        in_file.seek(0)
+                    if not data:
+                        break
+                    out_file.write(data)
+                    offset += len(data)
+            os.rename(partial_path, evidence_item['file_cache_path'])
+        except:
+            logging.warn('Failed to cache ' + evidence_item['file_name'])
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            raise
+        finally:
+            PathspecHelper._close_file_object(evidence_item['pathspec'])
 
-                if evidence_item['mimetype'] == 'image/jpeg':
-                    image.save(evidence_item['thumbnail_cache_path'], 'JPEG')
-                else:
-                    image.save(evidence_item['thumbnail_cache_path'])
-
-                if not cached:
-                    self._close_file_object(evidence_item['pathspec'])
-            except IOError:
-                logging.warn('IOError when trying to create thumbnail for '
-                             + evidence_item['file_name'] + ' at cached path ' +
-                             evidence_item['file_cache_path'])
-            except:
-                logging.warn('Failed to create thumbnail for ' + evidence_item['file_name'] +
-                             ' at cached path ' + evidence_item['file_cache_path'])
+    def create_thumbnail(self, evidence_item, file_entry=False):
+        """Returns the thumbnail path of the image, or None after queueing it with the thumbnail service"""
+        if evidence_item['mimetype'].startswith('image'):
+            return self.thumbnail_service.get_thumbnail(evidence_item)
+        return None
 
     def get_mimetype(self, encoded_pathspec, file_entry=None):
-        """Gets the mimetype of the given pathspec"""
-        data = PathspecHelper.read_file(encoded_pathspec, file_entry, size=self._mimetype_chunk_size)
+        """Gets the mimetype of the given pathspec, sniffing it only if it is not in the metadata store"""
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        mimetype = self.metadata_store.get_mimetype(key.hash)
+        if mimetype:
+            return mimetype
+
+        data = PathspecHelper.read_file(key, file_entry, size=self._mimetype_chunk_size)
         if not data:
-            return 'Empty'
+            mimetype = 'Empty'
+        else:
+            mimetype = self.magic_pool.from_buffer(data)
 
-        # Do not remove this lock, it maybe a bug in magic, but it will break the code
-        with self._magic:
-            if self._pymagic:
-                return self._my_magic.from_buffer(data)
-            else:
-                return self._my_magic.id_buffer(data)
+        self.metadata_store.set_mimetype(key.hash, mimetype)
+        return mimetype
 
     def get_mimetype_from_path(self, path):
         """Gets the mimetype from the file at the specified path"""
-        # Do not remove this lock, it maybe a bug in magic, but it will break the code
-        with self._magic:
-            if self._pymagic:
-                return self._my_magic.from_file(path)
-            else:
-                return self._my_magic.id_filename(path)
-
-    def list_directory(self, encoded_pathspec, recursive=False, index='*', auto_skip=True):
-        """Lists a directory using a pathspec or list of pathspecs"""
-        directories = self._list_directory(self._open_file_entry(encoded_pathspec), recursive, 0, index)
-        self._close_file_entry(encoded_pathspec)
-        return directories
-
-    def _list_directory(self, file_entry, recursive=False, depth=0, index='*'):
-        """Lists a directory using a file entry"""
-        directory_list = []
-
-        if depth > 0:
-            evidence = {}
-            pathspec = file_entry.path_spec
-            evidence['pathspec'] = JsonPathSpecSerializer.WriteSerialized(pathspec)
-            evidence['url_query'] = urlencode({'pathspec': evidence['pathspec'], 'index': index})
-            evidence['path'] = pathspec.location
-            location = pathspec.location
-            if location.endswith('/') or location.endswith('\\'):
-                location = location[:-1]
-            file_name = os.path.basename(location)
-            evidence['file_name'] = file_name
-            evidence.update(self._get_stat_information_from_file_entry(file_entry))
-            evidence['file_cache_path'] = self.get_cache_path(evidence['pathspec'])
-            evidence['extension'] = self.get_file_extension(evidence['pathspec'])
-            directory_list.append(self._append_mimetype(evidence))
+        return self.magic_pool.from_file(path)
+
+    def list_directory(self, encoded_pathspec, recursive=False, index='*', auto_skip=True, analyze=True):
+        """Lists a directory using a pathspec or list of pathspecs
+
+        Args:
+            encoded_pathspec: The encoded pathspec of the directory
+            recursive: True to list all sub directories
+            index: The Elasticsearch index added to each url_query
+            auto_skip: Unused
+            analyze: False to only return cheap metadata, format types and mimetypes are only included if they
+                were previously detected and files without them have 'analyzed' set to False
+        """
+        return list(self.iter_directory(encoded_pathspec, recursive, index, analyze))
+
+    def list_directory_page(self, encoded_pathspec, cursor=0, page_size=100, recursive=False, index='*',
+                            analyze=True):
+        """Returns one page of the directory listing and the cursor of the next page, None if it is the last page
+
+        The walk of a page that is not the last page is suspended, so the next page continues where it stopped.
+        Only the most recently listed pages are kept, any other cursor walks the directory again from its first entry
+        and skips the entries before the cursor, which dfvfs still has to open.
+
+        Args:
+            encoded_pathspec: The encoded pathspec of the directory
+            cursor: The number of entries before this page, returned as the next cursor by the previous page
+            page_size: The max number of entries in the page
+            recursive: True to list all sub directories
+            index: The Elasticsearch index added to each url_query
+            analyze: False to skip format and mimetype detection, see list_directory
+        """
+        listing = (PathspecHelper.get_pathspec_key(encoded_pathspec).hash, recursive, index, analyze)
+        with PathspecHelper._suspended_listings_lock:
+            suspended = PathspecHelper._suspended_listings.pop(listing + (cursor,), None)
+
+        if suspended:
+            # The suspended walk already yielded the first entry of this page
+            items_iterator, items = suspended
+        else:
+            items_iterator, items = self.iter_directory(encoded_pathspec, recursive, index, analyze, cursor), []
+        items.extend(itertools.islice(items_iterator, page_size + 1 - len(items)))
 
-        if (recursive or depth == 0) and (file_entry.IsDirectory() or hasattr(file_entry, 'sub_file_entries')):
-            for sub_file_entry in file_entry.sub_file_entries:
-                directory_list.extend(self._list_directory(sub_file_entry, recursive, depth + 1))
+        if len(items) > page_size:
+            self._suspend_listing(listing + (cursor + page_size,), items_iterator, items[page_size:])
+            return items[:page_size], cursor + page_size
+        items_iterator.close()
+        return items, None
 
-        return directory_list
+    @staticmethod
+    def _suspend_listing(page, items_iterator, items):
+        """Keeps the walk that yields the page, closing the least recently suspended walks over the limit"""
+        closing = []
+        with PathspecHelper._suspended_listings_lock:
+            if page in PathspecHelper._suspended_listings:
+                closing.append(PathspecHelper._suspended_listings.pop(page)[0])
+            PathspecHelper._suspended_listings[page] = (items_iterator, items)
+            while len(PathspecHelper._suspended_listings) > PathspecHelper._max_suspended_listings:
+                closing.append(PathspecHelper._suspended_listings.popitem(last=False)[1][0])
+        # Closing a walk closes the file entry of its directory
+        for suspended_iterator in closing:
+            suspended_iterator.close()
+
+    def iter_directory(self, encoded_pathspec, recursive=False, index='*', analyze=True, cursor=0):
+        """Yields the entries of a directory one at a time, keeping only the current path of a recursive walk in
+        memory
+
+        Args:
+            encoded_pathspec: The encoded pathspec of the directory
+            recursive: True to list all sub directories
+            index: The Elasticsearch index added to each url_query
+            analyze: False to skip format and mimetype detection, see list_directory
+            cursor: The number of entries to skip, skipped entries are not stat'ed
+        """
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        if not recursive and self.evidence_index and self.evidence_index.is_indexed(key.hash):
+            for item in self._iter_indexed_directory(key, index, analyze, cursor):
+                yield item
+            return
+
+        file_entry = self._open_file_entry(encoded_pathspec)
+        try:
+            if not (file_entry.IsDirectory() or hasattr(file_entry, 'sub_file_entries')):
+                return
+
+            # Depth first walk using a stack of sub file entry iterators
+            stack = [iter(file_entry.sub_file_entries)]
+            while stack:
+                sub_file_entry = next(stack[-1], None)
+                if sub_file_entry is None:
+                    stack.pop()
+                    continue
+
+                if cursor > 0:
+                    cursor -= 1
+                else:
+                    yield self._get_listing_item(sub_file_entry, index, analyze)
+
+                if recursive and (sub_file_entry.IsDirectory() or hasattr(sub_file_entry, 'sub_file_entries')):
+                    stack.append(iter(sub_file_entry.sub_file_entries))
+        finally:
+            self._close_file_entry(encoded_pathspec)
+
+    def _iter_indexed_directory(self, key, index='*', analyze=True, cursor=0):
+        """Yields the entries of a directory from the evidence index, reading a page of entries at a time"""
+        while True:
+            children = self.evidence_index.get_children(key.hash, cursor, self._index_page_size)
+            for child in children:
+                yield self._get_indexed_listing_item(child, index, analyze)
+            if len(children) < self._index_page_size:
+                return
+            cursor += len(children)
+
+    def _get_indexed_listing_item(self, evidence, index='*', analyze=True):
+        """Completes the evidence item of an indexed entry, dfvfs is only used to detect formats if analyze is True"""
+        key = PathspecHelper.get_pathspec_key(evidence['pathspec'])
+        evidence['url_query'] = urlencode({'pathspec': evidence['pathspec'], 'index': index})
+
+        if evidence.get('meta_type') in ['File', 'Device']:
+            self._append_format_types(evidence, None, key, False)
+            if analyze and evidence.get('analyzed') is False:
+                file_entry = self._open_file_entry(key)
+                try:
+                    del evidence['analyzed']
+                    self._append_format_types(evidence, file_entry, key)
+                except (AccessError, IOError):
+                    logging.debug('Failed to determine volume or storage type of indexed entry')
+                finally:
+                    self._close_file_entry(key)
+
+        evidence['file_cache_path'] = self.get_cache_path(key)
+        evidence['extension'] = key.extension
+        return self._append_mimetype(evidence, sniff=analyze)
+
+    def _get_listing_item(self, file_entry, index='*', analyze=True):
+        """Returns the evidence item of a directory listing entry"""
+        evidence = {}
+        pathspec = file_entry.path_spec
+        key = PathspecHelper.get_pathspec_key(JsonPathSpecSerializer.WriteSerialized(pathspec), pathspec)
+        evidence['pathspec'] = key.encoded_pathspec
+        evidence['url_query'] = urlencode({'pathspec': evidence['pathspec'], 'index': index})
+        evidence['path'] = pathspec.location
+        location = pathspec.location
+        if location.endswith('/') or location.endswith('\\'):
+            location = location[:-1]
+        file_name = os.path.basename(location)
+        evidence['file_name'] = file_name
+        evidence.update(self._get_stat_information_from_file_entry(file_entry, key, analyze))
+        evidence['file_cache_path'] = self.get_cache_path(key)
+        evidence['extension'] = key.extension
+        return self._append_mimetype(evidence, sniff=analyze)
 
     def old_list_directory(self, encoded_pathspec, recursive=False):
         """Lists a directory using a pathspec or list of pathspecs"""
         directory_list = []
         pathspec = PathspecHelper._decode_pathspec(encoded_pathspec)
 
-        directory_list.extend(self._list_directory(
+        directory_list.extend(self._old_list_directory(
             resolver.Resolver.OpenFileEntry(pathspec), recursive, 0))
 
         return directory_list
@@ -410,18 +691,44 @@ class PathspecHelper(object):
 
         if (recursive or depth == 0) and file_entry.IsDirectory():
             for sub_file_entry in file_entry.sub_file_entries:
-                directory_list.extend(self._list_directory(sub_file_entry, recursive, depth + 1))
+                directory_list.extend(self._old_list_directory(sub_file_entry, recursive, depth + 1))
 
         return directory_list
 
     @staticmethod
-    def _decode_pathspec(encoded_pathspec):
-        """Returns a Path Spec object from an encoded path spec, causes a 400 abort if the decode fails"""
+    def get_pathspec_key(encoded_pathspec, pathspec=None):
+        """Returns the memoized PathspecKey of an encoded path spec, causes a 400 abort if there is no path spec
+
+        Args:
+            encoded_pathspec: The encoded path spec or an existing PathspecKey, which is returned as is
+            pathspec: The already decoded Path Spec, if available, to skip decoding
+        """
+        if isinstance(encoded_pathspec, PathspecKey):
+            return encoded_pathspec
+
         if not encoded_pathspec:
             logging.warn('Path Spec required but none found')
             abort(400, 'Expected an encoded Path Spec, but none found')
 
-        return JsonPathSpecSerializer.ReadSerialized(encoded_pathspec)
+        with PathspecHelper._pathspec_keys_lock:
+            key = PathspecHelper._pathspec_keys.pop(encoded_pathspec, None)
+            if key:
+                PathspecHelper._pathspec_keys[encoded_pathspec] = key
+                return key
+
+        key = PathspecKey(encoded_pathspec, pathspec)
+
+        with PathspecHelper._pathspec_keys_lock:
+            PathspecHelper._pathspec_keys[encoded_pathspec] = key
+            while len(PathspecHelper._pathspec_keys) > PathspecHelper._max_pathspec_keys:
+                PathspecHelper._pathspec_keys.popitem(last=False)
+
+        return key
+
+    @staticmethod
+    def _decode_pathspec(encoded_pathspec):
+        """Returns a Path Spec object from an encoded path spec, causes a 400 abort if the decode fails"""
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).pathspec
 
     @staticmethod
     def get_inode(encoded_pathspec):
@@ -431,15 +738,12 @@ class PathspecHelper(object):
     @staticmethod
     def get_file_path(encoded_pathspec):
         """Returns the full path of the given pathspec"""
-        return getattr(PathspecHelper._decode_pathspec(encoded_pathspec), 'location', '')
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).file_path
     
     @staticmethod
     def get_file_name(encoded_pathspec):
         """Returns the file name with extension of the given pathspec"""
-        file_name = os.path.basename(PathspecHelper.get_file_path(encoded_pathspec))
-        if not file_name:
-            file_name = 'none'
-        return file_name
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).file_name
     
     @staticmethod
     def get_file_directory(encoded_pathspec):
@@ -449,106 +753,137 @@ class PathspecHelper(object):
     @staticmethod
     def get_file_extension(encoded_pathspec):
         """Returns the file extension of the given pathspec"""
-        return os.path.splitext(PathspecHelper.get_file_name(encoded_pathspec))[1][1:].lower() or ""
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).extension
     
     @staticmethod
     def _get_pathspec_hash(encoded_pathspec):
         """Returns the SHA1 hash of the encoded pathspec, NOT THE FILE"""
-        return hashlib.sha1(encoded_pathspec).hexdigest()
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).hash
 
     @staticmethod
     def get_file_strings(encoded_pathspec, min=4):
-        chars = r"A-Za-z0-9/\-:.,_$%'()[\]<> "
-        regexp = '[%s]{%d,}' % (chars, min)
-        pattern = re.compile(regexp)
-        return pattern.findall(PathspecHelper.read_file(encoded_pathspec))
+        """Yields the ASCII and UTF-16LE strings of the file, reading it a chunk at a time"""
+        for _, value in PathspecHelper.iter_file_strings(encoded_pathspec, min):
+            yield value
+
+    @staticmethod
+    def iter_file_strings(encoded_pathspec, min_length=4, offset=0):
+        """Yields the offset and value of each ASCII and UTF-16LE string of the file in offset order
+
+        The file is read in fixed size chunks, the trailing characters of a chunk that may be the start of a string
+        are carried over to the next chunk.
+
+        Args:
+            encoded_pathspec: The encoded pathspec of the file
+            min_length: The min number of characters in a string
+            offset: The offset to start reading at
+        """
+        chars = PathspecHelper._strings_characters
+        ascii_pattern = re.compile('[%s]{%d,}' % (chars, min_length))
+        utf16_pattern = re.compile('(?:[%s]\x00){%d,}' % (chars, min_length))
+        # The trailing UTF-16 characters that could continue into the next chunk, matched on the reversed data
+        reversed_utf16_tail = re.compile('[%s]?(?:\x00[%s])*' % (chars, chars))
+        max_carry_over = PathspecHelper._strings_max_carry_over
+
+        key = PathspecHelper.get_pathspec_key(encoded_pathspec)
+        data = ''
+        data_offset = offset
+        # The end offset of the last ASCII and UTF-16 strings, so the rest of a string is not found again
+        ends = {False: 0, True: 0}
+        read_offset = offset
+
+        while True:
+            chunk = PathspecHelper.read_file(key, size=PathspecHelper._strings_chunk_size, seek=read_offset)
+            read_offset += len(chunk)
+            data += chunk
+
+            if chunk:
+                ascii_start = len(data.rstrip(PathspecHelper._strings_character_set))
+                utf16_start = len(data) - reversed_utf16_tail.match(data[:-max_carry_over - 2:-1]).end()
+                carry_start = min(ascii_start, utf16_start)
+                if len(data) - carry_start > max_carry_over:
+                    carry_start = len(data)
+            else:
+                carry_start = len(data)
+
+            # Strings starting before the carry over are complete, they may end inside it but not at its end
+            strings = []
+            for pattern, utf16 in [(ascii_pattern, False), (utf16_pattern, True)]:
+                for match in pattern.finditer(data):
+                    if match.start() >= carry_start:
+                        break
+                    if data_offset + match.start() < ends[utf16]:
+                        continue
+                    ends[utf16] = data_offset + match.end()
+                    strings.append((match.start(), match.group().replace('\x00', '') if utf16 else match.group()))
+            for start, value in sorted(strings):
+                yield data_offset + start, value
+
+            if not chunk:
+                return
+            data = data[carry_start:]
+            data_offset += carry_start
 
     @staticmethod
     def _open_file_entry(encoded_pathspec):
-        """Returns an open File Entry object of the given path spec"""
-        with PathspecHelper._open_file_entries_lock:
-            if encoded_pathspec not in PathspecHelper._open_file_entries_locks:
-                PathspecHelper._open_file_entries_locks[encoded_pathspec] = threading.Lock()
-
-        with PathspecHelper._open_file_entries_locks[encoded_pathspec]:
-            if encoded_pathspec in PathspecHelper._open_file_entries:
-                PathspecHelper._open_file_entries_count[encoded_pathspec] += 1
-                if PathspecHelper._open_file_entries[encoded_pathspec]:
-                    return PathspecHelper._open_file_entries[encoded_pathspec]
+        """Returns an open File Entry object of the given path spec, must be closed with _close_file_entry"""
+        return PathspecHelper._open_file_entries.acquire(PathspecHelper.get_pathspec_key(encoded_pathspec).encoded_pathspec)
+
+    @staticmethod
+    def _resolve_file_entry(encoded_pathspec):
+        """Opens a new File Entry object of the given path spec using dfvfs"""
+        try:
             try:
-                PathspecHelper._open_file_entries_count[encoded_pathspec] = 1
-                try:
-                    PathspecHelper._open_file_entries[encoded_pathspec] =\
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
-                except KeyError:
-                    logging.warn('Unknown KEY ERROR while opening evidence file, attempting again...')
-                    PathspecHelper._open_file_entries[encoded_pathspec] = \
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
-                except RuntimeError:
-                    logging.warn('Unknown RUNTIME ERROR while opening evidence file, attempting again...')
-                    PathspecHelper._open_file_entries[encoded_pathspec] = \
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
-                except AttributeError:
-                    logging.warn('Unknown ATTRIBUTE ERROR while opening evidence file, attempting again...')
-                    PathspecHelper._open_file_entries[encoded_pathspec] = \
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
-                except CacheFullError:
-                    PathspecHelper._clear_file_entry_cache()
-                    PathspecHelper._open_file_entries[encoded_pathspec] = \
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
-
-                if not PathspecHelper._open_file_entries[encoded_pathspec]:
-                    # TODO There appears to be a bug in dfVFS
-                    # TODO     for compressed formats ZIP, etc.
-                    logging.warn('Attempting compression error fix...')
-                    type_indicator_list = ['ZIP', 'GZIP']
-                    pathspec_dictionary = json.loads(encoded_pathspec)
-                    # TODO add levels to repeat current_level = 0
-                    if pathspec_dictionary['type_indicator'] in type_indicator_list:
-                        pathspec_dictionary['location'] = pathspec_dictionary['location'] + u'/'
-                    new_encoded_pathspec = json.dumps(pathspec_dictionary)
-                    PathspecHelper._open_file_entries[encoded_pathspec] = \
-                        resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(new_encoded_pathspec))
-                if PathspecHelper._open_file_entries[encoded_pathspec]:
-                    return PathspecHelper._open_file_entries[encoded_pathspec]
-            except Exception as e:
-                del PathspecHelper._open_file_entries_count[encoded_pathspec]
-                logging.error('Failed second attempt to open evidence file entry')
-                logging.debug(encoded_pathspec)
-                logging.debug(e.message)
-                logging.debug(traceback.format_exc())
-                raise RuntimeError('Failed to open evidence file entry')
-        logging.error('Missing file entry for pathspec "' + encoded_pathspec + '"')
-        raise RuntimeError('Missing File Entry for Pathspec')
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
+            except KeyError:
+                logging.warn('Unknown KEY ERROR while opening evidence file, attempting again...')
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
+            except RuntimeError:
+                logging.warn('Unknown RUNTIME ERROR while opening evidence file, attempting again...')
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
+            except AttributeError:
+                logging.warn('Unknown ATTRIBUTE ERROR while opening evidence file, attempting again...')
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
+            except CacheFullError:
+                PathspecHelper._clear_file_entry_cache()
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(encoded_pathspec))
+
+            if not file_entry:
+                # TODO There appears to be a bug in dfVFS
+                # TODO     for compressed formats ZIP, etc.
+                logging.warn('Attempting compression error fix...')
+                type_indicator_list = ['ZIP', 'GZIP']
+                pathspec_dictionary = json.loads(encoded_pathspec)
+                # TODO add levels to repeat current_level = 0
+                if pathspec_dictionary['type_indicator'] in type_indicator_list:
+                    pathspec_dictionary['location'] = pathspec_dictionary['location'] + u'/'
+                new_encoded_pathspec = json.dumps(pathspec_dictionary)
+                file_entry = resolver.Resolver.OpenFileEntry(PathspecHelper._decode_pathspec(new_encoded_pathspec))
+        except Exception as e:
+            logging.error('Failed second attempt to open evidence file entry')
+            logging.debug(encoded_pathspec)
+            logging.debug(e.message)
+            logging.debug(traceback.format_exc())
+            raise RuntimeError('Failed to open evidence file entry')
+
+        if not file_entry:
+            logging.error('Missing file entry for pathspec "' + encoded_pathspec + '"')
+            raise RuntimeError('Missing File Entry for Pathspec')
+
+        return file_entry
 
     @staticmethod
     def _clear_file_entry_cache():
-        logging.warn('File Entry cache is full, attempting to empty cache')
-        with PathspecHelper._open_file_entries_lock:
-            temp_locks = PathspecHelper._open_file_entries_locks.iteritems()
-            keys_to_delete = []
-            for key, lock in temp_locks:
-                if not lock.locked():
-                    keys_to_delete.append(key)
-            for key in keys_to_delete:
-                if key in PathspecHelper._open_file_entries_locks:
-                    del PathspecHelper._open_file_entries_locks[key]
-                if key in PathspecHelper._open_file_entries_count:
-                    del PathspecHelper._open_file_entries_count[key]
-                if key in PathspecHelper._open_file_entries:
-                    del PathspecHelper._open_file_entries[key]
-        time.sleep(0.1)
+        """Closes all idle file objects and file entries, releasing their references in the dfvfs cache"""
+        logging.warn('File Entry cache is full, closing idle file objects and file entries')
+        PathspecHelper._open_file_objects.evict_idle()
+        PathspecHelper._open_file_entries.evict_idle()
 
     @staticmethod
     def _close_file_entry(encoded_pathspec):
         """Closes the file entry"""
         try:
-            with PathspecHelper._open_file_entries_lock:
-                PathspecHelper._open_file_entries_count[encoded_pathspec] -= 1
-                # currently waiting until cache is full is more stable than the following code:
-                # if PathspecHelper._open_file_entries_count[encoded_pathspec] < 1:
-                #     del PathspecHelper._open_file_entries[encoded_pathspec]
-                #     del PathspecHelper._open_file_entries_locks[encoded_pathspec]
+            PathspecHelper._open_file_entries.release(PathspecHelper.get_pathspec_key(encoded_pathspec).encoded_pathspec)
         except KeyError:
             logging.error('Attempted to close already closed file entry!')
             raise RuntimeError('Attempting to close already closed file entry')
@@ -557,7 +892,7 @@ class PathspecHelper(object):
     def read_file(encoded_pathspec, file_entry=False, size=0, seek=0):
         """Reads the file object from the specified pathspec, always seeks back to the beginning"""
         file = PathspecHelper._open_file_object(encoded_pathspec)
-        with PathspecHelper._file_read_lock:
+        with PathspecHelper._get_read_lock(encoded_pathspec):
             file.seek(seek)
             if size:
                 data = file.read(size)
@@ -568,44 +903,97 @@ class PathspecHelper(object):
         return data
 
     @staticmethod
-    def _open_file_object(encoded_pathspec):
-        """Returns the file object from the specified pathspec"""
-        with PathspecHelper._open_file_object_lock:
-            if len(PathspecHelper._open_file_objects) < PathspecHelper._max_file_count:
-                if encoded_pathspec in PathspecHelper._open_file_objects_count:
-                    PathspecHelper._open_file_objects_count[encoded_pathspec] += 1
-                else:
-                    PathspecHelper._open_file_objects_count[encoded_pathspec] = 1
+    def iter_file_chunks(encoded_pathspec, chunk_size=1048576, offset=0):
+        """Yields the data of the file in chunks, starting at the offset
+
+        The file object stays open for the whole stream, but the read lock of the image is only held while one chunk
+        is read, so a long stream does not block other reads from the same image.
+        """
+        file = PathspecHelper._open_file_object(encoded_pathspec)
+        try:
+            while True:
+                with PathspecHelper._get_read_lock(encoded_pathspec):
+                    file.seek(offset)
+                    data = file.read(chunk_size)
+                if not data:
+                    break
+                offset += len(data)
+                yield data
+        finally:
+            PathspecHelper._close_file_object(encoded_pathspec)
+
+    def hash_file(self, encoded_pathspec, hash_types=None):
+        """Returns a dictionary of hash type to hex digest, computing every digest in one pass over the file
+
+        Args:
+            encoded_pathspec: The pathspec of the file to hash
+            hash_types: The list of hashlib algorithm names, md5 if empty
+        """
+        hashers = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types or ['md5']]
+
+        # The cached copy is read if there is one, otherwise the file is streamed from the evidence
+        if self.is_file_cached(encoded_pathspec):
+            with open(self.get_cache_path(encoded_pathspec), 'rb') as cached_file:
+                for data in iter(lambda: cached_file.read(PathspecHelper._hash_chunk_size), ''):
+                    for hash_type, hasher in hashers:
+                        hasher.update(data)
+        else:
+            for data in PathspecHelper.iter_file_chunks(encoded_pathspec, PathspecHelper._hash_chunk_size):
+                for hash_type, hasher in hashers:
+                    hasher.update(data)
 
-                if encoded_pathspec not in PathspecHelper._open_file_objects:
-                    file_entry = PathspecHelper._open_file_entry(encoded_pathspec)
-                    if not file_entry.IsFile() and not file_entry.IsDevice():
-                        PathspecHelper._close_file_entry(encoded_pathspec)
-                        raise TypeError('Cannot open file object, because the pathspec is not for a file or device.')
+        return dict([(hash_type, hasher.hexdigest()) for hash_type, hasher in hashers])
 
-                    try:
-                        PathspecHelper._open_file_objects[encoded_pathspec] = file_entry.GetFileObject()
-                    except SystemError:
-                        logging.warn('System Error while trying to get file object, attempting again.')
-                        PathspecHelper._open_file_objects[encoded_pathspec] = file_entry.GetFileObject()
+    @staticmethod
+    def _get_image_key(encoded_pathspec):
+        """Returns the encoded root pathspec, which identifies the underlying image of the given pathspec"""
+        return PathspecHelper.get_pathspec_key(encoded_pathspec).image_key
+
+    @staticmethod
+    def _get_read_lock(encoded_pathspec):
+        """Returns the read lock for the underlying image of the pathspec
+
+        dfvfs shares one handle (and one seek position) per image between every file object opened from it,
+        so reads only need to be serialized per image and evidence on different images can be read in parallel.
+        """
+        image_key = PathspecHelper._get_image_key(encoded_pathspec)
+        with PathspecHelper._file_read_locks_lock:
+            if image_key not in PathspecHelper._file_read_locks:
+                PathspecHelper._file_read_locks[image_key] = threading.Lock()
+            return PathspecHelper._file_read_locks[image_key]
 
-                    PathspecHelper._close_file_entry(encoded_pathspec)
+    @staticmethod
+    def _open_file_object(encoded_pathspec):
+        """Returns the file object from the specified pathspec, must be closed with _close_file_object"""
+        return PathspecHelper._open_file_objects.acquire(PathspecHelper.get_pathspec_key(encoded_pathspec).encoded_pathspec)
 
-                return PathspecHelper._open_file_objects[encoded_pathspec]
+    @staticmethod
+    def _resolve_file_object(encoded_pathspec):
+        """Opens a new file object from the specified pathspec using dfvfs"""
+        file_entry = PathspecHelper._open_file_entry(encoded_pathspec)
+        try:
+            if not file_entry.IsFile() and not file_entry.IsDevice():
+                raise TypeError('Cannot open file object, because the pathspec is not for a file or device.')
+
+            try:
+                return file_entry.GetFileObject()
+            except SystemError:
+                logging.warn('System Error while trying to get file object, attempting again.')
+                return file_entry.GetFileObject()
+            except CacheFullError:
+                PathspecHelper._clear_file_entry_cache()
+                return file_entry.GetFileObject()
+        finally:
+            PathspecHelper._close_file_entry(encoded_pathspec)
 
     @staticmethod
     def _close_file_object(encoded_pathspec):
         """Closes the file object associated with the specified pathspec"""
-        with PathspecHelper._open_file_object_lock:
-            try:
-                PathspecHelper._open_file_objects_count[encoded_pathspec] -= 1
-                if PathspecHelper._open_file_objects_count[encoded_pathspec] < 1:
-                    PathspecHelper._open_file_objects[encoded_pathspec].close()
-                    del PathspecHelper._open_file_objects[encoded_pathspec]
-                    PathspecHelper._close_file_entry(encoded_pathspec)
-            except KeyError:
-                logging.error('Attempted to close already closed file object!')
-                raise RuntimeError('Attempting to close already closed file object')
+        try:
+            PathspecHelper._open_file_objects.release(PathspecHelper.get_pathspec_key(encoded_pathspec).encoded_pathspec)
+        except KeyError:
+            logging.error('Attempted to close already closed file object!')
+            raise RuntimeError('Attempting to close already closed file object')
 
     @staticmethod
     def list_base_pathspecs(evidence):
@@ -640,6 +1028,34 @@ class PathspecHelper(object):
 
     @staticmethod
     def _list_new_base_pathspecs(encoded_pathspec):
+        """Gets a list of the base_pathspecs from in a pathspec, scanning the source only once
+
+        The scan results are kept in memory and in the metadata store, so expanding or moving up through an image
+        with many partitions and volume shadow copies does not scan it again.
+        """
+        pathspec_hash = PathspecHelper.get_pathspec_key(encoded_pathspec).hash
+        with PathspecHelper._base_pathspecs_lock:
+            pathspecs = PathspecHelper._base_pathspecs.get(pathspec_hash)
+        metadata_store = getattr(PathspecHelper.instance, 'metadata_store', None)
+
+        if pathspecs is None and metadata_store:
+            pathspecs = metadata_store.get_base_pathspecs(pathspec_hash)
+            if pathspecs is not None:
+                with PathspecHelper._base_pathspecs_lock:
+                    PathspecHelper._base_pathspecs[pathspec_hash] = pathspecs
+
+        if pathspecs is None:
+            pathspecs = PathspecHelper._scan_base_pathspecs(encoded_pathspec)
+            with PathspecHelper._base_pathspecs_lock:
+                PathspecHelper._base_pathspecs[pathspec_hash] = pathspecs
+            if metadata_store:
+                metadata_store.set_base_pathspecs(pathspec_hash, pathspecs)
+
+        # Callers add keys to the items, so each gets its own copies
+        return [dict(item) for item in pathspecs]
+
+    @staticmethod
+    def _scan_base_pathspecs(encoded_pathspec):
         '''Gets a list of the base_pathspecs from in a pathspec using dfvfs_utils'''
         try:
             dfvfs_util = DfvfsUtil(PathspecHelper._decode_pathspec(encoded_pathspec), interactive=True, is_pathspec=True)
@@ -693,6 +1109,12 @@ class PathspecHelper(object):
     @staticmethod
     def get_parent_pathspec(encoded_pathspec):
         '''Gets the parent pathspec of the provided pathspec'''
+        evidence_index = getattr(PathspecHelper.instance, 'evidence_index', None)
+        if evidence_index:
+            parent_pathspec = evidence_index.get_parent_pathspec(PathspecHelper.get_pathspec_key(encoded_pathspec).hash)
+            if parent_pathspec:
+                return parent_pathspec
+
         file_entry = PathspecHelper._open_file_entry(encoded_pathspec)
         parent_entry = file_entry.GetParentFileEntry()
         PathspecHelper._close_file_entry(encoded_pathspec)
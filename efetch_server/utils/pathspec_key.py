@@ -0,0 +1,51 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import os
+from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
+
+
+class PathspecKey(object):
+    """This class holds an encoded pathspec along with its decoded Path Spec and the values derived from it, so
+    each is only computed once per pathspec"""
+
+    def __init__(self, encoded_pathspec, pathspec=None):
+        """Decodes the pathspec and computes its hash, file name, and extension
+
+        Args:
+            encoded_pathspec: The JSON encoded pathspec
+            pathspec: The already decoded Path Spec, if available, to skip decoding
+        """
+        self.encoded_pathspec = encoded_pathspec
+        self.pathspec = pathspec or JsonPathSpecSerializer.ReadSerialized(encoded_pathspec)
+        self.hash = hashlib.sha1(encoded_pathspec).hexdigest()
+        self.file_path = getattr(self.pathspec, 'location', '')
+        self.file_name = os.path.basename(self.file_path) or 'none'
+        self.extension = os.path.splitext(self.file_name)[1][1:].lower() or ""
+        # Cache directories and paths by parent directory, filled in by the PathspecHelper
+        self.cache_directories = {}
+        self.cache_paths = {}
+        self._image_key = None
+
+    @property
+    def image_key(self):
+        """The encoded root pathspec, which identifies the underlying image of this pathspec"""
+        if not self._image_key:
+            root = self.pathspec
+            while getattr(root, 'parent', None):
+                root = root.parent
+            self._image_key = JsonPathSpecSerializer.WriteSerialized(root)
+        return self._image_key
@@ -0,0 +1,428 @@
+# Copyright 2016 Michael J Maurer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import Queue
+import struct
+import threading
+import time
+from cStringIO import StringIO
+from dfvfs.resolver import context
+from dfvfs.resolver import resolver
+from dfvfs.serializer.json_serializer import JsonPathSpecSerializer
+from efetch_server.utils.file_lock import FileLock
+from PIL import Image
+
+
+# Bytes read from the start of a JPEG to find its EXIF thumbnail, the EXIF segment is at most 64KB
+_exif_header_size = 131072
+# The dfvfs resolver context of a worker process, so each worker opens and caches its own image handles
+_resolver_context = None
+
+
+def _init_worker():
+    """Creates the dfvfs resolver context of the worker process"""
+    global _resolver_context
+    FileLock.close_inherited()
+    _resolver_context = context.Context()
+
+
+class _FileObjectReader(object):
+    """This class adapts a dfvfs file object to the file interface PIL reads images from"""
+
+    def __init__(self, file_object):
+        self._file_object = file_object
+
+    def read(self, size=None):
+        return self._file_object.read(size if size >= 0 else None)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._file_object.seek(offset, whence)
+
+    def tell(self):
+        return self._file_object.get_offset()
+
+
+def _create_thumbnail(source_path, encoded_pathspec, thumbnail_path, thumbnail_size, jpeg, lock_path):
+    """Creates the thumbnail of an image, runs in a worker process
+
+    Args:
+        source_path: The path of the cached image, None to read the image from the evidence
+        encoded_pathspec: The pathspec of the image, opened with the dfvfs resolver context of the worker
+        thumbnail_path: The path to save the thumbnail to
+        thumbnail_size: The max width and height of the thumbnail
+        jpeg: True to use the EXIF thumbnail of the JPEG and save the thumbnail as a JPEG, otherwise it is saved
+            as a PNG
+        lock_path: The path of the lock file held while the thumbnail is created, shared with other server processes
+
+    Returns:
+        True if the thumbnail was created
+    """
+    file_object = None
+    try:
+        with FileLock(lock_path):
+            if os.path.isfile(thumbnail_path):
+                return True
+            if source_path:
+                file_object = open(source_path, 'rb')
+                image_file = file_object
+            else:
+                file_object = resolver.Resolver.OpenFileObject(
+                    JsonPathSpecSerializer.ReadSerialized(encoded_pathspec), resolver_context=_resolver_context)
+                image_file = _FileObjectReader(file_object)
+
+            if jpeg:
+                # The embedded EXIF thumbnail only needs the header of the image
+                exif_thumbnail = _get_exif_thumbnail(image_file.read(_exif_header_size))
+                if exif_thumbnail:
+                    image_file = StringIO(exif_thumbnail)
+                else:
+                    image_file.seek(0)
+            return _save_thumbnail(image_file, thumbnail_path, thumbnail_size, jpeg)
+    except Exception:
+        return False
+    finally:
+        if file_object:
+            file_object.close()
+
+
+def _save_thumbnail(image_file, thumbnail_path, thumbnail_size, jpeg):
+    """Saves the thumbnail of the image read from the file, returns True if it was created"""
+    partial_path = thumbnail_path + '.part'
+    try:
+        image = Image.open(image_file)
+        if image.format == 'JPEG':
+            # Lets the decoder scale down by up to 8x while decoding instead of decoding every pixel
+            image.draft(image.mode, (thumbnail_size, thumbnail_size))
+        image.thumbnail((thumbnail_size, thumbnail_size), Image.ANTIALIAS)
+        if jpeg:
+            if image.mode not in ['1', 'L', 'RGB', 'CMYK']:
+                image = image.convert('RGB')
+            image.save(partial_path, 'JPEG')
+        else:
+            if image.mode not in ['1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I']:
+                image = image.convert('RGBA')
+            image.save(partial_path, 'PNG')
+        os.rename(partial_path, thumbnail_path)
+        return True
+    except Exception:
+        if os.path.isfile(partial_path):
+            os.remove(partial_path)
+        return False
+
+
+def _get_exif_thumbnail(data):
+    """Returns the JPEG thumbnail embedded in the EXIF header of the JPEG data, or None if there is none"""
+    if data[:2] != '\xff\xd8':
+        return None
+
+    # Walks the JPEG markers before the image data looking for the EXIF APP1 segment
+    offset = 2
+    try:
+        while offset + 4 <= len(data) and data[offset] == '\xff':
+            marker = ord(data[offset + 1])
+            if marker in [0xd9, 0xda]:
+                return None
+            length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+            if marker == 0xe1 and data[offset + 4:offset + 10] == 'Exif\x00\x00':
+                return _get_tiff_thumbnail(data[offset + 10:offset + 2 + length])
+            offset += 2 + length
+    except struct.error:
+        pass
+    return None
+
+
+def _get_tiff_thumbnail(tiff):
+    """Returns the JPEG thumbnail referenced by the second IFD of the EXIF TIFF structure, or None"""
+    if tiff[:2] == 'II':
+        endian = '<'
+    elif tiff[:2] == 'MM':
+        endian = '>'
+    else:
+        return None
+
+    try:
+        ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        next_offset = ifd_offset + 2 + entry_count * 12
+        ifd_offset = struct.unpack(endian + 'I', tiff[next_offset:next_offset + 4])[0]
+        if not ifd_offset:
+            return None
+
+        start = 0
+        length = 0
+        entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        for index in range(entry_count):
+            entry_offset = ifd_offset + 2 + index * 12
+            tag, _, _, value = struct.unpack(endian + 'HHII', tiff[entry_offset:entry_offset + 12])
+            # JPEGInterchangeFormat and JPEGInterchangeFormatLength
+            if tag == 0x0201:
+                start = value
+            elif tag == 0x0202:
+                length = value
+    except struct.error:
+        return None
+
+    thumbnail = tiff[start:start + length]
+    if start and length and len(thumbnail) == length and thumbnail[:2] == '\xff\xd8':
+        return thumbnail
+    return None
+
+
+class ThumbnailService(object):
+    """This class creates thumbnails in a pool of worker processes, requested thumbnails are created before the
+    thumbnails prefetched for the rest of their directory"""
+    # Queue priorities, lower runs first
+    _requested = 0
+    _prefetched = 1
+    # Number of directories remembered as already prefetched
+    _max_prefetched_directories = 1024
+    # Number of failed thumbnails remembered, and seconds before a failed thumbnail is tried again
+    _max_failed = 10000
+    _failure_expiry = 600
+    # Seconds before a thumbnail is recorded as failed when its worker died or hung
+    _task_timeout = 120
+    # Seconds between checks for the results of the worker pool
+    _collect_interval = 0.05
+
+    def __init__(self, pathspec_helper, cache_manager, processes=2, thumbnail_size=64):
+        """Creates the service, the worker processes are started on first use
+
+        Args:
+            pathspec_helper: The PathspecHelper used to list the directories of images
+            cache_manager: The CacheManager that tracks the created thumbnails
+            processes: The number of worker processes
+            thumbnail_size: The max width and height of thumbnails
+        """
+        self.processes = max(1, processes)
+        self.thumbnail_size = thumbnail_size
+        self._pathspec_helper = pathspec_helper
+        self._cache_manager = cache_manager
+        self._lock = threading.Lock()
+        self._queue = Queue.PriorityQueue()
+        self._sequence = itertools.count()
+        # Limits the number of thumbnails waiting for a worker, so requested thumbnails are not queued behind
+        # every prefetched thumbnail
+        self._in_flight = threading.Semaphore(self.processes * 2)
+        # Thumbnail path to priority of the queued or running thumbnails
+        self._pending = {}
+        # Thumbnail path to the AsyncResult and deadline of the thumbnails in the worker pool
+        self._tasks = {}
+        self._tasks_added = threading.Condition(self._lock)
+        # Thumbnail path to the time it failed, oldest first
+        self._failed = collections.OrderedDict()
+        self._prefetched_directories = collections.OrderedDict()
+        # The pool and dispatcher belong to the process that started them
+        self._pid = None
+        self._pool = None
+        self._dispatcher = None
+        self._collector = None
+        self.created = 0
+        self.failures = 0
+
+    def get_thumbnail(self, evidence_item, prefetch=True):
+        """Returns the path of the thumbnail of the image, or None after queueing it if it does not exist yet
+
+        Args:
+            evidence_item: The evidence item of the image
+            prefetch: True to also queue the thumbnails of the other images in the directory of the image
+        """
+        thumbnail_path = self._get_thumbnail_path(evidence_item)
+        if os.path.isfile(thumbnail_path):
+            self._cache_manager.touch(thumbnail_path)
+            return thumbnail_path
+
+        self._queue_thumbnail(evidence_item, thumbnail_path, self._requested)
+        if prefetch and self._should_prefetch(evidence_item['pathspec']):
+            self._queue.put((self._prefetched, next(self._sequence), ('directory', evidence_item['pathspec'])))
+        return None
+
+    def is_pending(self, evidence_item):
+        """Returns True if the thumbnail of the image is queued or being created"""
+        with self._lock:
+            return self._get_thumbnail_path(evidence_item) in self._pending
+
+    def get_statistics(self):
+        """Returns a dictionary with the number of queued, created, and failed thumbnails"""
+        with self._lock:
+            return {'pending': len(self._pending),
+                    'created': self.created,
+                    'failures': self.failures,
+                    'processes': self.processes}
+
+    def close(self):
+        """Stops the worker processes"""
+        with self._lock:
+            if self._pool and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+    def _get_thumbnail_path(self, evidence_item):
+        """Returns the thumbnail cache path of the evidence item"""
+        return evidence_item.get('thumbnail_cache_path') or \
+            self._pathspec_helper.get_cache_path(evidence_item['pathspec'], 'thumbnails')
+
+    def _queue_thumbnail(self, evidence_item, thumbnail_path, priority):
+        """Queues the thumbnail unless it is already queued with the same or a higher priority, or it failed"""
+        with self._lock:
+            self._start()
+            if time.time() - self._failed.get(thumbnail_path, 0) < self._failure_expiry or \
+                    self._pending.get(thumbnail_path, priority + 1) <= priority:
+                return
+            self._pending[thumbnail_path] = priority
+        self._queue.put((priority, next(self._sequence), ('thumbnail', (evidence_item, thumbnail_path))))
+
+    def _start(self):
+        """Starts the dispatcher thread and worker pool in this process, the lock must be held"""
+        if self._pid == os.getpid():
+            return
+        # Work queued by a parent process is dropped, it is queued again when requested
+        self._pid = os.getpid()
+        self._queue = Queue.PriorityQueue()
+        self._in_flight = threading.Semaphore(self.processes * 2)
+        self._pending = {}
+        self._tasks = {}
+        self._pool = multiprocessing.Pool(self.processes, _init_worker)
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _dispatch(self):
+        """Hands queued images to the worker pool, and lists directories to prefetch"""
+        while True:
+            priority, _, (kind, value) = self._queue.get()
+            try:
+                if kind == 'directory':
+                    self._prefetch_directory(value)
+                else:
+                    self._submit(value[0], value[1], priority)
+            except Exception:
+                logging.exception(u'Failed to dispatch thumbnail work')
+                if kind == 'thumbnail':
+                    self._finish(value[1], False)
+
+    def _submit(self, evidence_item, thumbnail_path, priority):
+        """Submits the thumbnail to the worker pool, which reads the cached file or the evidence itself"""
+        with self._lock:
+            # Skips stale queue entries, i.e. a prefetch of a thumbnail that was requested since
+            if self._pending.get(thumbnail_path) != priority:
+                return
+            self._pending[thumbnail_path] = -1
+            pool = self._pool
+
+        # Another worker process may have created it since it was queued
+        if os.path.isfile(thumbnail_path):
+            self._finish(thumbnail_path, True)
+            return
+
+        jpeg = evidence_item.get('mimetype') == 'image/jpeg'
+        source_path = evidence_item.get('file_cache_path')
+        if not source_path or not os.path.isfile(source_path):
+            source_path = None
+
+        thumbnail_directory = os.path.dirname(thumbnail_path)
+        if not os.path.isdir(thumbnail_directory):
+            try:
+                os.makedirs(thumbnail_directory)
+            except OSError:
+                pass
+
+        self._in_flight.acquire()
+        try:
+            async_result = pool.apply_async(_create_thumbnail,
+                                            (source_path, evidence_item['pathspec'], thumbnail_path,
+                                             self.thumbnail_size, jpeg,
+                                             self._cache_manager.get_lock(thumbnail_path).path))
+        except Exception:
+            self._in_flight.release()
+            raise
+        with self._lock:
+            self._tasks[thumbnail_path] = (async_result, time.time() + self._task_timeout)
+            self._tasks_added.notify()
+
+    def _collect(self):
+        """Records the results of the worker pool. A pool replaces a worker that dies but never finishes its
+        thumbnail, so thumbnails past the timeout are recorded as failed to free their place in the pool."""
+        while True:
+            with self._lock:
+                while not self._tasks:
+                    self._tasks_added.wait()
+            time.sleep(self._collect_interval)
+            now = time.time()
+            with self._lock:
+                tasks = self._tasks.items()
+            for thumbnail_path, (async_result, deadline) in tasks:
+                if async_result.ready():
+                    try:
+                        created = async_result.get()
+                    except Exception:
+                        created = False
+                elif now >= deadline:
+                    created = False
+                else:
+                    continue
+                with self._lock:
+                    self._tasks.pop(thumbnail_path, None)
+                self._finish(thumbnail_path, created, True)
+
+    def _finish(self, thumbnail_path, created, in_flight=False):
+        """Records the result of a thumbnail"""
+        if in_flight:
+            self._in_flight.release()
+        with self._lock:
+            self._pending.pop(thumbnail_path, None)
+            self._failed.pop(thumbnail_path, None)
+            if created:
+                self.created += 1
+            else:
+                self.failures += 1
+                self._failed[thumbnail_path] = time.time()
+                while len(self._failed) > self._max_failed:
+                    self._failed.popitem(last=False)
+        if created:
+            self._cache_manager.touch(thumbnail_path)
+        else:
+            logging.warn(u'Failed to create thumbnail ' + thumbnail_path)
+
+    def _should_prefetch(self, encoded_pathspec):
+        """Returns True the first time an image of a directory is requested"""
+        key = self._pathspec_helper.get_pathspec_key(encoded_pathspec)
+        directory = (key.image_key, os.path.dirname(key.file_path))
+        with self._lock:
+            if directory in self._prefetched_directories:
+                return False
+            self._prefetched_directories[directory] = True
+            while len(self._prefetched_directories) > self._max_prefetched_directories:
+                self._prefetched_directories.popitem(last=False)
+            return True
+
+    def _prefetch_directory(self, encoded_pathspec):
+        """Queues the thumbnails of the images in the directory of the pathspec"""
+        directory = self._pathspec_helper.get_parent_pathspec(encoded_pathspec)
+        if not directory:
+            return
+
+        for item in self._pathspec_helper.iter_directory(directory, analyze=False):
+            if item.get('meta_type') == 'File' and item.get('mimetype', '').startswith('image'):
+                thumbnail_path = self._get_thumbnail_path(item)
+                if not os.path.isfile(thumbnail_path):
+                    self._queue_thumbnail(item, thumbnail_path, self._prefetched)